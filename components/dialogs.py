@@ -889,6 +889,7 @@ class EditSummary(SummaryDialog):
         summary_text = self.summary_textbox.get("1.0", 'end-1c')
         self.state.summaries[self.summary['id']]['text'] = summary_text
         self.state.summaries[self.summary['id']]['end_id'] = self.included_nodes[-1]['id']
+        self.state.summaries_changed()
 
 
 class Summaries(Dialog):
@@ -1182,7 +1183,7 @@ class ModelConfigDialog(Dialog):
         Dialog.__init__(self, parent, title="Model Configuration")
 
     def set_vars(self):
-        self.available_models = self.state.model_config['models']
+        self.available_models = deepcopy(self.state.model_config['models'])
         self.selected_model.set(self.state.generation_settings['model'])
         self.openai_api_key = self.state.OPENAI_API_KEY if self.state.OPENAI_API_KEY else ""
         self.ai21_api_key = self.state.AI21_API_KEY if self.state.AI21_API_KEY else ""
@@ -12,7 +12,8 @@ from view.styles import textbox_config, code_textbox_config
 from components.templates import *
 from view.tree_vis import round_rectangle
 from pprint import pformat, pprint
-from gpt import completions_text, gen
+from gpt import completions_text
+from generation_service import generation_service
 import uuid
 import threading
 from tkinter.colorchooser import askcolor
@@ -743,14 +744,16 @@ class JanusPlayground(Module):
         if mode == 'completions':
             # disable generate button
             self.generate_button.configure(state='disabled')
-            threading.Thread(target=self.call_model, args=(prompt, settings, config)).start()
+            self.call_model(prompt, settings, config)
         elif mode == 'eval':
             # disable eval button
             self.eval_prompt_button.configure(state='disabled')
-            threading.Thread(target=self.call_model_prompt, args=(prompt, settings, config)).start()
+            self.call_model_prompt(prompt, settings, config)
 
     def call_model(self, prompt, settings, model_config):
-        response, error = gen(prompt, settings, model_config)
+        generation_service().submit(prompt, settings, model_config, callback=self.show_completions)
+
+    def show_completions(self, response, error):
         self.generate_button.configure(state='normal')
         self.textbox.model_response = response
         self.textbox.process_logprobs()
@@ -759,8 +762,8 @@ class JanusPlayground(Module):
             self.completion_windows.open_window(completion)
 
     def call_model_prompt(self, prompt, settings, model_config):
-        self.textbox.call_model_prompt(prompt, settings, model_config)
-        self.eval_prompt_button.configure(state='normal')
+        self.textbox.call_model_prompt(prompt, settings, model_config,
+                                       callback=lambda: self.eval_prompt_button.configure(state='normal'))
 
     def call_model_inline(self, prompt, settings, selected_range):
         self.textbox.call_model_inline(prompt, settings, selected_range)
@@ -1007,7 +1010,9 @@ class MiniMap(Module):
             pruned_tree = limited_branching_tree(self.ancestry, filtered_tree, depth_limit=self.settings()['path_length_limit'])
         elif self.settings()['prune_mode'] == 'selection_dist':
             pruned_tree = limited_distance_tree(filtered_tree, self.selected_node, distance_limit=self.settings()['path_length_limit'], 
-                                                node_dict=filtered_dict)
+                                                node_dict=filtered_dict,
+                                                distance=lambda a, b: self.state.path_distance(self.state.node(a['id']),
+                                                                                               self.state.node(b['id'])))
             self.ancestry = self.ancestry[-(self.settings()['path_length_limit'] + 1):]
         elif self.settings()['prune_mode'] == 'wavefunction_collapse':
             pruned_tree = collapsed_wavefunction(self.ancestry, filtered_tree, self.selected_node, depth_limit=self.settings()['path_length_limit'])
@@ -1294,21 +1299,24 @@ class Edit(Module):
             self.write_template()
             
 
+    def set_pinned_node(self, node_id):
+        self.state.update_user_frame(update={'module_settings': {self.name: {'node_id': node_id}}})
+
     def toggle_pin(self, *args):
         if self.settings()['node_id']:
             if self.settings()['node_id'] != self.state.selected_node_id:
                 self.done_editing()
             else:
-                self.settings()['node_id'] = None
+                self.set_pinned_node(None)
                 self.node_label.configure(image="")
         else:
-            self.settings()['node_id'] = self.state.selected_node['id']
+            self.set_pinned_node(self.state.selected_node['id'])
             self.node_label.configure(image=icons.get_icon('pin-red'), compound="left")
 
     def done_editing(self):
         self.save_all()
         # unpin edit node id
-        self.settings()['node_id'] = None
+        self.set_pinned_node(None)
         self.rebuild_textboxes()
         # TODO close pane
 
@@ -1674,10 +1682,13 @@ class Transformers(Module):
         self.write_all()
         prompt = self.prompt
         n = self.generation_settings["num_continuations"]
-        threading.Thread(target=self.call_model, args=(prompt, n)).start()
+        self.call_model(prompt, n)
 
     def call_model(self, prompt, n):
-        response, error = gen(prompt, self.generation_settings, self.state.model_config)
+        generation_service().submit(prompt, self.generation_settings, self.state.model_config,
+                                    callback=self.show_completions)
+
+    def show_completions(self, response, error):
         response_text_list = completions_text(response)
         self.completions_frame.show()
         for completion in response_text_list:
@@ -2017,6 +2028,7 @@ class Wavefunction(Module):
             prompt=active_node['prefix']
             new_child = self.state.create_child(self.state.selected_node, expand=True)
             new_child['text'] = prompt
+            self.state.text_changed(new_child)
             self.state.tree_updated(add=[new_child['id']])
 
     def save_image(self):
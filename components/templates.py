@@ -7,6 +7,7 @@ from util.custom_tks import TextAware, ScrollableFrame
 from util.react import *
 from util.util_tk import create_side_label, create_label, Entry, create_button, create_slider, create_combo_box, create_checkbutton
 from util.gpt_util import logprobs_to_probs
+from util.token_array import token_array
 from util.util import split_indices
 from util.util_tree import num_descendents
 from tkinter.scrolledtext import ScrolledText
@@ -16,7 +17,8 @@ import time
 import os
 import codecs
 from PIL import Image, ImageTk
-from gpt import gen, completions_text
+from gpt import completions_text
+from generation_service import generation_service
 import json
 import bisect
 import threading
@@ -192,7 +194,8 @@ class NodeWindows(Windows):
             self.windows[window_id]['icon'].configure(image=icon)
 
     def draw_num_descendents(self, window_id):
-        descendents = num_descendents(self.windows[window_id]['node'], filter=lambda node:self.callbacks["In nav"]["callback"](node=node))
+        descendents = num_descendents(self.windows[window_id]['node'], filter=lambda node:self.callbacks["In nav"]["callback"](node=node)) \
+                      + self.callbacks["Unloaded descendents"]["callback"](node=self.windows[window_id]['node'])
         color = text_color() if descendents > 1 else ooc_color()
         self.windows[window_id]['num_descendents'] = tk.Label(self.windows[window_id]['frame'], text=descendents, bg=bg_color(), fg=color)
         self.windows[window_id]['num_descendents'].grid(row=0, column=3, rowspan=len(self.buttons))
@@ -824,10 +827,14 @@ class LoomTerminal(TextAware):
             text = self.get("1.0", "insert")
             prompt = text[-prompt_length:]
             selected_range = [len(text), len(text)]
-        threading.Thread(target=self.call_model_inline, args=(prompt, generation_settings, selected_range, config)).start()
+        self.call_model_inline(prompt, generation_settings, selected_range, config)
 
     def call_model_inline(self, prompt, settings, selected_range, model_config):
-        response, error = gen(prompt, settings, model_config)
+        generation_service().submit(prompt, settings, model_config,
+                                    callback=lambda response, error: self.show_inline_completions(response,
+                                                                                                  selected_range))
+
+    def show_inline_completions(self, response, selected_range):
         response_text_list = completions_text(response)
         print(response_text_list)
         self.alternatives = []
@@ -843,14 +850,19 @@ class LoomTerminal(TextAware):
         self.tag_remove("alternate", "1.0", tk.END)
         self.insert_inline_completion()
 
-    def call_model_prompt(self, prompt, settings, model_config):
+    # callback is called after the logprobs are shown
+    def call_model_prompt(self, prompt, settings, model_config, callback=None):
         eval_settings = settings.copy()
-        eval_settings.update({'max_tokens': 1, 'num_continuations': 1, 'logprobs': 15})
-        response, error = gen(prompt, eval_settings, model_config)
-        # enable eval button
-        #self.eval_prompt_button.configure(state='normal')
-        self.model_response = response
-        self.process_logprobs()
+        # greedy, so evaluating the same prompt again is answered from the request cache
+        eval_settings.update({'response_length': 1, 'num_continuations': 1, 'logprobs': 15, 'temperature': 0})
+
+        def show_logprobs(response, error):
+            self.model_response = response
+            self.process_logprobs()
+            if callback:
+                callback()
+
+        generation_service().submit(prompt, eval_settings, model_config, callback=show_logprobs)
 
     def insert_inline_completion(self, step=1):
         if self.inline_completions:
@@ -874,7 +886,7 @@ class LoomTerminal(TextAware):
             textbox_length = len(self.get("1.0", "end-1c"))
             diff = textbox_length - prompt_length
             if self.model_response['prompt']['tokens']:
-                for token_data in self.model_response['prompt']['tokens']:
+                for token_data in token_array(self.model_response['prompt']['tokens']):
                     #print(token_data)
                     if 'counterfactuals' in token_data and token_data['counterfactuals']:
                         alt_dict = {'alts': [],
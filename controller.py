@@ -3,6 +3,7 @@ import os
 import tkinter as tk
 import threading
 from collections import defaultdict, ChainMap
+from copy import deepcopy
 import time
 from functools import reduce
 from pprint import pprint
@@ -22,12 +23,18 @@ from view.colors import history_color, not_visited_color, visited_color, ooc_col
     immutable_color
 from view.display import Display
 from components.dialogs import *
-from model import TreeModel
+from model import TreeModel, UNLOADED_SUFFIX
+from generation_service import BULK
 from util.util import clip_num, metadata, diff, split_indices, diff_linesToWords
 from util.util_tree import ancestry_in_range, depth, height, flatten_tree, stochastic_transition, node_ancestry, subtree_list, \
     node_index, nearest_common_ancestor, filtered_children
 from util.gpt_util import logprobs_to_probs, parse_logit_bias
 from util.textbox_util import distribute_textbox_changes
+from util.tree_file import TREE_EXTENSION
+from util.tree_db import DATABASE_EXTENSIONS
+from util.compaction import report_text
+from util.request_cache import request_cache
+from util.tree_hash import diff_text
 from util.keybindings import tkinter_keybindings
 from view.icons import Icons
 from difflib import SequenceMatcher
@@ -62,7 +69,6 @@ class Controller:
         self.register_model_callbacks()
         self.setup_key_bindings()
         self.build_menus()
-        self.ancestor_end_indices = None
         self.nav_history = []
         self.undo_history = []
 
@@ -180,6 +186,8 @@ class Controller:
             "Edit": [
                 ('Edit node', 'Ctrl+E', None, no_junk_args(self.toggle_edit_mode)),
                 ('Toggle textbox editable', 'Alt+Shift+E', None, no_junk_args(self.toggle_editable)),
+                ('Previous revision', None, None, no_junk_args(self.prev_revision)),
+                ('Next revision', None, None, no_junk_args(self.next_revision)),
                 "-",
                 ("New root child", 'Ctrl+Shift+H', None, no_junk_args(self.create_root_child)),
                 ("Create parent", 'Alt-Left', None, no_junk_args(self.create_parent)),
@@ -212,6 +220,7 @@ class Controller:
             "Generation": [
                 ('Generation settings', 'Ctrl+shift+p', None, no_junk_args(self.generation_settings_dialog)),
                 ('Generate', 'G, Ctrl+G', None, no_junk_args(self.generate)),
+                ('Generate on leaves', None, None, no_junk_args(self.generate_leaves)),
                 #('View summaries', '', None, no_junk_args(self.view_summaries)),
 
             ],
@@ -241,6 +250,7 @@ class Controller:
             ],
             "Developer": [
                 ('Run code', 'Ctrl+Shift+B', None, no_junk_args(self.run)),
+                ('Request cache', None, None, no_junk_args(self.show_request_cache)),
 
             ],
             "Info": [
@@ -357,6 +367,9 @@ class Controller:
     def nav_select(self, *, node_id, open=False):
         if not node_id or node_id == self.state.selected_node_id:
             return
+        if node_id.endswith(UNLOADED_SUFFIX):
+            self.nav_open(node_id)
+            return
         if self.change_parent.meta["click_mode"]:
             self.change_parent(node=self.state.node(node_id))
         # TODO This causes infinite recursion from the vis node. Need to change how updating open status works
@@ -375,19 +388,17 @@ class Controller:
 
     @metadata(name="Toggle prompt", keys=["<asterisk>"], display_key="")
     def toggle_prompt(self, node=None):
-        self.state.preferences['show_prompt'] = not self.state.preferences['show_prompt']
+        self.state.update_user_frame(update={'preferences': {'show_prompt': not self.state.preferences['show_prompt']}})
         self.refresh_textbox()
 
     def next_tag(self, tag, node=None):
         node = node if node else self.state.selected_node
-        next_tag_id = self.state.find_next(node=node, filter=lambda node: self.state.has_tag_attribute(node, tag),
-                                           visible_filter=self.in_nav)
+        next_tag_id = self.state.find_next(node=node, tag=tag, visible_filter=self.in_nav)
         self.select_node(self.state.node(next_tag_id))
 
     def prev_tag(self, tag, node=None):
         node = node if node else self.state.selected_node
-        prev_tag_id = self.state.find_prev(node=node, filter=lambda node: self.state.has_tag_attribute(node, tag),
-                                           visible_filter=self.in_nav)
+        prev_tag_id = self.state.find_prev(node=node, tag=tag, visible_filter=self.in_nav)
         self.select_node(self.state.node(prev_tag_id))
 
     @metadata(name="Go to next bookmark", keys=["<Key-d>", "<Control-d>"])
@@ -425,6 +436,18 @@ class Controller:
     def in_nav(self, node):
         return self.display.nav_tree.exists(node['id'])
 
+    @metadata(name="Unloaded descendents")
+    def unloaded_descendents(self, node):
+        return self.state.unloaded_descendents(node)
+
+    # Nav items of nodes whose children haven't been loaded get a placeholder child, so they can be opened
+    @metadata(name="Nav open")
+    def nav_open(self, node_id=None):
+        node_id = node_id if node_id else self.display.nav_tree.focus()
+        if node_id.endswith(UNLOADED_SUFFIX):
+            node_id = node_id[:-len(UNLOADED_SUFFIX)]
+        self.state.load_children(self.state.node(node_id))
+
     @metadata(name="Select node")
     def select_node(self, node, noscroll=False, ask_reveal=True, open=True):
         if node == self.state.selected_node:
@@ -441,10 +464,10 @@ class Controller:
         #print('writing textbox changes')
         self.write_textbox_changes()
         if open:
-            node['open'] = True
+            self.state.set_node_flag(node, 'open', True)
             self.refresh_nav_node(node)
         else:
-            node['open'] = self.display.nav_tree.item(node["id"], "open")
+            self.state.set_node_flag(node, 'open', self.display.nav_tree.item(node["id"], "open"))
         self.nav_history.append(self.state.selected_node_id)
         self.undo_history = []
         self.state.select_node(node['id'])
@@ -669,12 +692,24 @@ class Controller:
         if node is None:
             node = self.state.selected_node
         try:
-            node["open"] = True
+            self.state.set_node_flag(node, "open", True)
             self.display.nav_tree.item(node['id'], open=True)
         except Exception as e:
             print(str(e))
         self.state.generate_continuations(node=node, **kwargs)
 
+    # Generates on every leaf under the node. These wait behind generations on single nodes, see
+    # generation_service.py
+    @metadata(name="Generate on leaves")
+    def generate_leaves(self, node=None):
+        node = node if node else self.state.selected_node
+        # in a lazily loaded tree, nodes whose children aren't loaded would look like leaves
+        self.state.load_subtree(node)
+        leaves = [n for n in subtree_list(node, filter=self.in_nav)
+                  if not any(self.in_nav(child) for child in n['children'])]
+        for leaf in leaves:
+            self.state.generate_continuations(node=leaf, priority=BULK)
+
 
     @metadata(name="Retry")
     def retry(self, node=None):
@@ -792,6 +827,30 @@ class Controller:
             _, selected_ancestor = self.index_to_ancestor(index)
             self.nav_select(node_id=selected_ancestor["id"])
 
+    # steps the selected node's text back or forward through its revision history. The text the node had when
+    # browsing started is saved as the latest revision first, so nothing is lost
+    @metadata(name="Goto revision", keys=[], display_key="", node_id=None, revision_index=None, text=None)
+    def goto_revision(self, traverse=-1):
+        self.save_edits()
+        node = self.state.selected_node
+        if self.goto_revision.meta["node_id"] != node["id"] or self.goto_revision.meta["text"] != node["text"]:
+            self.state.save_revision(node)
+            self.goto_revision.meta["node_id"] = node["id"]
+            self.goto_revision.meta["revision_index"] = self.state.revision_count(node) - 1
+        index = self.goto_revision.meta["revision_index"] + traverse
+        if not 0 <= index < self.state.revision_count(node):
+            return
+        self.goto_revision.meta["revision_index"] = index
+        self.goto_revision.meta["text"] = self.state.restore_revision(node, index)
+
+    @metadata(name="Previous revision", keys=[], display_key="")
+    def prev_revision(self):
+        self.goto_revision(-1)
+
+    @metadata(name="Next revision", keys=[], display_key="")
+    def next_revision(self):
+        self.goto_revision(1)
+
     @metadata(name="Split node", keys=[], display_key="")
     def split_node(self, index, change_selection=True, node=None):
         node = node if node else self.state.selected_node
@@ -801,7 +860,7 @@ class Controller:
                 return
             self.write_textbox_changes()
             ancestor_index, selected_ancestor = self.index_to_ancestor(index)
-            ancestor_end_indices = [ind[1] for ind in self.state.ancestor_text_indices(node)]
+            ancestor_end_indices = self.state.ancestry_end_indices(node)
             negative_offset = ancestor_end_indices[ancestor_index] - index
             split_index = len(selected_ancestor['text']) - negative_offset
             new_parent, _ = self.state.split_node(selected_ancestor, split_index)
@@ -1018,6 +1077,7 @@ class Controller:
             changed_ancestry = distribute_textbox_changes(new_text, ancestry)
             for ancestor in changed_ancestry:
                 self.state.tree_node_dict[ancestor['id']]['text'] = ancestor['text']
+                self.state.text_changed(ancestor)
             self.update_nav_tree(edit=[ancestor['id'] for ancestor in changed_ancestry])
 
     def select_endpoints_range(self, start_endpoint, end_endpoint):
@@ -1094,22 +1154,26 @@ class Controller:
         end_node = self.state.node(end_endpoint[0])
         return self.state.chain_uninterrupted(start_node, end_node)
 
+    # end indices of nodes in the selected node's ancestry, cached by the model
+    @property
+    def ancestor_end_indices(self):
+        return self.state.ancestry_end_indices(self.state.selected_node)
+
     def endpoints_to_range(self, start, end):
-        ancestor_text_indices = self.state.ancestor_text_indices(self.state.selected_node)
-        # ancestor_text_indices is a list of types (start, end) for nodes in ancestry
+        start_indices = self.state.ancestry_start_indices(self.state.selected_node)
+        # start_indices is a list of the start text index of each node in ancestry
         # endpoints are ({start_node_id: text_index}, {end_node_id: text_index})
-        start_node_index = node_index(self.state.node(start[0]), self.state.tree_node_dict)
-        end_node_index = node_index(self.state.node(end[0]), self.state.tree_node_dict)
-        start_node_text_index = ancestor_text_indices[start_node_index][0]
-        end_node_text_index = ancestor_text_indices[end_node_index][0]
+        start_node_index = self.state.node_depth(self.state.node(start[0]))
+        end_node_index = self.state.node_depth(self.state.node(end[0]))
+        start_node_text_index = start_indices[start_node_index]
+        end_node_text_index = start_indices[end_node_index]
         start_text_index = start_node_text_index + start[1]
         end_text_index = end_node_text_index + end[1]
         return start_text_index, end_text_index
 
     def range_to_endpoints(self, start, end):
         ancestry = self.state.ancestry(self.state.selected_node)
-        ancestor_text_indices = self.state.ancestor_text_indices(self.state.selected_node)
-        start_indices = [i[0] for i in ancestor_text_indices]
+        start_indices = self.state.ancestry_start_indices(self.state.selected_node)
         # use bisect to find the index of the start and end node
         start_node_index = bisect.bisect_right(start_indices, start) - 1
         end_node_index = bisect.bisect_right(start_indices, end) - 1
@@ -1121,14 +1185,10 @@ class Controller:
         return (start_node['id'], start_text_index), (end_node['id'], end_text_index)
 
     def node_range(self, node):
-        ancestor_text_indices = self.state.ancestor_text_indices(node)
-        idx = node_index(node, self.state.tree_node_dict)
-        return ancestor_text_indices[idx]
+        return self.state.ancestry_start_indices(node)[-1], self.state.ancestry_end_indices(node)[-1]
 
     def index_to_ancestor(self, index):
-        ancestor_end_indices = [ind[1] for ind in self.state.ancestor_text_indices(self.state.selected_node)]
-        ancestor_index = bisect.bisect_left(ancestor_end_indices, index)
-        return ancestor_index, node_ancestry(self.state.selected_node, self.state.tree_node_dict)[ancestor_index]
+        return self.state.index_to_ancestor(self.state.selected_node, index)
 
     # TODO nodes with mixed prompt/continuation
     def tag_prompts(self):
@@ -1163,6 +1223,7 @@ class Controller:
 
     @metadata(name="Search", keys=["<Control-Shift-KeyPress-F>"], display_key="ctrl-shift-f")
     def search(self):
+        self.state.load_all()
         dialog = SearchDialog(parent=self.display.frame, state=self.state, goto=self.nav_select)
         self.refresh_textbox()
 
@@ -1262,8 +1323,7 @@ class Controller:
                 self.change_token.meta["counterfactual_index"] = 0
                 self.change_token.meta["prev_token"] = None
                 model_response, prompt, completion = self.state.get_request_info(selected_node)
-                token_offsets = [token_data['position']['start'] for token_data in completion['tokens']]
-                token_index = bisect.bisect_left(token_offsets, offset) - 1
+                token_index = bisect.bisect_left(completion['tokens'].start, offset) - 1
                 token_data = completion['tokens'][token_index]
                 counterfactuals = token_data['counterfactuals']
                 start = token_data['position']['start']
@@ -1292,7 +1352,7 @@ class Controller:
         token_data = completion['tokens'][token_index]
 
         if not self.change_token.meta['temp_token_offsets']:
-            token_offsets = [token_data['position']['start'] for token_data in completion['tokens']]
+            token_offsets = completion['tokens'].start.tolist()
             self.change_token.meta['temp_token_offsets'] = token_offsets
         else:
             token_offsets = self.change_token.meta['temp_token_offsets']
@@ -1301,7 +1361,7 @@ class Controller:
         token = token_data['generatedToken']['token']
         counterfactuals = token_data['counterfactuals'].copy()
         original_token = (token, counterfactuals.pop(token, None))
-        index = node_index(node, self.state.tree_node_dict)
+        index = self.state.node_depth(node)
         sorted_counterfactuals = list(sorted(counterfactuals.items(), key=lambda item: item[1], reverse=True))
         sorted_counterfactuals.insert(0, original_token)
 
@@ -1345,7 +1405,7 @@ class Controller:
     @metadata(name="Apply counterfactual", keys=["<Command-Return>"], display_key="", counterfactual_index=0, prev_token=None)
     def apply_counterfactual_changes(self):
         # TODO apply to non selected nodes
-        index = node_index(self.state.selected_node, self.state.tree_node_dict)
+        index = self.state.node_depth(self.state.selected_node)
 
         new_text = self.display.textbox.get(f"1.0 + {self.ancestor_end_indices[index - 1]} chars", "end-1c")
         self.state.update_text(node=self.state.selected_node, text=new_text, modified_flag=False)
@@ -1559,7 +1619,7 @@ class Controller:
     @metadata(name="Expand children", keys=["<Control-slash>"], display_key="Ctrl-/")
     def expand_node(self, node=None):
         node = node if node else self.state.selected_node
-        node['open'] = True
+        self.state.set_node_flag(node, 'open', True)
         self.display.nav_tree.item(
             node["id"],
             open=True
@@ -1568,7 +1628,7 @@ class Controller:
     @metadata(name="Collapse node", keys=["<Control-question>"], display_key="Ctrl-?")
     def collapse_node(self, node=None):
         node = node if node else self.state.selected_node
-        node['open'] = False
+        self.state.set_node_flag(node, 'open', False)
         self.display.nav_tree.item(
             node["id"],
             open=False
@@ -1584,20 +1644,23 @@ class Controller:
     #################################
 
     def set_visited(self, status=True):
-        self.state.selected_node["visited"] = status
+        self.state.set_node_flag(self.state.selected_node, "visited", status)
         self.update_nav_tree()
         self.update_nav_tree_selected()
 
 
     def set_subtree_visited(self, status=True):
-        for d in flatten_tree(self.state.selected_node):
+        nodes = flatten_tree(self.state.selected_node)
+        for d in nodes:
             d["visited"] = status
+        self.state.nodes_changed(nodes)
         self.update_nav_tree()
         self.update_nav_tree_selected()
 
     def set_all_visited(self, status=True):
         for d in self.state.nodes:
             d["visited"] = status
+        self.state.nodes_changed(self.state.nodes)
         self.update_nav_tree()
         self.update_nav_tree_selected()
 
@@ -1607,6 +1670,7 @@ class Controller:
         if not 'meta' in node:
             node['meta'] = {}
         node['meta']['source'] = source
+        self.state.node_changed(node)
         if refresh:
             self.refresh_textbox()
             self.update_nav_tree()
@@ -1665,25 +1729,83 @@ class Controller:
         options = {
             'initialdir': os.getcwd() + '/data',
             'parent': self.root, 'title': "Open a json tree",
-            'filetypes': [('json files', '.json')]
+            'filetypes': [('trees', ('.json', TREE_EXTENSION) + DATABASE_EXTENSIONS), ('json files', '.json'),
+                          ('loom files', TREE_EXTENSION), ('databases', DATABASE_EXTENSIONS)]
         }
         filename = filedialog.askopenfilename(**options)
         if not filename:
             return
         self.state.open_tree(filename)
 
+    @metadata(name="Restore backup", keys=[], display_key="")
+    def restore_backup(self):
+        if not self.state.tree_filename:
+            return
+        options = {
+            'initialdir': self.state.backup_store().manifests_dir,
+            'parent': self.root, 'title': "Restore a backup point",
+            'filetypes': [('backup points', '.json')]
+        }
+        filename = filedialog.askopenfilename(**options)
+        if not filename:
+            return
+        name = os.path.splitext(os.path.basename(filename))[0]
+        self.state.open_tree(self.state.restore_backup(name))
+
+    @metadata(name="Compare with file", keys=[], display_key="")
+    def compare_tree(self):
+        if not self.state.tree_filename:
+            return
+        options = {
+            'initialdir': os.path.dirname(self.state.tree_filename),
+            'parent': self.root, 'title': "Compare with a tree",
+            'filetypes': [('trees', ('.json', TREE_EXTENSION) + DATABASE_EXTENSIONS)]
+        }
+        filename = filedialog.askopenfilename(**options)
+        if not filename:
+            return
+        diff = self.state.diff_tree_file(filename)
+        print(diff_text(diff))
+        messagebox.showinfo("Compare with file", '\n'.join(f'{kind}: {len(ids)}' for kind, ids in diff.items()))
+
+    @metadata(name="Compact tree", keys=[], display_key="")
+    def compact_tree(self):
+        if not self.state.tree_filename:
+            return
+        report = self.state.compact_tree(dry_run=True)
+        result = messagebox.askquestion("Compact tree", f"Remove unreferenced data and rewrite the tree file?\n\n"
+                                                        f"{report_text(report)}", icon='warning')
+        if result != 'yes':
+            return
+        self.state.compact_tree()
+
+    # Shows how often deterministic requests were answered from the request cache, and offers to clear it
+    @metadata(name="Request cache")
+    def show_request_cache(self):
+        cache = request_cache()
+        stats = cache.stats()
+        bypassed = '\n(bypassed)' if cache.bypass else ''
+        result = messagebox.askquestion("Request cache", f"hits: {stats['hits']}\nmisses: {stats['misses']}\n"
+                                                         f"entries: {stats['entries']} "
+                                                         f"({stats['bytes'] / 1024:.1f} KB){bypassed}\n\n"
+                                                         f"Clear the cache?")
+        if result != 'yes':
+            return
+        cache.clear()
+
     # TODO repeated code
     @metadata(name="Import JSON as subtree", keys=["<Control-Shift-KeyPress-O>"], display_key="ctrl+shift+o")
     def import_tree(self):
         options = {
             'initialdir': os.getcwd() + '/data',
-            'parent': self.root, 'title': "Import a json tree",
-            'filetypes': [('json files', '.json')]
+            'parent': self.root, 'title': "Import trees",
+            'filetypes': [('trees', ('.json', '.jsonl', TREE_EXTENSION) + DATABASE_EXTENSIONS), ('json files', '.json'),
+                          ('jsonl streams', '.jsonl'), ('loom files', TREE_EXTENSION), ('databases', DATABASE_EXTENSIONS)]
         }
-        filename = filedialog.askopenfilename(**options)
-        if not filename:
+        filenames = filedialog.askopenfilenames(**options)
+        if not filenames:
             return
-        self.state.import_tree(filename)
+        self.state.import_trees(filenames)
 
     @metadata(name="New tree from node", keys=[], display_key="")
     def new_from_node(self):
@@ -1713,9 +1835,12 @@ class Controller:
         if self.state.preferences['model_response'] == 'backup' and not autosave:
             self.state.backup_and_delete_model_response_data()
         elif self.state.preferences['model_response'] == 'discard':
-            self.state.tree_raw_data['model_responses'] = {}
+            self.state.model_responses.clear()
 
-        self.state.save_tree(backup=popup, save_filename=filename, subtree=subtree)
+        if autosave:
+            self.state.schedule_autosave()
+        else:
+            self.state.save_tree(backup=popup, save_filename=filename, subtree=subtree)
         if popup:
             messagebox.showinfo(title=None, message="Saved!")
         #except Exception as e:
@@ -1870,8 +1995,9 @@ class Controller:
             # self.save_tree(popup=False)
 
     def workspace_dialog(self):
-        dialog = WorkspaceDialog(self.display.frame, self.state.workspace)
+        dialog = WorkspaceDialog(self.display.frame, deepcopy(self.state.workspace))
         if dialog.result:
+            self.state.update_user_frame({'workspace': {key: dialog.result[key] for key in dialog.vars}})
             self.refresh_workspace()
 
     @metadata(name="Show Info", keys=["<Control-i>"], display_key="i")
@@ -2002,6 +2128,7 @@ class Controller:
             #new_text = self.state.submit_modifications(text)
             new_child = self.create_child(toggle_edit=False)
             new_child['text'] = text
+            self.state.text_changed(new_child)
             self.state.tree_updated(add=[new_child['id']])    
         if auto_response:
             self.generate(update_selection=True, placeholder="")
@@ -2397,6 +2524,8 @@ class Controller:
         # if node is root, then index = 0
         insert_idx = self.state.siblings_index(node, filter=self.state.visible)
         parent_id = node.get("parent_id", "")
+        if self.display.nav_tree.exists(parent_id + UNLOADED_SUFFIX):
+            self.display.nav_tree.delete(parent_id + UNLOADED_SUFFIX)
         # TODO instead of visible, check if parent is in nav tree
         if parent_id:
             if not self.in_nav(self.state.node(parent_id)):
@@ -2416,6 +2545,9 @@ class Controller:
             tags=tags,
             **dict(image=image) if image else {}
         )
+        if self.state.unloaded_children(node):
+            self.display.nav_tree.insert(parent=node["id"], index="end", iid=node["id"] + UNLOADED_SUFFIX,
+                                         text=f'... {self.state.unloaded_children(node)} unloaded')
 
     def build_nav_tree(self, flat_tree=None):
         if not flat_tree:
@@ -2513,9 +2645,14 @@ class Controller:
 
         # Update the open state of all nodes based on the navbar
         # TODO
+        changed = []
         for node in self.state.nodes:
             if self.display.nav_tree.exists(node["id"]):
-                node["open"] = self.display.nav_tree.item(node["id"], "open")
+                is_open = self.display.nav_tree.item(node["id"], "open")
+                if node.get("open") != is_open:
+                    node["open"] = is_open
+                    changed.append(node)
+        self.state.nodes_changed(changed)
 
         # Update tag of node based on visited status
         self.refresh_nav_node(self.state.selected_node)
@@ -2589,7 +2726,7 @@ class Controller:
 
         open_nav_ids = {d["id"] for d in open_nav_nodes}
         # Ordered by tree order
-        open_nav_ids = [iid for iid in self.state.tree_node_dict.keys() if iid in open_nav_ids]
+        open_nav_ids = [d["id"] for d in self.state.nodes if d["id"] in open_nav_ids]
 
         # Magic numbers
         WIDTH_PER_INDENT = 20  # Derived...
@@ -0,0 +1,244 @@
+import asyncio
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+from gpt import gen, cache_key, SINGLE_COMPLETION_TYPES
+from util.gpt_util import get_correct_key
+from util.request_cache import request_cache
+from util.util import timestamp
+
+"""
+All generation requests run as coroutines on one event loop, on its own thread, so many requests in flight
+cost one loop thread (plus worker threads for blocking clients) instead of a thread each.
+
+submit can be called from any thread and returns a concurrent.futures.Future of (response, error). If a
+callback is given it is called as callback(response, error) on the Tk thread: finished requests are put in a
+queue which poll_with drains every POLL_INTERVAL ms with after(), so callbacks can use widgets and the tree.
+
+Requests wait for a ProviderLimiter before they're sent. Each (model type, api_base, api key) has one, which
+allows at most 'max_concurrent' requests at once and, if the model's config sets them, 'requests_per_minute'
+and 'tokens_per_minute' with token buckets. Waiting requests go in order of priority (INTERACTIVE before
+BULK), then of submission.
+
+Deterministic requests are answered from the request cache without waiting, unless submitted with
+bypass_cache=True. Cached responses get a new id and timestamp.
+"""
+
+# ms between checks for finished requests
+POLL_INTERVAL = 50
+
+# priorities of requests, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+DEFAULT_MAX_CONCURRENT = 16
+# for estimating the tokens of a prompt without tokenizing it
+CHARS_PER_TOKEN = 4
+
+
+# Holds up to per_minute units, refilled continuously
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    # seconds until amount can be taken. More than the bucket holds waits for a full bucket
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.per_minute)
+        return max(0, (amount - self.tokens) * 60 / self.per_minute)
+
+    def take(self, amount):
+        self.refill()
+        self.tokens -= min(amount, self.per_minute)
+
+
+# Only used on the service's loop
+class ProviderLimiter:
+    def __init__(self, loop):
+        self.loop = loop
+        self.max_concurrent = DEFAULT_MAX_CONCURRENT
+        self.request_bucket = None
+        self.token_bucket = None
+        self.running = 0
+        # (priority, submission order, requests, tokens, future)
+        self.waiting = []
+        self.order = itertools.count()
+        self.timer = None
+
+    def configure(self, model_info):
+        self.max_concurrent = model_info.get('max_concurrent', DEFAULT_MAX_CONCURRENT)
+        requests_per_minute = model_info.get('requests_per_minute')
+        tokens_per_minute = model_info.get('tokens_per_minute')
+        if requests_per_minute != (self.request_bucket.per_minute if self.request_bucket else None):
+            self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        if tokens_per_minute != (self.token_bucket.per_minute if self.token_bucket else None):
+            self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    async def acquire(self, priority, requests, tokens):
+        future = self.loop.create_future()
+        heapq.heappush(self.waiting, (priority, next(self.order), requests, tokens, future))
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled after being let through
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.running -= 1
+        self.dispatch()
+
+    # lets waiting requests through until one has to wait, then checks again when it can go
+    def dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.waiting:
+            priority, _, requests, tokens, future = self.waiting[0]
+            if future.cancelled():
+                heapq.heappop(self.waiting)
+                continue
+            if self.running >= self.max_concurrent:
+                return
+            wait = max(self.request_bucket.wait_time(requests) if self.request_bucket else 0,
+                       self.token_bucket.wait_time(tokens) if self.token_bucket else 0)
+            if wait > 0:
+                self.timer = self.loop.call_later(wait, self.dispatch)
+                return
+            heapq.heappop(self.waiting)
+            if self.request_bucket:
+                self.request_bucket.take(requests)
+            if self.token_bucket:
+                self.token_bucket.take(tokens)
+            self.running += 1
+            future.set_result(None)
+
+
+class GenerationService:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.completed = queue.SimpleQueue()
+        self.polling = False
+        self.limiters = {}
+        # requests waiting for their limiter, and being sent
+        self.waiting = 0
+        self.running = 0
+        # called as listener(waiting, running) on the Tk thread when those change
+        self.queue_listeners = []
+        self.reported_depth = (0, 0)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='generation', daemon=True)
+        self.thread.start()
+
+    # runs a coroutine on the service's loop. Returns a concurrent.futures.Future
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit(self, prompt, settings, config, callback=None, priority=INTERACTIVE, **kwargs):
+        future = self.run(self.scheduled(prompt, settings, config, priority, **kwargs))
+        if callback:
+            future.add_done_callback(lambda done: self.completed.put((callback, done)))
+        return future
+
+    def limiter(self, model_info, kwargs):
+        if model_info['type'] == 'ai21':
+            api_key = kwargs.get('AI21_API_KEY') or os.environ.get('AI21_API_KEY')
+        else:
+            api_key, _ = get_correct_key(model_info['type'], kwargs)
+        key = (model_info['type'], model_info.get('api_base'), api_key)
+        if key not in self.limiters:
+            self.limiters[key] = ProviderLimiter(self.loop)
+        self.limiters[key].configure(model_info)
+        return self.limiters[key]
+
+    async def scheduled(self, prompt, settings, config, priority, bypass_cache=False, **kwargs):
+        key = None if bypass_cache else cache_key(prompt, settings, config)
+        if key:
+            cached = request_cache().get(key)
+            if cached is not None:
+                # a new response, so it doesn't replace the stored one it was cached from (see
+                # TreeModel.post_generation). The cache returns a new copy on every get
+                cached['id'] = str(uuid.uuid1())
+                cached['timestamp'] = timestamp()
+                return cached, None
+        model_info = config['models'][settings['model']]
+        limiter = self.limiter(model_info, kwargs)
+        # single completion servers get a request per continuation, see gpt.openAI_fan_out
+        requests = settings['num_continuations'] if model_info['type'] in SINGLE_COMPLETION_TYPES else 1
+        tokens = len(prompt) // CHARS_PER_TOKEN + settings['response_length'] * settings['num_continuations']
+        self.waiting += 1
+        try:
+            await limiter.acquire(priority, requests, tokens)
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            response, error = await gen(prompt, settings, config, **kwargs)
+        finally:
+            self.running -= 1
+            limiter.release()
+        # responses with failed completions are requested again next time
+        if key and not error and response and not any('error' in c for c in response['completions']):
+            request_cache().put(key, response)
+        return response, error
+
+    # calls the callbacks of finished requests and the queue listeners. Only call from the Tk thread
+    def poll(self):
+        depth = (self.waiting, self.running)
+        if depth != self.reported_depth:
+            self.reported_depth = depth
+            for listener in self.queue_listeners:
+                listener(*depth)
+        while True:
+            try:
+                callback, future = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            if future.cancelled():
+                response, error = None, 'Cancelled'
+            elif future.exception():
+                response, error = None, future.exception()
+            else:
+                response, error = future.result()
+            try:
+                callback(response, error)
+            except Exception:
+                traceback.print_exc()
+
+    # polls with widget.after until the app exits. Later calls do nothing, so every tab can call it
+    def poll_with(self, widget):
+        if self.polling:
+            return
+        self.polling = True
+
+        def poll_again():
+            self.poll()
+            widget.after(POLL_INTERVAL, poll_again)
+
+        widget.after(POLL_INTERVAL, poll_again)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def generation_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = GenerationService()
+        return _service
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import time
 import traceback
@@ -6,7 +7,8 @@ from pprint import pprint
 from celery import Celery
 import openai
 from util.util import retry, timestamp
-from util.gpt_util import parse_logit_bias, parse_stop, get_correct_key
+from util.gpt_util import parse_logit_bias, parse_stop, get_correct_key, openai_client, DEFAULT_TIMEOUT, CONNECT_TIMEOUT
+from util.request_cache import request_key
 import requests
 import codecs
 import json
@@ -47,10 +49,18 @@ import json
 
 #ai21_api_key = os.environ.get("AI21_API_KEY", None)
 
-client = openai.Client(api_key=os.environ.get("OPENAI_API_KEY", 'placeholder'))
 
+def default_client():
+    return openai_client(api_key=os.environ.get("OPENAI_API_KEY", None))
 
-def gen(prompt, settings, config, **kwargs):
+
+# Model types whose servers return one completion per request. Their completions are requested concurrently,
+# at most 'parallel' (from the model's config) at a time
+SINGLE_COMPLETION_TYPES = ('llama-cpp',)
+DEFAULT_PARALLEL_REQUESTS = 4
+
+
+async def gen(prompt, settings, config, **kwargs):
     if settings["stop"]:
         stop = parse_stop(settings["stop"])
     else:
@@ -62,11 +72,10 @@ def gen(prompt, settings, config, **kwargs):
     #if config['OPENAI_API_KEY']:
     model_info = config['models'][settings['model']]
     # print('model info:', model_info)
-    client.base_url = model_info['api_base'] if model_info['api_base'] else "https://api.openai.com/v1"
-
     ai21_api_key = kwargs.get('AI21_API_KEY', None)
     ai21_api_key = ai21_api_key if ai21_api_key else os.environ.get("AI21_API_KEY", None)
-    client.api_key, client.organization = get_correct_key(model_info['type'], kwargs)
+    api_key, organization = get_correct_key(model_info['type'], kwargs)
+    client = openai_client(model_info['api_base'], api_key, organization, model_info.get('timeout', DEFAULT_TIMEOUT))
 
     # print('openai api base: ' + openai.api_base)
 
@@ -76,7 +85,7 @@ def gen(prompt, settings, config, **kwargs):
         #TODO
         # ai21_api_key = config['AI21_API_KEY']
     try:
-        response, error = generate(prompt=prompt,
+        response, error = await generate(prompt=prompt,
                                 length=settings['response_length'],
                                 num_continuations=settings['num_continuations'],
                                 temperature=settings['temperature'],
@@ -87,6 +96,8 @@ def gen(prompt, settings, config, **kwargs):
                                 logit_bias=logit_bias,
                                 config=config,
                                 ai21_api_key=ai21_api_key,
+                                client=client,
+                                timeout=model_info.get('timeout', DEFAULT_TIMEOUT),
                                 )
         return response, error
     except Exception as e:
@@ -94,11 +105,26 @@ def gen(prompt, settings, config, **kwargs):
         return None, e
 
 
-def generate(config, **kwargs):
+# Key of a generation in the request cache (see util/request_cache.py), or None if its response isn't
+# deterministic. Sampling parameters which can't change the response are left out of the key
+def cache_key(prompt, settings, config):
+    if settings['temperature'] != 0 and settings['response_length'] != 0:
+        return None
+    model_info = config['models'][settings['model']]
+    params = {'type': model_info['type'],
+              'length': settings['response_length'],
+              'num_continuations': settings['num_continuations'],
+              'logprobs': settings['logprobs'],
+              'stop': parse_stop(settings['stop']) if settings['stop'] else None,
+              'logit_bias': parse_logit_bias(settings['logit_bias']) if settings['logit_bias'] else None}
+    return request_key(settings['model'], model_info.get('api_base'), prompt, params)
+
+
+async def generate(config, **kwargs):
     #pprint(kwargs)
     model_type = config['models'][kwargs['model']]['type']
     if model_type == 'ai21':
-        response, error = ai21_generate(api_key=kwargs['ai21_api_key'], **kwargs)#config['AI21_API_KEY'], **kwargs)
+        response, error = await ai21_generate(api_key=kwargs['ai21_api_key'], **kwargs)#config['AI21_API_KEY'], **kwargs)
         #save_response_json(response.json(), 'examples/AI21_response.json')
         if not error:
             formatted_response = format_ai21_response(response.json(), model=kwargs['model'])
@@ -114,19 +140,14 @@ def generate(config, **kwargs):
         assert kwargs['logprobs'] > 0 or model_type not in ('together',), \
             "Logprobs must be greater than 0 for model type Together AI"
         # llama-cpp-python doesn't support batched inference yet: https://github.com/abetlen/llama-cpp-python/issues/771
-        needs_multiple_calls = model_type in ('llama-cpp',)
-        if needs_multiple_calls:
-            required_calls = kwargs['num_continuations']
-            kwargs['num_continuations'] = 1
-            responses = []
-            for _ in range(required_calls):
-                response, error = openAI_generate(model_type, **kwargs)
-                responses.append(response)
-            response = responses[-1]
-            response['choices'] = [r['choices'][0] for r in responses]
+        if model_type in SINGLE_COMPLETION_TYPES and kwargs['num_continuations'] > 1:
+            parallel = config['models'][kwargs['model']].get('parallel', DEFAULT_PARALLEL_REQUESTS)
+            response, error = await openAI_fan_out(model_type, parallel, **kwargs)
+            if error:
+                return None, error
         else:
             # TODO OpenAI errors
-            response, error = openAI_generate(model_type, **kwargs)
+            response, error = await openAI_generate(model_type, **kwargs)
         #save_response_json(response, 'examples/openAI_response.json')
         formatted_response = format_openAI_response(response, kwargs['prompt'], echo=echo, is_chat=is_chat)
         #save_response_json(formatted_response, 'examples/openAI_formatted_response.json')
@@ -187,11 +208,8 @@ def format_openAI_token_dict(completion, token, i, offset):
                   'position': calculated_offset}
     if completion['logprobs'].get('top_logprobs', None) is not None and \
         completion['logprobs']['top_logprobs']:
-        openai_counterfactuals = completion['logprobs']['top_logprobs'][i]
-        if openai_counterfactuals:
-            sorted_counterfactuals = {k: v for k, v in
-                                    sorted(openai_counterfactuals.items(), key=lambda item: item[1], reverse=True)}
-            token_dict['counterfactuals'] = sorted_counterfactuals
+        # counterfactuals are sorted when the token data is stored, see util/token_array.py
+        token_dict['counterfactuals'] = completion['logprobs']['top_logprobs'][i] or None
     else:
         token_dict['counterfactuals'] = None
     return token_dict, calculated_offset
@@ -206,6 +224,9 @@ def format_openAI_chat_token_dict(content_token, i):
     return token_dict
 
 def format_openAI_completion(completion, prompt_offset, prompt_end_index, is_chat):
+    # a failed request of a fan out, see openAI_fan_out
+    if 'error' in completion:
+        return {'text': '', 'finishReason': 'error', 'error': completion['error'], 'tokens': []}
     if 'text' in completion:
         completion_text = completion['text']
     else:
@@ -223,6 +244,9 @@ def format_openAI_completion(completion, prompt_offset, prompt_end_index, is_cha
             j = i + prompt_end_index
             token_dict, offset = format_openAI_token_dict(completion, token, j, offset)
             completion_dict['tokens'].append(token_dict)
+    if 'response_id' in completion:
+        completion_dict['id'] = completion['response_id']
+        completion_dict['usage'] = completion['usage']
     return completion_dict
 
 
@@ -240,7 +264,7 @@ def format_openAI_prompt(completion, prompt, prompt_end_index):
 def format_openAI_response(response, prompt, echo, is_chat):
     if echo:
         prompt_end_index = response['usage']['prompt_tokens']
-        prompt_dict = format_openAI_prompt(response['choices'][0],
+        prompt_dict = format_openAI_prompt(next(choice for choice in response['choices'] if 'error' not in choice),
                                                              prompt,
                                                              prompt_end_index)
     else:
@@ -260,8 +284,9 @@ def format_openAI_response(response, prompt, echo, is_chat):
 
 
 @retry(n_tries=3, delay=1, backoff=2, on_failure=lambda *args, **kwargs: ("", None))
-def openAI_generate(model_type, prompt, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1, stop=None,
-                    model='davinci', logit_bias=None, **kwargs):
+async def openAI_generate(model_type, prompt, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1, stop=None,
+                    model='davinci', logit_bias=None, client=None, **kwargs):
+    client = client if client else default_client()
     if not logit_bias:
         logit_bias = {}
     params = {
@@ -279,21 +304,55 @@ def openAI_generate(model_type, prompt, length=150, num_continuations=1, logprob
         params['messages'] = [{ 'role': "assistant", 'content': prompt }]
         params['logprobs'] = True
         params['top_logprobs'] = logprobs
-        response = client.chat.completions.create(
+        response = (await client.chat.completions.create(
             **params
-        ).to_dict()
+        )).to_dict()
     else:
         params['prompt'] = prompt
         params['echo'] = True
-        response = client.completions.create(
+        response = (await client.completions.create(
             **params
-        ).to_dict()
+        )).to_dict()
 
     return response, None
 
 
+# Requests num_continuations single completions concurrently and merges them into one response. Choices keep
+# the id and usage of their own response, and choices whose request failed only have an error
+async def openAI_fan_out(model_type, parallel, num_continuations=1, **kwargs):
+    semaphore = asyncio.Semaphore(max(1, parallel))
+
+    async def single():
+        async with semaphore:
+            return await openAI_generate(model_type, num_continuations=1, **kwargs)
+
+    outcomes = await asyncio.gather(*(single() for _ in range(num_continuations)), return_exceptions=True)
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            response, error = None, outcome
+        else:
+            response, error = outcome if outcome else (None, None)
+        # openAI_generate returns an empty response when it gives up retrying
+        if not response and not error:
+            error = 'Request failed'
+        results.append((response, error))
+    succeeded = [response for response, error in results if not error]
+    if not succeeded:
+        return None, results[0][1]
+    merged = dict(succeeded[0])
+    merged['choices'] = []
+    for i, (response, error) in enumerate(results):
+        if error:
+            merged['choices'].append({'index': i, 'error': str(error)})
+        else:
+            merged['choices'].append({**response['choices'][0], 'index': i, 'response_id': response['id'],
+                                      'usage': response.get('usage')})
+    return merged, None
+
+
 def search(query, documents, engine="curie"):
-    return client.Engine(engine).search(
+    return default_client().Engine(engine).search(
         documents=documents,
         query=query
     )
@@ -340,7 +399,11 @@ def format_ai21_response(response, model):
     return response_dict
 
 
-def ai21_generate(prompt, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1, stop=None,
+# keeps connections to AI21 alive between requests
+ai21_session = requests.Session()
+
+
+async def ai21_generate(prompt, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1, stop=None,
                   engine='j1-large', api_key=None, **kwargs):
     stop = stop if stop else []
     request_json = {
@@ -353,13 +416,18 @@ def ai21_generate(prompt, length=150, num_continuations=1, logprobs=10, temperat
         "topP": top_p,
     }
     try:
-        response = requests.post(
+        # requests blocks, so the post waits on a worker thread of the event loop
+        response = await asyncio.to_thread(
+            ai21_session.post,
             f"https://api.ai21.com/studio/v1/{engine}/complete",
             headers={"Authorization": f"Bearer {api_key}"},
             json=request_json,
+            timeout=(CONNECT_TIMEOUT, kwargs.get('timeout', DEFAULT_TIMEOUT)),
         )
     except requests.exceptions.ConnectionError:
         return None, 'Connection error'
+    except requests.exceptions.Timeout:
+        return None, 'Timed out'
     error = None
     if response.status_code != 200:
         error = f'Bad status code {response.status_code}'
@@ -13,6 +13,7 @@ from ttkthemes import ThemedStyle
 
 from controller import Controller
 from model import TreeModel, EMPTY_TREE
+from generation_service import generation_service
 from util.custom_tks import ClosableNotebook
 from util.util import json_open, json_create
 from util.util_tk import create_menubar
@@ -32,6 +33,7 @@ class Application:
         print(4.0 if self.args.high_resolution else self.args.scaling_factor)
         self.root.call('tk', 'scaling', 2.0 if self.args.high_resolution else self.args.scaling_factor)
         self.root.title("Read tree")
+        generation_service().queue_listeners.append(self.show_generation_queue)
 
         # Use a font that scales with the scaling factor
         fontSize = 12  # base font size before scaling
@@ -60,6 +62,8 @@ class Application:
         # Bind Button-1 to tab click so tabs can be closed
         self.notebook.bind('<Button-1>', self.tab_click)
         self.notebook.bind()
+        # closing the window waits for pending saves like Quit
+        self.root.protocol("WM_DELETE_WINDOW", self.quit_app)
 
         # Do final root prep
         self.root.update_idletasks()
@@ -109,6 +113,13 @@ class Application:
         json_create(self.app_data_file, self.app_data)
 
 
+    def show_generation_queue(self, waiting, running):
+        if waiting or running:
+            self.root.title(f"Read tree - generating {running}, {waiting} queued")
+        else:
+            self.root.title("Read tree")
+
+
     # Create a tab
     def create_tab(self, filename=None, event=None):
         # if len(self.tabs) > 0:
@@ -130,6 +141,7 @@ class Application:
 
     def close_tab(self, event=None, index=None):
         index = self.notebook.index("current") if index is None else index
+        self.tabs[index].state.flush_saves()
         self.notebook.forget(index)
         self.tabs.pop(index)
         if len(self.tabs) == 0:
@@ -147,6 +159,10 @@ class Application:
     def set_tab_names(self):
         for i, t in enumerate(self.tabs):
             name = t.state.name()
+            if t.state.save_status == 'saving':
+                name += ' *'
+            elif t.state.save_status == 'failed':
+                name += ' (save failed)'
             self.notebook.tab(i, text=name)
 
     # Build the applications menubar
@@ -163,6 +179,9 @@ class Application:
                 ('Import subtree', 'Ctrl+Shift+O', None, lambda event=None: self.forward_command(Controller.import_tree)),
                 ('Save', 'S', None, lambda event=None: self.forward_command(Controller.save_tree)),
                 ('Save As...', 'Ctrl+S', '<Control-s>', lambda event=None: self.forward_command(Controller.save_tree_as)),
+                ('Restore backup...', None, None, lambda event=None: self.forward_command(Controller.restore_backup)),
+                ('Compact tree...', None, None, lambda event=None: self.forward_command(Controller.compact_tree)),
+                ('Compare with file...', None, None, lambda event=None: self.forward_command(Controller.compare_tree)),
                 ('New tree from node...', None, None,
                  lambda event=None: self.forward_command(Controller.new_from_node)),
                 ('Export text', 'Ctrl+Shift+X', '<Control-Shift-KeyPress-X>',
@@ -189,6 +208,8 @@ class Application:
 
 
     def quit_app(self, event=None):
+        for tab in self.tabs:
+            tab.state.flush_saves()
         self.root.destroy()
 
 
@@ -1,6 +1,6 @@
 import functools
+import hashlib
 import os
-import threading
 import time
 import math
 import uuid
@@ -8,23 +8,36 @@ from asyncio import Queue
 from pprint import pprint
 import bisect
 import numpy as np
-from collections import defaultdict, ChainMap
+from collections import defaultdict, ChainMap, OrderedDict
+from itertools import accumulate, chain
 from multiprocessing.pool import ThreadPool
 import codecs
 import json
-from util.frames_util import frame_merger, frame_merger_append, frame_merger_override
+import pickle
+from util.frames_util import frame_merger, frame_merger_append, frame_merger_override, freeze
 from copy import deepcopy
 import jsonlines
 
-from gpt import openAI_generate, search, gen
+from gpt import openAI_generate, search
+from generation_service import generation_service, INTERACTIVE
 from util.util import json_create, timestamp, json_open, clip_num, index_clip, diff
 from util.util_tree import fix_miro_tree, flatten_tree, node_ancestry, in_ancestry, get_inherited_attribute, \
     subtree_list, generate_conditional_tree, filtered_children, \
     new_node, add_immutable_root, make_simple_tree, fix_tree, ancestry_in_range, ancestry_plaintext, ancestor_text_indices, \
-    node_index, ancestor_text_list, tree_subset
-from util.gpt_util import conditional_logprob, tokenize_ada, prompt_probs, logprobs_to_probs, parse_logit_bias, parse_stop
+    node_index, ancestor_text_list, tree_subset, preorder, all_nodes, remap_tree_ids
+from util.gpt_util import conditional_logprob, tokenize_ada, prompt_probs, logprobs_to_probs, parse_logit_bias, parse_stop, \
+    get_correct_key
+from util.token_array import TokenArray, token_array
+from util.revisions import add_revision, revision_text
+from util.compaction import compact_tree_data
+from util.tree_hash import subtree_hashes, diff_trees
 from util.multiverse_util import greedy_word_multiverse
 from util.node_conditions import conditions, condition_lambda
+from util.journal import journal_filename, read_journal, append_journal, remove_journal, replay_journal
+from util.backup_store import BackupStore
+from util.tree_file import tree_open, tree_create, is_jsonl, read_jsonl_trees
+from util.tree_db import TreeDatabase, is_database
+from util.response_store import ResponseStore, response_filename
 
 # Calls any callbacks associated with the wrapped function
 # class must have a defaultdict(list)[func_name] = [*callbacks]
@@ -40,6 +53,15 @@ def event(func):
     return wrapper
 
 
+# Frozen copy of data for the save thread, see TreeModel.snapshot_data
+class Snapshot:
+    def __init__(self, data):
+        self.pickled = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        return pickle.loads(self.pickled)
+
+
 DEFAULT_PREFERENCES = {
 
     # Nav tree
@@ -63,9 +85,13 @@ DEFAULT_PREFERENCES = {
     'autosave': False,
     #'save_counterfactuals': False,
     'model_response': 'backup', #'discard', #'save'
+    # [age, interval] in seconds: keep every backup from the last hour, one per hour for a day, one per day after
+    'backup_retention': [[3600, 0], [86400, 3600], [None, 86400]],
 
     # generation data
     'prob': True,
+    # keep the logprobs of prompt tokens in stored responses
+    'save_prompt_logprobs': False,
     # darkmode
 }
 
@@ -269,6 +295,26 @@ DEFAULT_TAGS = {
     }
  }
 
+# max number of nodes whose ancestry is cached
+ANCESTRY_CACHE_SIZE = 512
+# when the tree is renumbered, its interval is this many bits wider than it needs, see place_intervals
+INTERVAL_SLACK_BITS = 64
+
+# autosave writes a full snapshot instead of appending once the journal is bigger than this (bytes)
+JOURNAL_SNAPSHOT_SIZE = 4 * 1024 * 1024
+# changes to more nodes than this at once are saved with a snapshot instead of journaled, see nodes_changed
+JOURNAL_UPDATE_LIMIT = 100
+
+# database trees with more nodes than this are loaded lazily, see Lazy loading
+LAZY_LOAD_SIZE = 100000
+# id suffix of the nav tree placeholders for unloaded children
+UNLOADED_SUFFIX = '-unloaded'
+
+# autosave waits for this many ms without further changes before writing
+AUTOSAVE_DELAY = 1000
+# ms between checks for a finished save
+SAVE_POLL_INTERVAL = 100
+
 EMPTY_TREE = {
     "root": {
         "mutable": False,
@@ -289,7 +335,8 @@ class TreeModel:
     def __init__(self, root):
         self.app = root
         self.app.bind("<<TreeUpdated>>", lambda _: self.tree_updated())
-        self.app.bind("<<NewNodes>>", lambda _: self.edit_new_nodes())
+        # finished generations are handed to the Tk thread by polling, see generation_service.py
+        generation_service().poll_with(self.app)
 
         # All variables initialized below
         self.tree_filename = None
@@ -297,6 +344,32 @@ class TreeModel:
         self.tree_raw_data = None
         # CALCULATED {node_id: node}
         self.tree_node_dict = None
+        # CALCULATED preorder list of nodes, rebuilt lazily after structural edits
+        self._preorder = None
+        # CALCULATED {node_id: preorder position}
+        self._positions = None
+        # CALCULATED {tag: sorted preorder positions of nodes with the tag attribute}
+        self._tag_positions = {}
+        # CALCULATED {node_id: {nodes, index, starts, ends}}, see cached_ancestry
+        self._ancestry_cache = OrderedDict()
+        # CALCULATED {tag: {scope, covered}}, see tag_closure
+        self._tag_closure = {}
+        # CALCULATED {node_id: visible}
+        self._visibility = {}
+        self._visibility_key = None
+        # CALCULATED {node_id: [lo, hi, free]}, see Intervals
+        self._intervals = {}
+        self._dirty_intervals = set()
+        # CALCULATED {node_id: hash of text, tags and children}, see Subtree hashes
+        self._subtree_hashes = {}
+        # CALCULATED ((selected_node_id, frame version), ancestry entry, merged state), see resolved_state
+        self._state_cache = None
+        self._frame_version = 0
+        # {node_id: number of children} of nodes whose children haven't been loaded, see Lazy loading
+        self._unloaded = {}
+        self._unloaded_descendents = {}
+        # database the unloaded nodes are read from
+        self._lazy_database = None
         # {chapter_id: chapter}
         self.chapters = None
         #self.memories = None
@@ -311,6 +384,26 @@ class TreeModel:
         self.callbacks = defaultdict(list)
         self.conditions = defaultdict(list)
         self.new_nodes = []
+
+        # node operations since the last autosave, see Journal
+        self._journal = []
+        self._journal_touched = {}
+        self._journal_selection = None
+        self._snapshot_needed = False
+
+        # trees are written by a background thread, see Saving
+        self._saver = None
+        self._save_result = None
+        self._save_poll_job = None
+        self._autosave_job = None
+        # {backup directory: BackupStore}
+        self._backup_stores = {}
+        # open database of a .db tree, see tree_database
+        self._database = None
+        # None, 'saving', 'saved' or 'failed'
+        self.save_status = None
+        self._save_status_changed = False
+
         self.OPENAI_API_KEY = None
         self.AI21_API_KEY = None
         self.GOOSEAI_API_KEY = None
@@ -331,35 +424,35 @@ class TreeModel:
 
     @property
     def model_config(self):
-        return self.state["model_config"]
+        return self.resolved_state()['model_config']
 
     @property
     def generation_settings(self):
-        return self.state['generation_settings']
+        return self.resolved_state()['generation_settings']
 
     @property
     def inline_generation_settings(self):
-        return self.state['inline_generation_settings']
+        return self.resolved_state()['inline_generation_settings']
 
     @property
     def preferences(self):
-        return self.state['preferences']
+        return self.resolved_state()['preferences']
 
     @property
     def module_settings(self):
-        return self.state['module_settings']
+        return self.resolved_state()['module_settings']
 
     @property
     def workspace(self):
-        return self.state['workspace']
+        return self.resolved_state()['workspace']
 
     @property
     def memories(self):
-        return self.state['memories']
+        return self.resolved_state()['memories']
 
     @property
     def vars(self):
-        return self.state['vars']
+        return self.resolved_state()['vars']
     
     # user frame
 
@@ -399,8 +492,29 @@ class TreeModel:
             if self.tree_raw_data and "frame" in self.tree_raw_data \
             else {}
 
+    # The merged state is read-only (see util/frames_util.py), changes to it go through frames, e.g.
+    # update_user_frame. deepcopy it for an editable copy
     @property
     def state(self):
+        return self.resolved_state()
+
+    # The state merged from the defaults, the frames in the selected node's ancestry and the user frame
+    # is cached per selected node and frame version. Anything that changes frames bumps the version
+    # through frames_changed. Structural edits on the selected node's path replace its ancestry cache
+    # entry, which also invalidates the state
+    def resolved_state(self):
+        selected_node = self.selected_node
+        ancestry = self.cached_ancestry(selected_node) if selected_node else None
+        key = (selected_node['id'] if selected_node else None, self._frame_version)
+        if self._state_cache is None or self._state_cache[0] != key or self._state_cache[1] is not ancestry:
+            self._state_cache = (key, ancestry, freeze(self.merge_state()))
+        return self._state_cache[2]
+
+    def frames_changed(self):
+        self._frame_version += 1
+        self._snapshot_needed = True
+
+    def merge_state(self):
         state = {}
         state["memories"] = {}
         state["vars"] = deepcopy(DEFAULT_VARS)
@@ -412,7 +526,7 @@ class TreeModel:
         state["model_config"] = deepcopy(DEFAULT_MODEL_CONFIG)
         frames = self.accumulate_frames(self.selected_node) if self.selected_node else {}
         frame_merger.merge(state, frames)
-        frame_merger.merge(state, self.user_frame)
+        frame_merger.merge(state, deepcopy(self.user_frame))
         return state
 
 
@@ -441,6 +555,7 @@ class TreeModel:
 
     def set_frame(self, frame_parent, frame):
         frame_parent['frame'] = deepcopy(frame)
+        self.frames_changed()
 
     # def overwrite_frame(self, frame, new_frame):
     #     frame = deepcopy(new_frame)
@@ -472,6 +587,7 @@ class TreeModel:
             self.update(node['frame'], update, append)
         else:
             node['frame'] = deepcopy(update)
+        self.frames_changed()
         self.tree_updated(write=False)
 
     def get_frame(self, node):
@@ -479,12 +595,14 @@ class TreeModel:
 
     def set_user_frame(self, state):
         self.tree_raw_data['frame'] = deepcopy(state)
+        self.frames_changed()
 
     def update_user_frame(self, update, append=False):
         if 'frame' in self.tree_raw_data:
             self.update(self.tree_raw_data['frame'], update, append)
         else:
             self.tree_raw_data['frame'] = deepcopy(update)
+        self.frames_changed()
         self.tree_updated(write=False)
 
     # TODO merge with frame
@@ -492,11 +610,13 @@ class TreeModel:
         if 'frame' not in self.tree_raw_data:
             self.tree_raw_data['frame'] = {}
         self.set_path(self.tree_raw_data['frame'], value, path)
+        self.frames_changed()
         
     def set_frame_partial(self, node, value, path):
         if 'frame' not in node:
             node['frame'] = {}
         self.set_path(node['frame'], value, path)
+        self.frames_changed()
 
     def clear_user_frame(self):
         self.set_user_frame({})
@@ -515,10 +635,16 @@ class TreeModel:
         self.callbacks[func.__name__].append(callback)
 
     # Decorator calls callbacks
+    # tree_node_dict is maintained incrementally by the structural edits below, so the full
+    # rebuild only happens when a caller explicitly asks for it with rebuild=True
     @event
-    def tree_updated(self, rebuild_dict=True, **kwargs):
-        if self.tree_raw_data and rebuild_dict:
+    def tree_updated(self, rebuild=False, **kwargs):
+        if self.tree_raw_data and rebuild:
             self.rebuild_tree()
+        elif self.tree_node_dict:
+            for node_id in kwargs.get('edit', []):
+                if node_id in self.tree_node_dict:
+                    self.text_changed(self.tree_node_dict[node_id])
 
     # def tree_updated_silent(self):
     #     self.rebuild_tree()
@@ -527,18 +653,289 @@ class TreeModel:
     def rebuild_tree(self):
         add_immutable_root(self.tree_raw_data)
         self.tree_node_dict = {d["id"]: d for d in flatten_tree(self.tree_raw_data["root"])}
-        fix_miro_tree(self.nodes)
+        self.structure_changed()
+
+    #################################
+    #   Index
+    #################################
+
+    # Adds root and its descendents to tree_node_dict and fixes their parent_id links
+    def index_subtree(self, root, parent=None, journaled=False):
+        if parent is not None:
+            root['parent_id'] = parent['id']
+        for node in preorder(root):
+            if 'id' not in node:
+                node['id'] = str(uuid.uuid1())
+            for child in node['children']:
+                child['parent_id'] = node['id']
+            self.tree_node_dict[node['id']] = node
+            self._subtree_hashes.pop(node['id'], None)
+        self._dirty_intervals.add(root['id'])
+        self.structure_changed(root, journaled=journaled)
+
+    # Removes root and its descendents from tree_node_dict
+    def unindex_subtree(self, root, journaled=False):
+        for node in preorder(root):
+            self.tree_node_dict.pop(node['id'], None)
+            self._unloaded.pop(node['id'], None)
+            self._subtree_hashes.pop(node['id'], None)
+        self.structure_changed(root, journaled=journaled)
+
+    def index_node(self, node, retag=True, journaled=False):
+        self.tree_node_dict[node['id']] = node
+        self._dirty_intervals.add(node['id'])
+        self.structure_changed(node, retag=retag, journaled=journaled)
+
+    def unindex_node(self, node, journaled=False):
+        self.tree_node_dict.pop(node['id'], None)
+        self._unloaded.pop(node['id'], None)
+        self.structure_changed(node, journaled=journaled)
+
+    #################################
+    #   Lazy loading
+    #################################
+    """
+    Big database trees (see util/tree_db.py) are opened with only the children of the root and of open nodes
+    loaded. Other nodes are loaded with their children when they are opened, selected, or needed by a search,
+    by tagged_nodes, or by an edit that changes their children. Nodes whose children haven't been loaded yet
+    have an empty children list and are in _unloaded with their number of children.
+    """
+
+    def unloaded_children(self, node):
+        return self._unloaded.get(node['id'], 0)
+
+    def unloaded_descendents(self, node):
+        if node['id'] not in self._unloaded:
+            return 0
+        if node['id'] not in self._unloaded_descendents:
+            self._unloaded_descendents[node['id']] = self._lazy_database.descendent_count(node['id'])
+        return self._unloaded_descendents[node['id']]
+
+    # loads the children of node (and their open descendents, or all descendents if not lazy). Returns the children
+    def load_children(self, node, lazy=True, refresh_nav=True):
+        if not node or node['id'] not in self._unloaded:
+            return []
+        children, node_dict, unloaded = self._lazy_database.read_children(node['id'], lazy=lazy)
+        del self._unloaded[node['id']]
+        self._unloaded_descendents.pop(node['id'], None)
+        self._unloaded.update(unloaded)
+        node['children'].extend(children)
+        for child in children:
+            # already saved
+            self.index_subtree(child, node, journaled=True)
+        if refresh_nav and children:
+            self.tree_updated(add=list(node_dict))
+        return children
+
+    # loads the ancestry of a node which hasn't been loaded and returns the node
+    def load_node(self, node_id, refresh_nav=True):
+        if node_id in self.tree_node_dict or not self._unloaded:
+            return self.node(node_id)
+        added = []
+        for ancestor_id in self._lazy_database.ancestor_ids(node_id)[:-1]:
+            ancestor = self.node(ancestor_id)
+            if ancestor is None:
+                break
+            for child in self.load_children(ancestor, refresh_nav=False):
+                added.extend(d['id'] for d in preorder(child))
+        if refresh_nav and added:
+            self.tree_updated(add=added)
+        return self.node(node_id)
+
+    def load_all(self, refresh_nav=True):
+        added = []
+        for node_id in list(self._unloaded):
+            for child in self.load_children(self.node(node_id), lazy=False, refresh_nav=False):
+                added.extend(d['id'] for d in preorder(child))
+        if refresh_nav and added:
+            self.tree_updated(add=added)
+
+    # loads every descendent of node
+    def load_subtree(self, node, refresh_nav=True):
+        added = []
+        if self._unloaded:
+            for n in [n for n in preorder(node) if n['id'] in self._unloaded]:
+                for child in self.load_children(n, lazy=False, refresh_nav=False):
+                    added.extend(d['id'] for d in preorder(child))
+        if refresh_nav and added:
+            self.tree_updated(add=added)
+
+    def load_tagged(self, tag):
+        if self._unloaded:
+            for node_id in self._lazy_database.tagged_ids(tag):
+                self.load_node(node_id)
+
+    # Called whenever the topology of the tree changes (nodes added, removed, moved or reordered)
+    # node is the root of the subtree which was affected, if None everything is invalidated
+    # retag=False if the caller updates the tag index itself
+    # journaled=True if the caller records the change in the journal itself
+    def structure_changed(self, node=None, retag=True, journaled=False):
+        if not journaled:
+            self._snapshot_needed = True
+        self._preorder = None
+        self._positions = None
+        self._tag_positions = {}
+        self.invalidate_ancestry(node)
+        if node is None:
+            self._intervals = {}
+            self._dirty_intervals = set()
+            self._subtree_hashes = {}
+        else:
+            self.hash_changed(node)
+        if retag:
+            self._tag_closure = {}
+        self._visibility = {}
+
+    # Called whenever the text of a node changes
+    def text_changed(self, node):
+        self.node_changed(node)
+        for entry in self._ancestry_cache.values():
+            if node['id'] in entry['index']:
+                entry['starts'] = entry['ends'] = None
+                entry['prompts'] = {}
+
+    # Called whenever a summary is created, edited or deleted
+    def summaries_changed(self):
+        self._snapshot_needed = True
+        for entry in self._ancestry_cache.values():
+            entry['prompts'] = {}
+
+
+    #################################
+    #   Subtree hashes
+    #################################
+    """
+    Every node's subtree hash combines its text, tags and the hashes of its children (see util/tree_hash.py).
+    Hashes are computed when they're asked for and cached. When a node changes, its hash and the hashes of its
+    ancestors are dropped. A cached node always has its descendents cached, so dropping stops at the first
+    ancestor which isn't cached
+    """
+
+    def subtree_hash(self, node):
+        return subtree_hashes(node, self._subtree_hashes, self.loaded_children)[node['id']]
+
+    def loaded_children(self, node):
+        self.load_children(node, lazy=False, refresh_nav=False)
+        return node['children']
+
+    def hash_changed(self, node):
+        self._subtree_hashes.pop(node['id'], None)
+        parent = self.tree_node_dict.get(node.get('parent_id'))
+        while parent is not None and self._subtree_hashes.pop(parent['id'], None) is not None:
+            parent = self.tree_node_dict.get(parent.get('parent_id'))
+
+    # Compares the tree to a tree file (by default the last save), see diff_trees
+    def diff_tree_file(self, filename=None):
+        filename = filename if filename else self.tree_filename
+        other = tree_open(filename)[0]['root']
+        root = self.root()
+        self.subtree_hash(root)
+        return diff_trees(other, root, subtree_hashes(other), self._subtree_hashes)
 
+    #################################
+    #   Intervals
+    #################################
+
+    # Every node in the tree is assigned an integer interval [lo, hi] containing the intervals of all
+    # its descendents (an Euler tour with gaps), so ancestor checks are two comparisons.
+    # Intervals leave free space after the last child so that new or moved subtrees can be placed
+    # without renumbering the rest of the tree. index_node, index_subtree and change_parent mark the
+    # placed subtree dirty, and dirty subtrees are numbered the next time the index is used.
+    # Removing nodes doesn't break the nesting of the remaining intervals. Children which are moved up
+    # to the parent of a removed node are marked dirty too, because the removed node may not have been
+    # placed under its parent yet
+
+    def intervals(self):
+        if not self._intervals and self.tree_raw_data:
+            self._dirty_intervals = set()
+            self.place_intervals(self.root())
+        elif self._dirty_intervals:
+            dirty = [self.node(node_id) for node_id in self._dirty_intervals]
+            self._dirty_intervals = set()
+            # place shallow subtrees first, deeper dirty nodes may already be inside them
+            dirty = sorted((node for node in dirty if node), key=self.node_depth)
+            placed = set()
+            for node in dirty:
+                if not placed.intersection(self.cached_ancestry(node)['index']):
+                    placed.add(self.place_intervals(node)['id'])
+        return self._intervals
+
+    # width of the interval needed to number node's subtree
+    def interval_width(self, node):
+        widths = {}
+        for descendant in reversed(list(preorder(node))):
+            children = descendant['children']
+            widths[descendant['id']] = 1 + (2 * len(children) + 2) * max((widths[child['id']] for child in children),
+                                                                         default=0)
+        return widths[node['id']]
+
+    # numbers node's subtree inside [lo, hi], children use the first half and the rest is free
+    def number_intervals(self, node, lo, hi):
+        stack = [(node, lo, hi)]
+        while stack:
+            descendant, lo, hi = stack.pop()
+            children = descendant['children']
+            width = (hi - lo) // (2 * len(children) + 2)
+            for i, child in enumerate(children):
+                stack.append((child, lo + 1 + i * width, lo + (i + 1) * width))
+            self._intervals[descendant['id']] = [lo, hi, lo + 1 + len(children) * width]
+
+    # gives node's subtree an interval in the free space of its parent, or renumbers the whole tree if
+    # there is no room. Returns the root of the subtree which was numbered
+    def place_intervals(self, node):
+        parent = self.parent(node)
+        parent_interval = self._intervals.get(parent['id']) if parent else None
+        if parent_interval:
+            lo, hi, free = parent_interval
+            width = self.interval_width(node)
+            # don't give away more than half the free space, so that later siblings fit as well
+            available = min((hi - free + 1) // 2, width << 32)
+            if available >= width:
+                self.number_intervals(node, free, free + available - 1)
+                parent_interval[2] = free + available
+                return node
+        # renumber the whole tree, leaving room for it to grow before this happens again
+        root = self.root()
+        self._intervals = {}
+        self.number_intervals(root, 0, self.interval_width(root) << INTERVAL_SLACK_BITS)
+        return root
+
+    # returns True if a is b or an ancestor of b
+    def is_ancestor(self, a, b):
+        intervals = self.intervals()
+        a_interval = intervals.get(a['id'])
+        b_interval = intervals.get(b['id'])
+        if not (a_interval and b_interval and self.node(a['id']) is a and self.node(b['id']) is b):
+            return in_ancestry(a, b, self.tree_node_dict)
+        return a_interval[0] <= b_interval[0] and b_interval[1] <= a_interval[1]
+
+    # returns the nearest common ancestor and its depth
+    def nearest_common_ancestor(self, node_a, node_b):
+        ancestry = self.cached_ancestry(node_a)['nodes']
+        # ancestors of node_a which are also ancestors of node_b form a prefix of its ancestry
+        lo, hi = 0, len(ancestry) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.is_ancestor(ancestry[mid], node_b):
+                lo = mid
+            else:
+                hi = mid - 1
+        return ancestry[lo], lo
+
+    def path_distance(self, node_a, node_b):
+        _, nca_depth = self.nearest_common_ancestor(node_a, node_b)
+        return self.node_depth(node_a) + self.node_depth(node_b) - 2 * nca_depth
 
     @event
-    def edit_new_nodes(self):
-        print('new nodes:', self.new_nodes)
+    # Makes the nodes of a finished generation editable. Generations can finish in any order, so the finished
+    # ones are named instead of taking the oldest
+    def edit_new_nodes(self, node_ids):
+        print('new nodes:', node_ids)
         self.tree_updated()
-        time.sleep(0.5)
-        for node_id in self.new_nodes[0]:
+        for node_id in node_ids:
             self.node(node_id)['mutable'] = True
-        self.tree_updated(edit=self.new_nodes[0])
-        del self.new_nodes[0]
+            self.node_changed(self.node(node_id))
+        self.tree_updated(edit=node_ids)
 
     @event
     def pre_selection_updated(self, **kwargs):
@@ -582,22 +979,41 @@ class TreeModel:
     def selected_chapter(self):
         return self.chapter(self.selected_node) if self.selected_node is not None else None
 
+    # nodes in tree order. tree_node_dict is patched incrementally and is not ordered,
+    # so the traversal order is cached separately and recomputed after structural edits
     @property
     def nodes(self):
-        return list(self.tree_node_dict.values()) if self.tree_node_dict else None
+        if not self.tree_node_dict:
+            return None
+        if self._preorder is None:
+            self._preorder = list(preorder(self.tree_raw_data["root"]))
+        return self._preorder
 
 
     @property
     def tree_traversal_idx(self):
-        return self.nodes.index(self.selected_node)
+        return self.position(self.selected_node)
+
+    # preorder position of node, cached until the next structural edit
+    def position(self, node):
+        if self._positions is None:
+            self._positions = {d['id']: i for i, d in enumerate(self.nodes)}
+        return self._positions[node['id']]
+
+    # sorted preorder positions of nodes which have tag as an attribute
+    def tagged_positions(self, tag):
+        if tag not in self._tag_positions:
+            self.load_tagged(tag)
+            self._tag_positions[tag] = [i for i, d in enumerate(self.nodes) if self.has_tag_attribute(d, tag)]
+        return self._tag_positions[tag]
 
 
     def nodes_list(self, filter=None):
         #tree = tree if tree else self.tree_node_dict
         if not filter:
-            return list(self.tree_node_dict.values())
+            return list(self.nodes)
         else:
-            return [n for n in list(self.tree_node_dict.values()) if filter(n)]
+            return [n for n in self.nodes if filter(n)]
 
     def nodes_dict(self, filter=None):
         nodes = self.nodes_list(filter)
@@ -605,7 +1021,9 @@ class TreeModel:
 
     def traversal_idx(self, node, filter=None):
         #tree = tree if tree else self.tree_node_dict
-        nodes = self.nodes_list(filter) if filter else self.nodes
+        if not filter:
+            return self.position(node)
+        nodes = self.nodes_list(filter)
         return nodes.index(node)
         # for i, node in enumerate(nodes):
         #     if node['id'] == node_id:
@@ -649,11 +1067,77 @@ class TreeModel:
     #   Ancestry
     #################################
 
+    # Ancestries are cached per node together with the cumulative text length of the ancestry,
+    # so that text offset lookups are bisects instead of walks up the tree.
+    # Entries are dropped when a node on the path is moved (structure_changed) and their offsets are
+    # dropped when the text of a node on the path changes (text_changed)
+    def cached_ancestry(self, node):
+        node_id = node['id']
+        entry = self._ancestry_cache.get(node_id)
+        if entry is not None:
+            self._ancestry_cache.move_to_end(node_id)
+            return entry
+        parent_entry = self._ancestry_cache.get(node.get('parent_id'))
+        if parent_entry is not None:
+            nodes = parent_entry['nodes'] + [node]
+            has_template = parent_entry['has_template'] or self.is_template(node)
+        else:
+            nodes = node_ancestry(node, self.tree_node_dict)
+            has_template = any(self.is_template(ancestor) for ancestor in nodes)
+        entry = {'nodes': nodes,
+                 'index': {ancestor['id']: i for i, ancestor in enumerate(nodes)},
+                 # templates are evaluated, so their length can change without the node being edited
+                 'has_template': has_template,
+                 'starts': None,
+                 'ends': None,
+                 # assembled prompts, keyed by template and the settings they were built with
+                 'prompts': {}}
+        if node_id in self.tree_node_dict:
+            self._ancestry_cache[node_id] = entry
+            if len(self._ancestry_cache) > ANCESTRY_CACHE_SIZE:
+                self._ancestry_cache.popitem(last=False)
+        return entry
+
+    def invalidate_ancestry(self, node=None):
+        if node is None:
+            self._ancestry_cache.clear()
+            return
+        stale = [node_id for node_id, entry in self._ancestry_cache.items() if node['id'] in entry['index']]
+        for node_id in stale:
+            del self._ancestry_cache[node_id]
+
+    def ancestry_offsets(self, node):
+        entry = self.cached_ancestry(node)
+        if entry['ends'] is None or entry['has_template']:
+            entry['ends'] = list(accumulate(len(self.text(ancestor)) for ancestor in entry['nodes']))
+            entry['starts'] = [0] + entry['ends'][:-1]
+        return entry
+
+    # returns the (cached) list of end text indices of each node in the node's ancestry. Do not modify
+    def ancestry_end_indices(self, node):
+        return self.ancestry_offsets(node)['ends']
+
+    def ancestry_start_indices(self, node):
+        return self.ancestry_offsets(node)['starts']
+
+    # position of ancestor in node's ancestry (the node itself is last)
+    def ancestor_position(self, node, ancestor):
+        return self.cached_ancestry(node)['index'][ancestor['id']]
+
+    def node_depth(self, node):
+        return len(self.cached_ancestry(node)['nodes']) - 1
+
+    # returns the index of the ancestor which contains text_index in the ancestry text, and the ancestor
+    def index_to_ancestor(self, node, text_index):
+        ancestor_index = bisect.bisect_left(self.ancestry_end_indices(node), text_index)
+        return ancestor_index, self.cached_ancestry(node)['nodes'][ancestor_index]
+
     def ancestry(self, node, root=None):
+        nodes = self.cached_ancestry(node)['nodes']
         if not root:
-            return node_ancestry(node, self.tree_node_dict)
+            return list(nodes)
         else: 
-            return ancestry_in_range(root=root, node=node, node_dict=self.tree_node_dict)
+            return nodes[self.ancestor_position(node, root):]
 
     def ancestry_text(self, node, root=None):
         ancestry = self.ancestry(node, root)
@@ -664,12 +1148,17 @@ class TreeModel:
         return ancestor_text_list(ancestry, text_callback=self.text)
 
     def ancestor_text_indices(self, node, root=None):
-        ancestry = self.ancestry(node, root)
-        return ancestor_text_indices(ancestry, text_callback=self.text)
+        offsets = self.ancestry_offsets(node)
+        if not root:
+            return list(zip(offsets['starts'], offsets['ends']))
+        position = self.ancestor_position(node, root)
+        root_start = offsets['starts'][position]
+        return [(start - root_start, end - root_start)
+                for start, end in zip(offsets['starts'][position:], offsets['ends'][position:])]
 
     def chain_uninterrupted(self, start, end):
         # returns true if chain of nodes has no other siblings
-        chain = ancestry_in_range(start, end, self.tree_node_dict)
+        chain = self.ancestry(end, root=start)
         for ancestor in chain[:-1]:
             if len(ancestor["children"]) > 1:
                 return False
@@ -693,21 +1182,24 @@ class TreeModel:
 
     # Update the selected node, the nav tree selection, and possibly the position in the tree traversal
     def select_node(self, node_id, fire_callbacks=True, reveal_node=False, **kwargs):
+        if self._unloaded:
+            self.load_node(node_id)
+            self.load_children(self.node(node_id))
         if self.selected_node_id != node_id and self.tree_node_dict and node_id in self.tree_node_dict:
             self.pre_selection_updated(**kwargs)
 
             self.selected_node_id = node_id
-            self.selected_node["visited"] = True
+            self.set_node_flag(self.selected_node, "visited", True)
             self.tree_raw_data["selected_node_id"] = self.selected_node_id
             if reveal_node:
                 self.reveal_nodes([self.selected_node])
 
             # Open all parents but not the node itself
-            ancestors = node_ancestry(self.selected_node, self.tree_node_dict)
+            ancestors = self.ancestry(self.selected_node)
             for ancestor in ancestors[:-1]:
-                ancestor["open"] = True
+                self.set_node_flag(ancestor, "open", True)
             # Always open the root
-            self.tree_raw_data["root"]["open"] = True
+            self.set_node_flag(self.tree_raw_data["root"], "open", True)
             if fire_callbacks:
                 self.selection_updated(**kwargs)
             return self.selected_node
@@ -720,33 +1212,53 @@ class TreeModel:
 
     # this only works if node is in filter
     def next_id(self, node, offset=1, filter=None):
-        nodes = self.nodes_list(filter)
-        traversal_idx = self.traversal_idx(node, filter)
-        new_idx = clip_num(traversal_idx + offset, 0, len(nodes) - 1)
-        return nodes[new_idx]["id"]
+        nodes = self.nodes
+        current_idx = self.position(node)
+        if not filter:
+            return nodes[clip_num(current_idx + offset, 0, len(nodes) - 1)]["id"]
+        # step through the preorder until offset nodes satisfying filter have been passed
+        positions = range(current_idx + 1, len(nodes)) if offset > 0 else range(current_idx - 1, -1, -1)
+        remaining = abs(offset)
+        for i in positions:
+            if remaining == 0:
+                break
+            if filter(nodes[i]):
+                node = nodes[i]
+                remaining -= 1
+        return node["id"]
+
+    # Next/prev search forward/backward in preorder from node's position and wrap around, so they only
+    # evaluate filters until the first match. If tag is given, only nodes with that tag attribute are
+    # considered, and those are looked up from the cached tag positions
 
     # return id of next node which satisfies filter condition
-    def find_next(self, node, filter=None, visible_filter=None):
-        nodes = self.nodes_list(visible_filter) if visible_filter else self.nodes
-        current_idx = self.traversal_idx(node, visible_filter)
-        true_indices = self.filter_indices(nodes, filter)
-        if len(true_indices) < 1:
-            return
-        try:
-            go_to_true = next(i for i, idx in enumerate(true_indices.keys()) if idx > current_idx)
-        except StopIteration:
-            go_to_true = 0
-        return list(true_indices.values())[go_to_true]["id"]
-
-    def find_prev(self, node, filter=None, visible_filter=None):
-        nodes = self.nodes_list(visible_filter) if visible_filter else self.nodes
-        current_idx = self.traversal_idx(node, visible_filter)
-        true_indices = self.filter_indices(nodes, filter)
-        if len(true_indices) < 1:
-            return
-        earlier_true = list(i for i, idx in enumerate(true_indices.keys()) if idx < current_idx)
-        go_to_true = earlier_true[-1] if len(earlier_true) > 0 else -1
-        return list(true_indices.values())[go_to_true]["id"]
+    def find_next(self, node, filter=None, visible_filter=None, tag=None):
+        nodes = self.nodes
+        current_idx = self.position(node)
+        if tag:
+            tagged = self.tagged_positions(tag)
+            start = bisect.bisect_right(tagged, current_idx)
+            positions = (tagged[i] for i in chain(range(start, len(tagged)), range(start)))
+        else:
+            positions = chain(range(current_idx + 1, len(nodes)), range(current_idx + 1))
+        return self.first_match(nodes, positions, filter, visible_filter)
+
+    def find_prev(self, node, filter=None, visible_filter=None, tag=None):
+        nodes = self.nodes
+        current_idx = self.position(node)
+        if tag:
+            tagged = self.tagged_positions(tag)
+            start = bisect.bisect_left(tagged, current_idx)
+            positions = (tagged[i] for i in chain(range(start - 1, -1, -1), range(len(tagged) - 1, start - 1, -1)))
+        else:
+            positions = chain(range(current_idx - 1, -1, -1), range(len(nodes) - 1, current_idx - 1, -1))
+        return self.first_match(nodes, positions, filter, visible_filter)
+
+    def first_match(self, nodes, positions, filter=None, visible_filter=None):
+        for i in positions:
+            if (not filter or filter(nodes[i])) and (not visible_filter or visible_filter(nodes[i])):
+                return nodes[i]["id"]
+        return None
 
     def parent(self, node):
         return self.node(node['parent_id']) if 'parent_id' in node else None
@@ -806,8 +1318,20 @@ class TreeModel:
     def is_root(self, node):
         return node == self.root()
 
+    # visibility is cached per node until tags, tag settings or the tree structure change
     def visible(self, node):
-        return self.visible_conditions()(node) or self.is_root(node) #or self.is_compound(node)
+        visibility_key = tuple((tag, attributes['scope'], attributes['hide'], attributes['show_only'])
+                               for tag, attributes in self.tags.items()
+                               if attributes['hide'] or attributes['show_only'])
+        if visibility_key != self._visibility_key:
+            self._visibility = {}
+            self._visibility_key = visibility_key
+        visible = self._visibility.get(node['id'])
+        if visible is None:
+            visible = self.visible_conditions()(node) or self.is_root(node) #or self.is_compound(node)
+            if self.tree_node_dict.get(node['id']) is node:
+                self._visibility[node['id']] = visible
+        return visible
 
     def id_visible(self, node_id):
         return self.visible(self.node(node_id))
@@ -825,6 +1349,7 @@ class TreeModel:
         name = info_dict['name']
         params = info_dict.get('params', {})
         params['tree_node_dict'] = self.tree_node_dict
+        params['is_ancestor'] = self.is_ancestor
         return lambda node: conditions[name](node=node, **params)
 
     def generate_filtered_tree(self, root=None):
@@ -858,16 +1383,21 @@ class TreeModel:
         node["meta"]["source"] = source
         # TODO replace with history
         node["meta"]["modified"] = False
+        self.node_changed(node)
 
     def create_child(self, parent, expand=True):
         if not parent:
             return
+        self.load_children(parent)
         new_child = new_node()
+        new_child["parent_id"] = parent["id"]
         parent["children"].append(new_child)
         if expand:
             new_child["open"] = True
 
-        self.rebuild_tree()
+        self.index_node(new_child, retag=False, journaled=True)
+        self.retag(new_child)
+        self.journal('create', new_child, parent_id=parent['id'])
         return new_child
 
         # if refresh_nav:
@@ -902,7 +1432,8 @@ class TreeModel:
         node["parent_id"] = new_parent["id"]
         new_parent["open"] = True
 
-        self.rebuild_tree()
+        self.index_node(new_parent)
+        self.invalidate_ancestry(node)
         return new_parent
 
     def merge_with_parent(self, node):
@@ -912,16 +1443,19 @@ class TreeModel:
         assert 'parent_id' in node, self.is_mutable(node)
         parent = self.parent(node)
         assert self.is_mutable(parent)
+        self.load_children(node)
 
         parent["text"] += node["text"]
+        self.text_changed(parent)
 
         index_in_parent = parent["children"].index(node)
         parent["children"][index_in_parent:index_in_parent + 1] = node["children"]
         for i, c in enumerate(node["children"]):
             # parent["children"].insert(index_in_parent+i, c)
             c["parent_id"] = parent["id"]
-        
-        self.rebuild_tree()
+        self._dirty_intervals.update(c['id'] for c in node['children'])
+
+        self.unindex_node(node)
 
         # if node == self.selected_node:
         #     self.select_node(parent["id"])
@@ -936,9 +1470,11 @@ class TreeModel:
         if not node:
             return
 
+        self.load_children(node)
         children = node["children"]
         for child in children:
             child["text"] = node["text"] + child["text"]
+            self.text_changed(child)
         self.delete_node(node, reassign_children=True)
 
     # TODO indicate that change parent has been toggled
@@ -955,15 +1491,19 @@ class TreeModel:
         elif new_parent_id == node["parent_id"]:
             return
         new_parent = self.node(new_parent_id)
-        if in_ancestry(node, new_parent, self.tree_node_dict):
+        if self.is_ancestor(node, new_parent):
             print('error: node is ancestor of new parent')
             return
-        old_siblings = self.parent(node)["children"]
-        old_siblings.remove(node)
+        self.load_children(new_parent)
+        old_parent = self.parent(node)
+        self.hash_changed(node)
+        old_parent["children"].remove(node)
         node["parent_id"] = new_parent_id
         new_parent["children"].append(node)
-        # TODO does this cause bugs
-        self.rebuild_tree()
+        self._dirty_intervals.add(node['id'])
+        self.structure_changed(node, retag=False, journaled=True)
+        self.retag(node, old_parent=old_parent)
+        self.journal('move', node, parent_id=new_parent_id)
 
     # adds node to ghostchildren of new ghostparent
     def add_parent(self, node=None, new_ghostparent=None):
@@ -979,7 +1519,8 @@ class TreeModel:
         old_index = siblings.index(node)
         new_index = (old_index + interval) % len(siblings)
         siblings[old_index], siblings[new_index] = siblings[new_index], siblings[old_index]
-        self.rebuild_tree()
+        self.structure_changed(node, retag=False, journaled=True)
+        self.journal('order', self.parent(node), children=[child['id'] for child in siblings])
         # if refresh_nav:
         #     self.tree_updated(add=[n['id'] for n in subtree_list(self.parent(node))])
         # else:
@@ -990,6 +1531,8 @@ class TreeModel:
         node = node if node else self.selected_node
         if "parent_id" not in node:
             return
+        if reassign_children:
+            self.load_children(node)
 
         parent = self.parent(node)
         siblings = parent["children"]
@@ -997,8 +1540,13 @@ class TreeModel:
         siblings.remove(node)
         if reassign_children:
             siblings.extend(node["children"])
-
-        self.rebuild_tree()
+            for child in node["children"]:
+                child["parent_id"] = parent["id"]
+            self._dirty_intervals.update(child['id'] for child in node['children'])
+            self.unindex_node(node, journaled=True)
+        else:
+            self.unindex_subtree(node, journaled=True)
+        self.journal('delete', node, reassign=reassign_children)
 
 
 
@@ -1032,21 +1580,38 @@ class TreeModel:
             elif node['meta']['source'] == 'AI':
                 node['meta']['source'] = 'mixed'
 
+            self.text_changed(node)
+
             if save_revision_history:
-                if 'history' not in node:
-                    node['history'] = []
-                node['history'].append({
-                    'timestamp': timestamp(),
-                    'text': old_text,
-                })
-                
+                add_revision(node.setdefault('history', []), old_text, timestamp())
+
             if refresh_nav:
                 self.tree_updated(edit=[node['id']])
-            else:
-                self.rebuild_tree()
-                #pass
 
 
+    # text of the node's revision at index, oldest first (see util/revisions.py)
+    def revision_text(self, node, index):
+        return revision_text(node['history'], index)
+
+    def revision_count(self, node):
+        return len(node.get('history', []))
+
+    # sets the node's text to its revision at index. Unlike update_text, it works for empty revisions and
+    # immutable nodes, and doesn't mark the text as modified
+    def restore_revision(self, node, index):
+        text = self.revision_text(node, index)
+        if node['text'] != text:
+            node['text'] = text
+            self.text_changed(node)
+            self.tree_updated(edit=[node['id']])
+        return text
+
+    # adds the node's current text to its history if it isn't the latest revision
+    def save_revision(self, node):
+        if not self.revision_count(node) or self.revision_text(node, -1) != node['text']:
+            add_revision(node.setdefault('history', []), node['text'], timestamp())
+            self.node_changed(node)
+
     def update_note(self, node, text, index=0):
         assert node["id"] in self.tree_node_dict, text
 
@@ -1056,6 +1621,7 @@ class TreeModel:
             node["notes"] = ['']
         if node["notes"][index] != text:
             node["notes"][index] = text
+            self.node_changed(node)
             edited = True
 
         # if edited:
@@ -1073,6 +1639,8 @@ class TreeModel:
 
         new_parent["text"] = parent_text
         node["text"] = child_text
+        self.text_changed(new_parent)
+        self.text_changed(node)
 
         new_parent["meta"] = {}
         new_parent['meta']['origin'] = f'split (from child {node["id"]})'
@@ -1087,7 +1655,8 @@ class TreeModel:
 
         # both nodes inherit tags
         if 'tags' in node:
-            new_parent['tags'] = node['tags']
+            new_parent['tags'] = list(node['tags'])
+            self.retag(new_parent)
 
         new_parent['visited'] = True
 
@@ -1095,7 +1664,6 @@ class TreeModel:
         if 'chapter_id' in node:
             new_parent['chapter_id'] = node['chapter_id']
             node.pop('chapter_id')
-        self.rebuild_tree()
         # if refresh_nav:
         #     self.tree_updated(add=[n['id'] for n in subtree_list(new_parent)])
         # else:
@@ -1125,6 +1693,7 @@ class TreeModel:
             self.adopt_parent(child, parent=node)
 
     def zip(self, head, tail, refresh_nav=True, update_selection=True):
+        self.load_children(tail)
         text = self.ancestry_text(node=tail, root=head) #ancestry_plaintext(ancestry_in_range(root=head, node=tail))
         mask = new_node(text=text, mutable=False)
         if self.has_parent(head):
@@ -1132,6 +1701,9 @@ class TreeModel:
             self.adopt_parent(mask, parent)
         children = self.sever_children(tail)
         self.adopt_children(mask, children)
+        # the chain from head to tail now lives only inside the mask
+        self.unindex_subtree(head)
+        self.index_node(mask)
         mask['masked_head'] = head
         mask['tail_id'] = tail['id']
         # TODO hacky
@@ -1142,8 +1714,6 @@ class TreeModel:
 
         if refresh_nav:
             self.tree_updated(delete=[head['id']], add=[n['id'] for n in subtree_list(mask)], write=False)
-        else:
-            self.rebuild_tree()
         if update_selection:
             self.select_node(mask['id'], write=False)
             self.selection_updated(write=False)
@@ -1162,12 +1732,12 @@ class TreeModel:
             parent = self.sever_from_parent(mask)
             self.adopt_parent(head, parent)
         children = self.sever_children(mask)
+        self.unindex_node(mask)
+        self.index_subtree(head)
         self.adopt_children(tail, children)
 
         if refresh_nav:
             self.tree_updated(delete=[mask['id']], add=[n['id'] for n in subtree_list(head, filter)], write=False)
-        else:
-            self.rebuild_tree()
         if update_selection:
             self.select_node(head['id'])
             self.selection_updated()
@@ -1185,6 +1755,7 @@ class TreeModel:
         if not (head == node and tail == node):
             zipped = self.zip(head=head, tail=tail, refresh_nav=refresh_nav, update_selection=update_selection)
             zipped['tags'] = self.get_constituents_attribute(zipped, "tags")
+            self.retag(zipped)
             zipped['memories'] = self.get_constituents_attribute(zipped, "memories")
             return zipped
         else:
@@ -1265,6 +1836,8 @@ class TreeModel:
 
     def set_template(self, node, value):
         node['template'] = value
+        self.invalidate_ancestry(node)
+        self.node_changed(node)
         self.tree_updated()
 
     def display_to_raw_index(self, node, index):
@@ -1302,10 +1875,12 @@ class TreeModel:
             }
             self.chapters[new_chapter["id"]] = new_chapter
             node["chapter_id"] = new_chapter["id"]
+        self._snapshot_needed = True
         self.tree_updated()
 
     def delete_chapter(self, chapter, update_tree=True):
         self.chapters.pop(chapter["id"])
+        self._snapshot_needed = True
         self.node(chapter["root_id"]).pop("chapter_id")
         if update_tree:
             self.tree_updated()
@@ -1362,7 +1937,7 @@ class TreeModel:
 
     def update_memory(self, memory_id, update):
         try:
-            memory = self.state['memories'][memory_id]
+            memory = self.memories[memory_id]
             self.update_frame(node=self.node(memory["root_id"]), update={'memories': {memory_id: update}})
         except KeyError:
             pass
@@ -1380,7 +1955,7 @@ class TreeModel:
         return memory['inheritability'] == 'none' and memory['root_id'] == node['id'] \
                or memory['inheritability'] == 'subtree' or memory['inheritability'] == 'global' \
                or (memory['inheritability'] == 'delayed'
-                   and node_index(memory_ancestor, self.tree_node_dict) < self.context_window_index(node))
+                   and self.node_depth(memory_ancestor) < self.context_window_index(node))
 
     # TODO also return list of pending?
     # def construct_memory(self, node):
@@ -1403,6 +1978,7 @@ class TreeModel:
         }
 
         self.summaries[new_summary['id']] = new_summary
+        self.summaries_changed()
 
         if 'summaries' not in root_node:
             root_node['summaries'] = []
@@ -1411,6 +1987,7 @@ class TreeModel:
 
     def delete_summary(self, summary):
         self.summaries.pop(summary['id'])
+        self.summaries_changed()
         root_node = self.node(summary["root_id"])
         root_node['summmaries'].remove(summary['id'])
 
@@ -1429,8 +2006,7 @@ class TreeModel:
 
     # returns first node that is fully contained in the context window
     def context_window_index(self, node):
-        indices = self.ancestor_text_indices(node)
-        end_indices = [ind[1] for ind in indices]
+        end_indices = self.ancestry_end_indices(node)
         first_in_context_index = end_indices[-1] - self.generation_settings['prompt_length']
         if first_in_context_index < 0:
             return 0
@@ -1452,6 +2028,7 @@ class TreeModel:
         return tags
 
     def add_tag(self, name, scope='node', hide=False, show_only=False, toggle_key='None', icon='None'):
+        self._snapshot_needed = True
         self.tags[name] = {'name': name,
                            'scope': scope,
                            'hide': hide,
@@ -1460,6 +2037,7 @@ class TreeModel:
                            'icon': icon}
 
     def delete_tag(self, name):
+        self._snapshot_needed = True
         del self.tags[name]
         # TODO delete tag from all nodes
 
@@ -1471,10 +2049,14 @@ class TreeModel:
             node['tags'] = []
         if tag not in node['tags']:
             node['tags'].append(tag)
+            self.retag(node, tag)
+            self.node_changed(node)
 
     def untag_node(self, node, tag):
         if 'tags' in node and tag in node['tags']:
             node['tags'].remove(tag)
+            self.retag(node, tag)
+            self.node_changed(node)
 
     def toggle_tag(self, node, tag):
         if self.has_tag_attribute(node, tag):
@@ -1486,6 +2068,7 @@ class TreeModel:
         if tag not in self.tags:
             print('no such tag')
             return
+        self.load_tagged(tag)
         # for tags with "node" scope, return all nodes with that tag
         nodes = self.nodes_list(filter)
         tagged_nodes = [d for d in nodes if self.has_tag_attribute(d, tag)]
@@ -1530,6 +2113,8 @@ class TreeModel:
         #print(node)
         if tag not in self.tags:
             return False
+        if self.tree_node_dict.get(node['id']) is node and self.tags[tag]['scope'] in ('node', 'subtree', 'ancestry'):
+            return node['id'] in self.tag_closure(tag)
         if self.tags[tag]['scope'] == 'node':
             return self.has_tag_attribute(node, tag)
         elif self.tags[tag]['scope'] == 'subtree':
@@ -1549,6 +2134,83 @@ class TreeModel:
             return
 
 
+    # The tag index maps each tag to the set of ids of nodes it applies to, including nodes covered
+    # through the tag's scope. Closures are built lazily per tag and kept up to date by tag_node,
+    # untag_node, create_child and change_parent. Other structural edits drop the index
+    def tag_closure(self, tag):
+        scope = self.tags[tag]['scope']
+        closure = self._tag_closure.get(tag)
+        if closure is None or closure['scope'] != scope:
+            closure = {'scope': scope, 'covered': self.build_tag_closure(tag, scope)}
+            self._tag_closure[tag] = closure
+        return closure['covered']
+
+    def build_tag_closure(self, tag, scope):
+        covered = set()
+        if scope == 'node':
+            covered.update(node['id'] for node in self.nodes if self.has_tag_attribute(node, tag))
+        elif scope == 'subtree':
+            # parents come before children in preorder
+            for node in self.nodes:
+                if self.has_tag_attribute(node, tag) or node.get('parent_id') in covered:
+                    covered.add(node['id'])
+        elif scope == 'ancestry':
+            # children come before parents in reverse preorder
+            for node in reversed(self.nodes):
+                if node['id'] in covered or self.has_tag_attribute(node, tag):
+                    covered.add(node['id'])
+                    if 'parent_id' in node:
+                        covered.add(node['parent_id'])
+        return covered
+
+    # updates built closures after node was tagged, untagged, created or moved from old_parent
+    def retag(self, node, tag=None, old_parent=None):
+        self._visibility = {}
+        if tag:
+            self._tag_positions.pop(tag, None)
+        else:
+            self._tag_positions = {}
+        for tag in ([tag] if tag else list(self._tag_closure)):
+            closure = self._tag_closure.get(tag)
+            if closure is None:
+                continue
+            if tag not in self.tags or closure['scope'] != self.tags[tag]['scope']:
+                del self._tag_closure[tag]
+                continue
+            covered = closure['covered']
+            if closure['scope'] == 'node':
+                if self.has_tag_attribute(node, tag):
+                    covered.add(node['id'])
+                else:
+                    covered.discard(node['id'])
+            elif closure['scope'] == 'subtree':
+                stack = [(node, self.parent(node) is not None and self.parent(node)['id'] in covered)]
+                while stack:
+                    descendant, parent_covered = stack.pop()
+                    if parent_covered or self.has_tag_attribute(descendant, tag):
+                        covered.add(descendant['id'])
+                    else:
+                        covered.discard(descendant['id'])
+                    stack.extend((child, descendant['id'] in covered) for child in descendant['children'])
+            elif closure['scope'] == 'ancestry':
+                self.retag_ancestry(covered, node, tag)
+                if old_parent:
+                    self.retag_ancestry(covered, old_parent, tag)
+                    self.retag_ancestry(covered, self.parent(node), tag)
+
+    # walks up from node until the coverage of an ancestor doesn't change
+    def retag_ancestry(self, covered, node, tag):
+        while node:
+            is_covered = self.has_tag_attribute(node, tag) \
+                         or any(child['id'] in covered for child in node['children'])
+            if is_covered == (node['id'] in covered):
+                return
+            if is_covered:
+                covered.add(node['id'])
+            else:
+                covered.discard(node['id'])
+            node = self.parent(node)
+
     # temporary function to turn root-level attributes into a tag in all nodes
     # TODO
     def turn_attributes_into_tags(self):
@@ -1599,6 +2261,7 @@ class TreeModel:
         if 'text_attributes' not in node:
             node['text_attributes'] = {}
         node['text_attributes'][attribute] = text
+        self.node_changed(node)
         self.tree_updated()
 
 
@@ -1641,9 +2304,12 @@ class TreeModel:
             self.tree_raw_data['summaries'] = {}
         self.summaries = self.tree_raw_data["summaries"]
 
-        if 'model_responses' not in self.tree_raw_data:
-            self.tree_raw_data['model_responses'] = {}
-        self.model_responses = self.tree_raw_data['model_responses']
+        # responses are stored next to the tree, see util/response_store.py. Responses saved in the tree by
+        # older versions are moved there
+        self.model_responses = ResponseStore(response_filename(self.tree_filename) if self.tree_filename else None)
+        for response_id, response in (self.tree_raw_data.pop('model_responses', None) or {}).items():
+            if response_id not in self.model_responses:
+                self.model_responses[response_id] = response
 
         # if 'tags' not in self.tree_raw_data:
         #     self.tree_raw_data['tags'] = DEFAULT_TAGS
@@ -1661,6 +2327,7 @@ class TreeModel:
         }
 
         self.tree_raw_data["frame"] = self.tree_raw_data.get("frame", {})
+        self.frames_changed()
 
         # View settings # TODO If there are more of these, reduce duplication
         self.tree_raw_data["visualization_settings"] = {
@@ -1697,7 +2364,7 @@ class TreeModel:
             new_tree['canonical'] = self.canonical
 
         if 'memories' not in new_tree:
-            new_tree['memories'] = self.memories
+            new_tree['memories'] = deepcopy(self.memories)
 
         if 'summaries' not in new_tree:
             new_tree['summaries'] = self.summaries
@@ -1731,7 +2398,14 @@ class TreeModel:
 
         return new_tree
 
-    def load_tree_data(self, data, init_global=True):
+    # node_dict is {node_id: node} if the loader already built it, unloaded is {node_id: number of children}
+    # of nodes whose children weren't loaded
+    def load_tree_data(self, data, init_global=True, node_dict=None, unloaded=None):
+        self._unloaded = unloaded if unloaded else {}
+        self._unloaded_descendents = {}
+        if not self._unloaded and self._lazy_database:
+            self._lazy_database.close()
+            self._lazy_database = None
         if "root" not in data:
             # json file with a root node
             self.tree_raw_data = deepcopy(EMPTY_TREE)
@@ -1742,7 +2416,11 @@ class TreeModel:
             fix_tree(self.tree_raw_data)
         else:
             self.tree_raw_data = data
-        self.tree_node_dict = {d["id"]: d for d in flatten_tree(self.tree_raw_data["root"])}
+        self.tree_node_dict = node_dict if node_dict is not None and self.tree_raw_data is data \
+            else {d["id"]: d for d in flatten_tree(self.tree_raw_data["root"])}
+        self.structure_changed()
+        # Miro html is only cleaned up once, when the tree is loaded
+        fix_miro_tree(self.nodes)
 
         # If things don't have an open state, give one to them
         for node in self.tree_node_dict.values():
@@ -1757,44 +2435,92 @@ class TreeModel:
 
     # Open a new tree json
     def open_tree(self, filename):
+        self.flush_saves()
         self.tree_filename = os.path.abspath(filename)
-        self.load_tree_data(json_open(self.tree_filename))
+        unloaded = None
+        if is_database(self.tree_filename) and self.tree_database().node_count() > LAZY_LOAD_SIZE:
+            if self._lazy_database:
+                self._lazy_database.close()
+            # saves may change the file name, so the nodes are read through a separate connection
+            self._lazy_database = TreeDatabase(self.tree_filename)
+            tree_data, node_dict, unloaded = self._lazy_database.read_tree(lazy=True)
+        else:
+            tree_data, node_dict = tree_open(self.tree_filename)
+        # apply the edits which were autosaved since the snapshot
+        records = read_journal(journal_filename(self.tree_filename), tree_data.get('journal_generation'))
+        if records:
+            replay_journal(tree_data, records)
+            node_dict = None
+        self.load_tree_data(tree_data, node_dict=node_dict, unloaded=unloaded)
+        self.reset_journal()
         self.io_update()
 
     def open_empty_tree(self):
+        self.flush_saves()
         self.tree_filename = None
         self.load_tree_data(deepcopy(EMPTY_TREE))
         self.io_update()
 
-    # Open a new tree json
-    # TODO if you try to import things that already exist in tree this causes problems
-    # because of duplicate IDs
-    # TODO does metadata of subtree overwrite parent tree?
+    # Imports a tree file (or a stream of trees, see import_trees) as children of the selected node
     def import_tree(self, filename):
-        tree_json = json_open(filename)
-        if 'root' in tree_json:
-            new_subtree_root = tree_json['root']
-            if not new_subtree_root['mutable']:
-                new_subtree_root['mutable'] = True
-            self.add_subtree(self.selected_node, new_subtree_root)
-            # self.selected_node['children'].append(new_subtree_root)
-            # new_subtree_root['parent_id'] = self.selected_node_id
-            if 'chapters' in tree_json:
-                #self.import_chapters(new_subtree_root, tree_json['chapters'])
-                self.chapters.update(tree_json['chapters'])
-            if 'tags' in tree_json:
-                self.tags.update(tree_json['tags'])
-            self.load_tree_data(self.tree_raw_data)
-            self.tree_updated()
+        self.import_trees([filename])
+
+    # Imports many trees as children of node (the selected node by default), with one index update per tree
+    # and one nav refresh. sources are filenames of trees or jsonl streams of trees (see read_jsonl_trees),
+    # or tree data. Ids which are already used in the tree are replaced. Chapters, summaries, tags and
+    # model responses are merged. Returns the roots of the imported trees
+    def import_trees(self, sources, node=None):
+        node = node if node else self.selected_node
+        self.load_all(refresh_nav=False)
+        taken = {n['id'] for n in all_nodes(self.root())} | set(self.chapters) | set(self.summaries)
+        roots = []
+        for tree_data, responses in self.tree_sources(sources):
+            if 'root' not in tree_data:
+                if 'id' not in tree_data:
+                    print('improperly formatted tree')
+                    continue
+                tree_data = {'root': tree_data}
+            root = tree_data['root']
+            remap_tree_ids(tree_data, taken)
+            if not root.get('mutable', True):
+                root['mutable'] = True
+            self.chapters.update(tree_data.get('chapters') or {})
+            self.canonical.extend(tree_data.get('canonical') or [])
+            self.summaries.update(tree_data.get('summaries') or {})
+            for tag, attributes in (tree_data.get('tags') or {}).items():
+                if tag not in self.tags:
+                    self.tree_raw_data.setdefault('tags', deepcopy(DEFAULT_TAGS))[tag] = attributes
+            inline_responses = tree_data.get('model_responses') or {}
+            for n in all_nodes(root):
+                response_id = n.get('generation', {}).get('id')
+                if response_id is None or response_id in self.model_responses:
+                    continue
+                response = inline_responses.get(response_id) or (responses.get(response_id) if responses else None)
+                if response:
+                    self.model_responses[response_id] = response
+            node['children'].append(root)
+            self.index_subtree(root, node)
+            roots.append(root)
+        if roots:
+            if self.summaries:
+                self.summaries_changed()
+            self.tree_updated(add=[n['id'] for root in roots for n in preorder(root)])
             self.io_update()
-        else:
-            if 'id' in tree_json:
-                self.add_subtree(self.selected_node, tree_json)
-                self.load_tree_data(self.tree_raw_data)
-                self.tree_updated()
-                self.io_update()
+        return roots
+
+    # yields (tree data, response store of the file or None) of each tree in sources
+    def tree_sources(self, sources):
+        for source in sources:
+            if not isinstance(source, str):
+                yield source, None
+            elif is_jsonl(source):
+                with open(source) as f:
+                    for tree_data in read_jsonl_trees(f):
+                        yield tree_data, None
             else:
-                print('improperly formatted tree')
+                responses = ResponseStore(response_filename(source)) if os.path.isfile(response_filename(source)) \
+                    else None
+                yield tree_open(source)[0], responses
 
     def add_subtree(self, node, subtree_root):
         node['children'].append(subtree_root)
@@ -1802,6 +2528,7 @@ class TreeModel:
 
     # open new tree with node as root
     def open_node_as_root(self, node=None, new_filename=None, save=True, rebuild_global=False):
+        self.load_all(refresh_nav=False)
         if save:
             self.save_tree()
         node = self.selected_node if not node else node
@@ -1866,24 +2593,272 @@ class TreeModel:
             return False
         print('saving tree')
 
+        backup = self.backup_store(save_filename) if backup else None
+        database = self.tree_database() if subtree is self.tree_raw_data and save_filename == self.tree_filename \
+            and is_database(save_filename) else None
+        # other files need the whole tree
+        if not database:
+            self.load_all(refresh_nav=False)
+
+        # print('chapters:', subtree['chapters'])
+        # Save tree
+        snapshot = save_filename == self.tree_filename and subtree is self.tree_raw_data
+        if snapshot:
+            # a pending autosave would only write what this save writes
+            self.cancel_autosave()
+            self.model_responses.attach(response_filename(save_filename))
+            # a new generation makes the old journal stale even if removing it below fails
+            subtree['journal_generation'] = str(uuid.uuid1())
+        data = self.snapshot_data(subtree)
+        if snapshot:
+            self.reset_journal()
+        self.submit_save(self.write_tree, save_filename, data, backup, self.preferences['backup_retention'], snapshot,
+                         database, list(self._unloaded))
+        return True
+
+    # runs on the save thread
+    def write_tree(self, save_filename, data, backup=None, retention=None, snapshot=False, database=None,
+                   unloaded=()):
+        # Keep the file saved before the store existed
+        if backup and not backup.backups() and os.path.isfile(save_filename):
+            modified = os.path.getmtime(save_filename)
+            previous = tree_open(save_filename)[0]
+            # a database is created empty when it's first opened
+            if previous.get('root'):
+                backup.add_backup(previous, timestamp(modified), modified)
+        if database:
+            database.write_tree(data, unloaded)
+            # the tree may only be partly loaded
+            data = database.read_tree()[0] if unloaded and backup else data
+        else:
+            tree_create(save_filename, data)
+        if snapshot:
+            remove_journal(journal_filename(save_filename))
+        if backup:
+            backup.add_backup(data, timestamp())
+            if retention:
+                backup.apply_retention(retention)
+
+    # backups of a tree file are kept in backups/<tree name>/ next to the open tree, see util/backup_store.py
+    def backup_store(self, save_filename=None):
+        save_filename = save_filename if save_filename else self.tree_filename
         # Fancy platform independent os.path
         filename = os.path.splitext(os.path.basename(save_filename))[0]
         save_dir = os.path.dirname(self.tree_filename)
-        backup_dir = os.path.join(save_dir, "backups")
+        backup_dir = os.path.join(save_dir, "backups", filename)
+        if backup_dir not in self._backup_stores:
+            self._backup_stores[backup_dir] = BackupStore(backup_dir)
+        return self._backup_stores[backup_dir]
+
+    # writes the tree at a backup point to backups/<tree name>-<backup point> and returns the filename
+    def restore_backup(self, name):
+        self.flush_saves()
+        store = self.backup_store()
+        data = store.restore(name)
+        extension = os.path.splitext(self.tree_filename)[1]
+        filename = os.path.join(os.path.dirname(store.directory), f"{self.name()}-{name}{extension}")
+        # the restored tree starts without a journal
+        data.pop('journal_generation', None)
+        tree_create(filename, data)
+        return filename
 
-        # Make backup before overwriting tree
-        if backup and os.path.isfile(save_filename):
-            if not os.path.exists(backup_dir):
-                os.mkdir(backup_dir)
-            os.rename(save_filename, os.path.join(backup_dir, f"{filename}-{timestamp()}.json"))
+    #################################
+    #   Saving
+    #################################
+    """
+    Saves serialize a copy of the tree on a background thread so the UI doesn't wait for the write. Writes
+    run one at a time in the order they were submitted, so a snapshot and the journal appends after it
+    land on disk in order. Autosaves are scheduled by schedule_autosave and wait until the tree has been
+    quiet for AUTOSAVE_DELAY, so a burst of updates (new nodes from a generation, zip_all_chains) is
+    written once. save_status is updated as writes start and finish, followed by io_update.
+    """
 
-        # print('chapters:', subtree['chapters'])
-        # Save tree
-        json_create(save_filename, subtree)
+    # copy of the tree which the save thread can serialize while the tree keeps changing. Only the pickling
+    # happens here, on the Tk thread; building the copy from the bytes is left to the save thread (run_save),
+    # and is most of the cost. For 100k nodes of ~200 characters with generation metadata, pickling takes
+    # ~0.5s and unpickling ~1.8s. Sharing unchanged nodes with the last snapshot would avoid the pickling
+    # too, but needs every node mutation to be tracked, and a missed one would silently save stale data
+    def snapshot_data(self, data):
+        return Snapshot(data)
+
+    def submit_save(self, func, *args):
+        if self._saver is None:
+            self._saver = ThreadPool(processes=1)
+        self.save_status = 'saving'
         self.io_update()
+        self._save_result = self._saver.apply_async(self.run_save, (self.model_responses, func) + args)
+        if self._save_poll_job is None:
+            self._save_poll_job = self.app.after(SAVE_POLL_INTERVAL, self.poll_saves)
+
+    # runs on the save thread. Tk isn't thread safe, and flush_saves may be blocking the Tk thread waiting
+    # for this, so it only sets a flag for poll_saves. Responses added since the last save are written first
+    def run_save(self, responses, func, *args):
+        try:
+            responses.flush()
+            func(*(arg.load() if isinstance(arg, Snapshot) else arg for arg in args))
+            self.save_status = 'saved'
+        except Exception as e:
+            print('failed to save tree:', e)
+            self.save_status = 'failed'
+        self._save_status_changed = True
+
+    # reports the save status on the Tk thread, checking again with after() until the last save is done
+    def poll_saves(self):
+        self._save_poll_job = None
+        # saves run in order, so the last one being done means they all are
+        done = self._save_result is None or self._save_result.ready()
+        self.report_save_status()
+        if not done:
+            self._save_poll_job = self.app.after(SAVE_POLL_INTERVAL, self.poll_saves)
+
+    def report_save_status(self):
+        if self._save_status_changed:
+            self._save_status_changed = False
+            self.io_update()
+
+    def schedule_autosave(self):
+        if self._autosave_job is not None:
+            self.app.after_cancel(self._autosave_job)
+        self._autosave_job = self.app.after(AUTOSAVE_DELAY, self.run_autosave)
+
+    def cancel_autosave(self):
+        if self._autosave_job is not None:
+            self.app.after_cancel(self._autosave_job)
+            self._autosave_job = None
+
+    def run_autosave(self):
+        self._autosave_job = None
+        self.autosave_tree()
+
+    # writes a pending autosave now and waits for all saves to finish, e.g. before the tree is closed
+    def flush_saves(self):
+        if self._autosave_job is not None:
+            self.cancel_autosave()
+            self.autosave_tree()
+        if self._save_result is not None:
+            self._save_result.wait()
+            self._save_result = None
+            self.report_save_status()
+
+    #################################
+    #   Journal
+    #################################
+    """
+    Autosaves append node operations to a journal next to the tree file (see util/journal.py) instead of 
+    rewriting the whole tree. Creating, moving, reordering and deleting nodes, and changes to nodes passed to
+    node_changed (text, tags, generation metadata) are journaled. Anything else which changes the tree
+    (other structural edits, frames, summaries, chapters, tag definitions) sets _snapshot_needed, and the
+    next autosave writes a full snapshot. Open/visited flags are set through set_node_flag, and changes to
+    many nodes at once are reported with nodes_changed.
+    """
+
+    def journal(self, op, node, **kwargs):
+        if self.tree_filename:
+            self._journal.append((op, node, kwargs))
+
+    # Called whenever attributes of a node change
+    def node_changed(self, node):
+        self.hash_changed(node)
+        if self.tree_filename:
+            self._journal_touched[node['id']] = node
+
+    # Sets an attribute like open or visited, reporting the node if the value changed
+    def set_node_flag(self, node, key, value):
+        if node.get(key) != value:
+            node[key] = value
+            self.node_changed(node)
+
+    # Reports attribute changes of many nodes. Past JOURNAL_UPDATE_LIMIT nodes, the next autosave writes a
+    # snapshot instead of journaling each one
+    def nodes_changed(self, nodes):
+        if len(nodes) > JOURNAL_UPDATE_LIMIT:
+            for node in nodes:
+                self.hash_changed(node)
+            self._snapshot_needed = True
+        else:
+            for node in nodes:
+                self.node_changed(node)
+
+    def reset_journal(self):
+        self._journal = []
+        self._journal_touched = {}
+        self._journal_selection = self.tree_raw_data.get('selected_node_id') if self.tree_raw_data else None
+        self._snapshot_needed = False
+
+    def node_fields(self, node):
+        return {key: value for key, value in node.items() if key != 'children'}
+
+    # serializes and clears the pending operations. Created nodes are serialized as they are now,
+    # so later changes to them in the same batch don't need separate records
+    def journal_records(self):
+        # runs on the Tk thread, like everything that adds operations. Generation results are delivered there too,
+        # by the generation service's after() polling
+        pending, self._journal = self._journal, []
+        touched, self._journal_touched = self._journal_touched, {}
+        records = []
+        created = set()
+        for op, node, kwargs in pending:
+            if op == 'create':
+                created.add(node['id'])
+                records.append({'op': 'create', 'parent_id': kwargs['parent_id'], 'node': self.node_fields(node)})
+            elif op == 'move':
+                records.append({'op': 'move', 'id': node['id'], 'parent_id': kwargs['parent_id']})
+            elif op == 'order':
+                records.append({'op': 'order', 'id': node['id'], 'children': kwargs['children']})
+            elif op == 'delete':
+                records.append({'op': 'delete', 'id': node['id'], 'reassign': kwargs.get('reassign', False)})
+        for node_id, node in touched.items():
+            if node_id not in created and self.tree_node_dict.get(node_id) is node:
+                records.append({'op': 'update', 'node': self.node_fields(node)})
+        selection = self.tree_raw_data.get('selected_node_id')
+        if selection != self._journal_selection:
+            records.append({'op': 'select', 'id': selection})
+            self._journal_selection = selection
+        return records
+
+    # Saves the tree by appending to the journal, or writes a snapshot if there were changes which can't be
+    # journaled or the journal has grown too big
+    def autosave_tree(self):
+        if not self.tree_filename:
+            return False
+        if is_database(self.tree_filename):
+            return self.autosave_database()
+        journal_file = journal_filename(self.tree_filename)
+        if self._snapshot_needed or not os.path.isfile(self.tree_filename) \
+                or not self.tree_raw_data.get('journal_generation') \
+                or (os.path.isfile(journal_file) and os.path.getsize(journal_file) > JOURNAL_SNAPSHOT_SIZE):
+            return self.save_tree(backup=False)
+        records = self.journal_records()
+        if records:
+            # records share lists with the nodes, which may change while the save thread writes them
+            self.submit_save(append_journal, journal_file, self.snapshot_data(records),
+                             self.tree_raw_data['journal_generation'])
+        elif self.model_responses.unwritten():
+            self.submit_save(self.model_responses.flush)
         return True
 
+    # Trees in a database apply the journal records to the database instead, see util/tree_db.py
+    def autosave_database(self):
+        if self._snapshot_needed or not os.path.isfile(self.tree_filename):
+            return self.save_tree(backup=False)
+        records = self.journal_records()
+        if records:
+            self.submit_save(self.tree_database().apply_records, self.snapshot_data(records))
+        elif self.model_responses.unwritten():
+            self.submit_save(self.model_responses.flush)
+        return True
+
+    # database of the open tree, if it's a .db tree
+    def tree_database(self):
+        if self._database and self._database.filename != self.tree_filename:
+            self._database.close()
+            self._database = None
+        if self._database is None and is_database(self.tree_filename):
+            self._database = TreeDatabase(self.tree_filename)
+        return self._database
+
     def export_subtree(self, root, filename, filter=None, copy_attributes=None):
+        self.load_all()
         filtered_tree = tree_subset(root, filter=filter, copy_attributes=copy_attributes)
         filtered_tree = {'root': filtered_tree}
         if 'tags' in copy_attributes:
@@ -1895,12 +2870,14 @@ class TreeModel:
         self.io_update()
 
     def save_simple_tree(self, save_filename, subtree=None):
+        self.load_all()
         subtree = subtree if subtree else self.tree_raw_data
         simple_tree = make_simple_tree(subtree)
         json_create(save_filename, simple_tree)
         self.io_update()
 
     def save_jsonl(self, save_filename=None, subtree=None):
+        self.load_all()
         subtree = subtree if subtree else self.tree_raw_data
         flat_tree = self.nodes
         save_filename = save_filename if save_filename else os.path.splitext(os.path.basename(self.tree_filename))[0]+ '.jsonl'
@@ -1946,11 +2923,19 @@ class TreeModel:
     #   Generation
     #################################
 
-    def post_generation(self, error, nodes, results):
+    # called on the Tk thread when a generation finishes
+    def post_generation(self, error, nodes, results, prompt_reference=None):
+        # ids of the generation's nodes, see generate_continuations
+        self.new_nodes.remove([node['id'] for node in nodes])
         if not error:
             #TODO adaptive branching
-            self.model_responses[results['id']] = results
+            self.model_responses[results['id']] = self.stored_response(results, prompt_reference)
             self.set_generated_nodes(nodes, results)
+            # completions whose request failed (see openAI_fan_out)
+            failed = [(node, completion['error']) for node, completion in zip(nodes, results['completions'])
+                      if 'error' in completion]
+            if failed:
+                self.delete_failed_nodes([node for node, _ in failed], failed[0][1])
         else:
             self.delete_failed_nodes(nodes, error)
             return
@@ -1958,8 +2943,7 @@ class TreeModel:
         for result in results['completions']:
             print("Generated continuation:\n", result['text'], "\nerror", error)
 
-        # DO NOT CALL FROM THREAD: self.tree_updated()
-        self.app.event_generate("<<NewNodes>>", when="tail")
+        self.edit_new_nodes([node['id'] for node in nodes if node['id'] in self.tree_node_dict])
 
     def default_post_template(self, completion):
         start_text = codecs.decode(self.generation_settings['start'], "unicode-escape")
@@ -1975,13 +2959,17 @@ class TreeModel:
 
     def set_generated_nodes(self, nodes, results):
         for i, node in enumerate(nodes):
+            if 'error' in results['completions'][i]:
+                continue
             node['text'] = self.default_post_template(results['completions'][i])
+            self.text_changed(node)
             # node['text'] = self.default_post_template(results['completions'][i]) \
             #     if self.generation_settings['post_template'] == "Default" \
             #     else self.custom_post_template(results['completions'][i], self.generation_settings['post_template'])
             self.node_creation_metadata(node, source='AI')
             node["generation"] = {'id': results['id'],
                                   'index': i}
+            self.node_changed(node)
             # TODO save history
 
     def delete_failed_nodes(self, nodes, error):
@@ -1989,16 +2977,70 @@ class TreeModel:
         for node in nodes:
             parent = self.parent(node)
             parent["children"].remove(node)
+            self.unindex_subtree(node)
         self.tree_updated(delete=[node['id'] for node in nodes])
 
-    def default_generate(self, prompt, nodes):
-        results, error = gen(prompt, self.generation_settings, self.model_config,
-            OPENAI_API_KEY=self.OPENAI_API_KEY,
-            AI21_API_KEY=self.AI21_API_KEY,
-            GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,
-            TOGETHERAI_API_KEY=self.TOGETHERAI_API_KEY,
-            )
-        self.post_generation(error, nodes, results)
+    def default_generate(self, prompt, nodes, prompt_reference=None, priority=INTERACTIVE):
+        generation_service().submit(prompt, self.generation_settings, self.model_config,
+                                    callback=lambda results, error: self.post_generation(error, nodes, results,
+                                                                                         prompt_reference),
+                                    priority=priority,
+                                    OPENAI_API_KEY=self.OPENAI_API_KEY,
+                                    AI21_API_KEY=self.AI21_API_KEY,
+                                    GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,
+                                    TOGETHERAI_API_KEY=self.TOGETHERAI_API_KEY,
+                                    )
+
+    # Stored responses refer to the prompt instead of repeating the story text for every generation. When the
+    # prompt contains the end of the ancestry text of the node it was made from, it's stored as
+    # prefix + ancestry_text(node)[-length:] + suffix with a hash of the full text, see response_prompt. The
+    # length is counted from the end, so edits further up the ancestry only matter if they reach the tail
+    def prompt_reference(self, node, prompt):
+        tail = self.ancestry_tail(node, self.generation_settings['prompt_length'])
+        index = prompt.find(tail) if tail else -1
+        if index < 0:
+            return None
+        return {'node_id': node['id'],
+                'template': self.generation_settings['template'],
+                'length': len(tail),
+                'prefix': prompt[:index],
+                'suffix': prompt[index + len(tail):],
+                'hash': hashlib.sha1(prompt.encode('utf-8')).hexdigest()}
+
+    def stored_response(self, results, prompt_reference=None):
+        prompt = dict(results['prompt'])
+        if prompt_reference:
+            prompt.pop('text')
+            prompt['reference'] = prompt_reference
+        tokens = prompt.pop('tokens', None)
+        if tokens and self.preferences['save_prompt_logprobs']:
+            prompt['tokens'] = TokenArray.from_tokens(tokens).encode()
+        # token data is stored in columns, see util/token_array.py
+        completions = [{**completion, 'tokens': TokenArray.from_tokens(completion['tokens']).encode()}
+                       if completion.get('tokens') else completion
+                       for completion in results['completions']]
+        return {**results, 'prompt': prompt, 'completions': completions}
+
+    # text of a stored response's prompt, or None if the ancestry it refers to has changed
+    def response_prompt(self, response):
+        prompt = response['prompt']
+        if 'text' in prompt:
+            return prompt['text']
+        reference = prompt['reference']
+        node = self.node(reference['node_id'])
+        if not node:
+            return None
+        ancestry_text = self.ancestry_text(node)
+        # references stored before lengths were used have absolute offsets
+        tail = ancestry_text[-reference['length']:] if 'length' in reference \
+            else ancestry_text[reference['start']:reference['end']]
+        text = reference['prefix'] + tail + reference['suffix']
+        if hashlib.sha1(text.encode('utf-8')).hexdigest() != reference['hash']:
+            return None
+        return text
+
+    def response_prompt_tokens(self, response):
+        return token_array(response['prompt'].get('tokens'))
 
 
     # if self.generation_settings['adaptive']:
@@ -2022,9 +3064,42 @@ class TreeModel:
             prompt = self.custom_prompt(node, self.generation_settings['template'])
         return prompt
 
+    # Assembled prompts are cached with the node's ancestry, so they are dropped when text in the
+    # ancestry changes. Ancestries containing templates are evaluated every time
+    def cached_prompt(self, node, key):
+        entry = self.cached_ancestry(node)
+        if entry['has_template']:
+            return None
+        return entry['prompts'].get(key)
+
+    def cache_prompt(self, node, key, prompt):
+        entry = self.cached_ancestry(node)
+        if not entry['has_template']:
+            entry['prompts'][key] = prompt
+        return prompt
+
+    # returns ancestry_text(node, root)[-length:], walking the ancestry backward and stopping
+    # once enough text has been collected
+    def ancestry_tail(self, node, length, root=None):
+        ancestry = self.cached_ancestry(node)['nodes']
+        stop = self.ancestor_position(node, root) if root else 0
+        if not length or length < 0:
+            return ''.join(self.text(ancestor) for ancestor in ancestry[stop:])
+        pieces = []
+        total = 0
+        for i in range(len(ancestry) - 1, stop - 1, -1):
+            text = self.text(ancestry[i])
+            pieces.append(text)
+            total += len(text)
+            if total >= length:
+                break
+        pieces.reverse()
+        return ''.join(pieces)[-length:]
+
+    # Not cached: templates are evaluated with node and self in scope, so they can read anything
     def custom_prompt(self, node, filename):
-        input = self.ancestry_text(node)
-        input = input[-self.generation_settings['prompt_length']:]
+        prompt_length = self.generation_settings['prompt_length']
+        input = self.ancestry_tail(node, prompt_length)
         with open(f'./config/prompts/{filename}.txt', 'r') as f:
             prompt = f.read()
         eval_prompt = eval(f'f"""{prompt}"""')
@@ -2035,19 +3110,32 @@ class TreeModel:
         return f'\n[Next section summary: {summary}]\n'
 
     def antisummary_prompt(self, node):
-        prompt = ''
-        ancestry = self.ancestry(node)
-        ancestor_ids = [ancestor['id'] for ancestor in ancestry]
-        for ancestor in ancestry:
+        prompt_length = self.generation_settings['prompt_length']
+        key = ('Antisummary', prompt_length)
+        cached = self.cached_prompt(node, key)
+        if cached is not None:
+            return cached
+        entry = self.cached_ancestry(node)
+        ancestry = entry['nodes']
+        ancestor_ids = entry['index']
+        # walk backward until the prompt is long enough
+        pieces = []
+        total = 0
+        for ancestor in reversed(ancestry):
+            pieces.append(ancestor['text'])
+            total += len(ancestor['text'])
             if 'summaries' in ancestor and len(ancestor['summaries']) > 0:
-                for summary_id in ancestor['summaries']:
+                for summary_id in reversed(ancestor['summaries']):
                     summary = self.summaries[summary_id]
                     # only add summary if entire summarized text is in prompt
                     if summary['end_id'] in ancestor_ids:
-                        prompt += self.antisummary_embedding(summary['text'])
-            prompt += ancestor['text']
-        prompt = prompt[-self.generation_settings['prompt_length']:]
-        return prompt
+                        pieces.append(self.antisummary_embedding(summary['text']))
+                        total += len(pieces[-1])
+            if prompt_length and total >= prompt_length:
+                break
+        pieces.reverse()
+        prompt = ''.join(pieces)[-prompt_length:]
+        return self.cache_prompt(node, key, prompt)
 
     # builds a summarization prompt with default summarization few-shots and any summaries from ancestry
     def summary_prompt(self, node, num_summaries=3):
@@ -2086,8 +3174,7 @@ class TreeModel:
                 prompt += "\nSummary:\n"
                 prompt += summaries[-num_summaries + i]
 
-        input = self.ancestry_text(node)
-        input = input[-self.generation_settings['prompt_length']:]
+        input = self.ancestry_tail(node, self.generation_settings['prompt_length'])
 
         prompt += "\nPassage:\n"
         prompt += input
@@ -2097,10 +3184,11 @@ class TreeModel:
 
 
     def default_prompt(self, node, prompt_length=None, memory=True, quiet=True):
-        prompt = self.ancestry_text(node)
         if not prompt_length:
             prompt_length = self.generation_settings['prompt_length']
-        prompt = prompt[-prompt_length:]
+        prompt = self.cached_prompt(node, ('Default', prompt_length))
+        if prompt is None:
+            prompt = self.cache_prompt(node, ('Default', prompt_length), self.ancestry_tail(node, prompt_length))
 
         global_context = self.generation_settings['global_context']
 
@@ -2167,12 +3255,14 @@ class TreeModel:
         self.tree_updated(add=new_nodes)
         #self.reveal_nodes(children + grandchildren)
         prompt = self.prompt(node=node)
+        prompt_reference = self.prompt_reference(node, prompt)
 
-        threading.Thread(target=self.default_generate, args=(prompt, children)).start()
+        self.default_generate(prompt, children, prompt_reference, kwargs.get('priority', INTERACTIVE))
 
         # After asking for the generation, set loading text
         for child in children:
             child["text"] = "\n\n** Generating **" if 'placeholder' not in kwargs else kwargs['placeholder']
+            self.text_changed(child)
             child['mutable'] = False
         # for grandchild in grandchildren:
         #     grandchild["text"] = "\n\n** Generating **"
@@ -2276,7 +3366,20 @@ class TreeModel:
         if not node:
             node = self.selected_node
         story = self.default_prompt(node=node, memory=False)
-        return conditional_logprob(prompt=story + context_breaker, target=target, engine=engine)
+        api_base, api_key = self.model_endpoint(engine)
+        return conditional_logprob(prompt=story + context_breaker, target=target, engine=engine,
+                                   api_base=api_base, api_key=api_key)
+
+    # endpoint and key of a model in the model config. Models that aren't configured are scored at the
+    # environment's endpoint
+    def model_endpoint(self, engine):
+        model_info = self.model_config['models'].get(engine)
+        if not model_info:
+            return None, None
+        api_key, _ = get_correct_key(model_info['type'], {'OPENAI_API_KEY': self.OPENAI_API_KEY,
+                                                          'GOOSEAI_API_KEY': self.GOOSEAI_API_KEY,
+                                                          'TOGETHERAI_API_KEY': self.TOGETHERAI_API_KEY})
+        return model_info['api_base'], api_key
 
     def measure_path_optimization(self, root, node):
         #node = node if node else self.selected_node
@@ -2391,7 +3494,7 @@ class TreeModel:
                 # uses original prompt
                 prompt = node["meta"]["generation"]["prompt"] + node['text']
                 engine = node["meta"]["generation"]["model"].split(':')[0]
-                logprobs, tokens, positions = prompt_probs(prompt, engine)
+                logprobs, tokens, positions = prompt_probs(prompt, engine, *self.model_endpoint(engine))
                 corrected_positions = [p - len(node["meta"]["generation"]["prompt"]) for p in positions]
                 start = positions.index(len(node["meta"]["generation"]["prompt"]))
                 changed_indices = []
@@ -2405,7 +3508,7 @@ class TreeModel:
             elif node["meta"]["source"] == "prompt":
                 prompt = self.default_prompt(node=node, quiet=True, mode='default')
                 engine = self.generation_settings['model']
-                logprobs, tokens, positions = prompt_probs(prompt, engine)
+                logprobs, tokens, positions = prompt_probs(prompt, engine, *self.model_endpoint(engine))
                 start_index = positions.index(len(prompt) - len(node['text']))
                 index = start_index
                 changed_indices = []
@@ -2447,13 +3550,13 @@ class TreeModel:
         prompt = prompt if prompt else ''
         node = node if node else self.selected_node
         prompt = self.default_prompt(quiet=True, node=node) + prompt
-        model_info = self.model_config['models'][engine]
+        api_base, api_key = self.model_endpoint(engine)
         multiverse, ground_truth = greedy_word_multiverse(prompt=prompt, ground_truth=ground_truth, max_depth=max_depth,
                                                           unnormalized_amplitude=unnormalized_amplitude,
                                                           unnormalized_threshold=threshold,
                                                           engine=engine,
-                                                          model_type=model_info['type'],
-                                                          api_base=model_info['api_base']
+                                                          api_base=api_base,
+                                                          api_key=api_key
         )
         return multiverse, ground_truth, prompt
 
@@ -2462,8 +3565,11 @@ class TreeModel:
         model_response = self.model_responses.get(node['generation']['id'], False)
         if not model_response:
             return None, '', ''
-        prompt = model_response['prompt']['text']
+        prompt = self.response_prompt(model_response)
+        if prompt is None:
+            prompt = '(the prompt has been edited since this was generated)'
         completion = model_response['completions'][node['generation']['index']]
+        completion = {**completion, 'tokens': token_array(completion.get('tokens'))}
         return model_response, prompt, completion
 
 
@@ -2507,6 +3613,19 @@ class TreeModel:
             self.clear_old_generation_metadata(child)
 
 
+    # Removes data nothing refers to any more (see util/compaction.py) and rewrites the tree file.
+    # Returns {category: [count, bytes]}
+    def compact_tree(self, dry_run=False):
+        self.load_all(refresh_nav=False)
+        report = compact_tree_data(self.tree_raw_data, self.model_responses, dry_run)
+        if not dry_run:
+            self.tree_updated(rebuild=True)
+            if self.save_tree():
+                self.flush_saves()
+                if is_database(self.tree_filename):
+                    self.tree_database().vacuum()
+        return report
+
     def backup_and_delete_model_response_data(self, root=None):
         root = root if root else self.root()
         print('backing up model response data')
@@ -2515,8 +3634,7 @@ class TreeModel:
         backup_dir = os.path.join(save_dir, "backups")
         if not os.path.exists(backup_dir):
             os.mkdir(backup_dir)
-        json_create(os.path.join(backup_dir, f"model_responses-{timestamp()}.json"), self.tree_raw_data['model_responses'])
-        self.tree_raw_data['model_responses'] = {}
+        self.model_responses.archive(os.path.join(backup_dir, f"model_responses-{timestamp()}.responses"))
 
     
         
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from util.util_tree import preorder
+
+"""
+Backups are stored as content addressed objects so that backup points share everything which didn't change
+between them. Every node is an object holding its attributes and the hashes of its children, so a subtree
+which didn't change has the same hash and is stored once. The rest of the tree data (everything but the root)
+is another object, and each backup point is a manifest naming the tree object.
+
+    <store>/objects/ab/cdef...      zlib compressed json
+    <store>/manifests/<name>.json   {"name": ..., "time": ..., "tree": hash}
+    <store>/references              json lines of [hash, [referenced hash, ...]]
+
+Objects:
+    {"node": {...}, "children": [hash, ...]}    node attributes without children
+    {"data": {...}, "root": hash}               tree data without the root
+
+The references of each object are appended to the references file when it's stored, so removing backup
+points can find the objects still in use without reading them. Objects are never changed, so a line stays
+true until its object is removed, when the file is rewritten.
+"""
+
+
+def object_hash(encoded):
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def encode_object(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+# Retention is a list of [age, interval] in seconds, ordered by age. Backup points younger than age are thinned
+# to one per interval (0 keeps all of them). The last age can be None for no limit. Points older than every
+# age are removed. Returns the names of the points to keep, newest first
+def retained_backups(backups, retention, now=None):
+    now = now if now else time.time()
+    kept = []
+    buckets = set()
+    for backup in sorted(backups, key=lambda b: b['time'], reverse=True):
+        age = now - backup['time']
+        for tier, (max_age, interval) in enumerate(retention):
+            if max_age is None or age < max_age:
+                bucket = (tier, int(backup['time'] // interval)) if interval else (tier, backup['name'])
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    kept.append(backup['name'])
+                break
+    return kept
+
+
+class BackupStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.manifests_dir = os.path.join(directory, 'manifests')
+        self.references_path = os.path.join(directory, 'references')
+        # hashes of stored objects, read from disk when first needed
+        self._known = None
+        # {hash: hashes it refers to}, read from disk when first needed
+        self._references = None
+        # references of objects stored since they were last written
+        self._new_references = []
+
+    def object_path(self, obj_hash):
+        return os.path.join(self.objects_dir, obj_hash[:2], obj_hash[2:])
+
+    def known(self):
+        if self._known is None:
+            self._known = set()
+            if os.path.isdir(self.objects_dir):
+                for prefix in os.listdir(self.objects_dir):
+                    for rest in os.listdir(os.path.join(self.objects_dir, prefix)):
+                        if not rest.endswith('.tmp'):
+                            self._known.add(prefix + rest)
+        return self._known
+
+    def references(self):
+        if self._references is None:
+            self._references = {}
+            if os.path.isfile(self.references_path):
+                with open(self.references_path) as f:
+                    for line in f:
+                        try:
+                            obj_hash, refs = json.loads(line)
+                        except ValueError:
+                            # cut off by a crash
+                            continue
+                        self._references[obj_hash] = refs
+        return self._references
+
+    def object_references(self, obj_hash):
+        if obj_hash not in self.references():
+            # stored by a version without the references file, or a crash before they were written
+            obj = self.get(obj_hash)
+            self._references[obj_hash] = [obj['root']] if 'root' in obj else obj['children']
+        return self._references[obj_hash]
+
+    def write_references(self):
+        if self._new_references:
+            with open(self.references_path, 'a') as f:
+                f.writelines(json.dumps(entry, separators=(',', ':')) + '\n' for entry in self._new_references)
+            self._new_references = []
+
+    def put(self, obj, refs=()):
+        encoded = encode_object(obj)
+        obj_hash = object_hash(encoded)
+        if obj_hash not in self.known():
+            path = self.object_path(obj_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # objects are never partially written, a crash leaves a tmp file
+            with open(path + '.tmp', 'wb') as f:
+                f.write(zlib.compress(encoded))
+            os.replace(path + '.tmp', path)
+            self._known.add(obj_hash)
+            self.references()[obj_hash] = list(refs)
+            self._new_references.append([obj_hash, list(refs)])
+        return obj_hash
+
+    def get(self, obj_hash):
+        with open(self.object_path(obj_hash), 'rb') as f:
+            return json.loads(zlib.decompress(f.read()))
+
+    def put_tree(self, data):
+        nodes = list(preorder(data['root']))
+        hashes = {}
+        # children before their parents
+        for node in reversed(nodes):
+            children = [hashes[id(child)] for child in node.get('children', [])]
+            hashes[id(node)] = self.put({
+                'node': {key: value for key, value in node.items() if key != 'children'},
+                'children': children,
+            }, children)
+        tree_hash = self.put({
+            'data': {key: value for key, value in data.items() if key != 'root'},
+            'root': hashes[id(data['root'])],
+        }, [hashes[id(data['root'])]])
+        self.write_references()
+        return tree_hash
+
+    def get_tree(self, tree_hash):
+        tree = self.get(tree_hash)
+        data = tree['data']
+        data['root'] = self.get_node(tree['root'])
+        return data
+
+    def get_node(self, node_hash):
+        obj = self.get(node_hash)
+        root = obj['node']
+        root['children'] = []
+        stack = [(root, obj['children'])]
+        while stack:
+            node, child_hashes = stack.pop()
+            for child_hash in child_hashes:
+                child_obj = self.get(child_hash)
+                child = child_obj['node']
+                child['children'] = []
+                node['children'].append(child)
+                stack.append((child, child_obj['children']))
+        return root
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifests_dir, f'{name}.json')
+
+    def add_backup(self, data, name, backup_time=None):
+        if os.path.isfile(self.manifest_path(name)):
+            name = next(f'{name}-{i}' for i in range(1, 1000) if not os.path.isfile(self.manifest_path(f'{name}-{i}')))
+        manifest = {'name': name, 'time': backup_time if backup_time else time.time(), 'tree': self.put_tree(data)}
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        # manifests are written after their objects, so every manifest on disk is complete
+        with open(self.manifest_path(name) + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path(name) + '.tmp', self.manifest_path(name))
+        return manifest
+
+    # manifests of all backup points, oldest first
+    def backups(self):
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        manifests = []
+        for filename in os.listdir(self.manifests_dir):
+            if filename.endswith('.json'):
+                with open(os.path.join(self.manifests_dir, filename)) as f:
+                    manifests.append(json.load(f))
+        return sorted(manifests, key=lambda m: m['time'])
+
+    def restore(self, name):
+        with open(self.manifest_path(name)) as f:
+            manifest = json.load(f)
+        return self.get_tree(manifest['tree'])
+
+    def apply_retention(self, retention, now=None):
+        backups = self.backups()
+        kept = set(retained_backups(backups, retention, now))
+        removed = [backup['name'] for backup in backups if backup['name'] not in kept]
+        for name in removed:
+            os.remove(self.manifest_path(name))
+        if removed:
+            self.collect_garbage()
+        return removed
+
+    # removes objects which no backup point refers to, and their lines in the references file
+    def collect_garbage(self):
+        live = set()
+        stack = [backup['tree'] for backup in self.backups()]
+        while stack:
+            obj_hash = stack.pop()
+            if obj_hash in live:
+                continue
+            live.add(obj_hash)
+            stack.extend(self.object_references(obj_hash))
+        for obj_hash in list(self.known()):
+            if obj_hash not in live:
+                os.remove(self.object_path(obj_hash))
+                self._known.discard(obj_hash)
+        self._references = {obj_hash: refs for obj_hash, refs in self.references().items() if obj_hash in live}
+        self._new_references = []
+        with open(self.references_path + '.tmp', 'w') as f:
+            f.writelines(json.dumps([obj_hash, refs], separators=(',', ':')) + '\n'
+                         for obj_hash, refs in self._references.items())
+        os.replace(self.references_path + '.tmp', self.references_path)
@@ -0,0 +1,137 @@
+import json
+import sys
+
+from util.tree_file import tree_open, tree_create
+from util.tree_db import is_database, TreeDatabase
+from util.response_store import ResponseStore, response_filename
+from util.util_tree import all_nodes
+from util.journal import journal_filename, read_journal, replay_journal, remove_journal
+
+"""
+Compaction removes data in a tree which nothing refers to any more:
+
+    responses       stored model responses which no node was generated from
+    chapters        chapters whose root node is gone, and chapter ids of nodes naming missing chapters
+    summaries       summaries whose root or end node is gone, and ids of missing summaries in nodes
+    masked heads    chains inside zipped nodes which can't be unzipped because their tail is gone
+    generation      old style meta.generation data of nodes which have a stored response
+
+Nodes inside zipped nodes count as part of the tree, since unzipping restores them. Sizes are the bytes of
+compact json, or of the response file.
+"""
+
+CATEGORIES = ('responses', 'chapters', 'summaries', 'masked heads', 'generation')
+
+
+def json_size(obj):
+    return len(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+# Removes unreferenced data from the tree data and the response store. Returns {category: [count, bytes]}.
+# With dry_run nothing is removed
+def compact_tree_data(data, responses=None, dry_run=False):
+    report = {category: [0, 0] for category in CATEGORIES}
+
+    def remove(category, size):
+        report[category][0] += 1
+        report[category][1] += size
+
+    nodes = []
+    stack = [data['root']]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.get('children', []))
+        if 'masked_head' in node:
+            if node.get('tail_id') in {n['id'] for n in all_nodes(node['masked_head'])}:
+                stack.append(node['masked_head'])
+            else:
+                remove('masked heads', json_size(node['masked_head']))
+                if not dry_run:
+                    node.pop('masked_head')
+                    node.pop('tail_id', None)
+    node_ids = {node['id'] for node in nodes}
+
+    chapters = data.get('chapters') or {}
+    live_chapters = set()
+    for chapter_id, chapter in list(chapters.items()):
+        if chapter.get('root_id') in node_ids:
+            live_chapters.add(chapter_id)
+        else:
+            remove('chapters', json_size(chapter))
+            if not dry_run:
+                chapters.pop(chapter_id)
+    summaries = data.get('summaries') or {}
+    live_summaries = set()
+    for summary_id, summary in list(summaries.items()):
+        if summary.get('root_id') in node_ids and summary.get('end_id') in node_ids:
+            live_summaries.add(summary_id)
+        else:
+            remove('summaries', json_size(summary))
+            if not dry_run:
+                summaries.pop(summary_id)
+
+    generation_ids = set()
+    for node in nodes:
+        if 'chapter_id' in node and node['chapter_id'] not in live_chapters:
+            remove('chapters', json_size(node['chapter_id']))
+            if not dry_run:
+                node.pop('chapter_id')
+        missing = [summary_id for summary_id in node.get('summaries', []) if summary_id not in live_summaries]
+        if missing:
+            remove('summaries', json_size(missing))
+            if not dry_run:
+                node['summaries'] = [summary_id for summary_id in node['summaries'] if summary_id in live_summaries]
+        if 'generation' in node:
+            generation_ids.add(node['generation']['id'])
+            if 'generation' in node.get('meta', {}):
+                remove('generation', json_size(node['meta']['generation']))
+                if not dry_run:
+                    node['meta'].pop('generation')
+
+    # trees saved before responses were kept in their own file have them inline
+    inline_responses = data.get('model_responses') or {}
+    for response_id, response in list(inline_responses.items()):
+        if response_id not in generation_ids:
+            remove('responses', json_size(response))
+            if not dry_run:
+                inline_responses.pop(response_id)
+    if responses is not None:
+        count, size = responses.compact(generation_ids, dry_run)
+        report['responses'][0] += count
+        report['responses'][1] += size
+    return report
+
+
+def report_text(report):
+    lines = [f'{category}: {count} ({size / 1024:.1f} KB)' for category, (count, size) in report.items()]
+    lines.append(f'total: {sum(size for _, size in report.values()) / 1024:.1f} KB')
+    return '\n'.join(lines)
+
+
+def compact_tree_file(filename, dry_run=False):
+    data, _ = tree_open(filename)
+    # changes autosaved since the last save are part of the tree
+    records = read_journal(journal_filename(filename), data.get('journal_generation'))
+    if records:
+        replay_journal(data, records)
+    responses = ResponseStore(response_filename(filename))
+    report = compact_tree_data(data, responses, dry_run)
+    if not dry_run:
+        tree_create(filename, data)
+        remove_journal(journal_filename(filename))
+        if is_database(filename):
+            database = TreeDatabase(filename)
+            try:
+                database.vacuum()
+            finally:
+                database.close()
+    return report
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--dry-run']
+    if len(args) != 1:
+        print('usage: python -m util.compaction [--dry-run] <tree file>')
+        sys.exit(1)
+    print(report_text(compact_tree_file(args[0], dry_run='--dry-run' in sys.argv)))
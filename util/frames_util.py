@@ -50,4 +50,39 @@ frame_merger_override = Merger(
     # finally, choose the strategies in
     # the case where the types conflict:
     ["override"]
-)
\ No newline at end of file
+)
+
+# Read-only containers for the merged state, see TreeModel.resolved_state. They are built once per state and
+# shared by every reader, so they can't be changed in place; changes go through frames. deepcopy (and pickling)
+# gives back plain dicts and lists which can be edited
+def read_only(*args, **kwargs):
+    raise TypeError('the merged state is read-only, change it with a frame update')
+
+
+class FrozenDict(dict):
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = read_only
+
+    def __deepcopy__(self, memo):
+        return {key: deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class FrozenList(list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = remove = pop = clear = sort = \
+        reverse = read_only
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(value, memo) for value in self]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
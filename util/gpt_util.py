@@ -3,7 +3,9 @@ import os
 import numpy as np
 import math
 import codecs
+import threading
 from util.tokenizer import logit_mask
+from util.request_cache import request_cache, request_key
 
 
 def normalize(probs):
@@ -27,47 +29,82 @@ def total_logprob(response):
     return sum(logprobs)
 
 
-def tokenize_ada(prompt):
-    response = openai.Completion.create(
-        engine='ada',
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+# seconds to wait for a response, unless the model's config sets 'timeout'
+DEFAULT_TIMEOUT = 600
+CONNECT_TIMEOUT = 10
+
+# Each (api_base, key, organization, timeout) gets its own client instead of reconfiguring a shared one per
+# request. Clients keep their connections alive between requests. Async clients are only used from the
+# generation service's event loop (see generation_service.py), blocking ones are used for scoring
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def openai_client(api_base=None, api_key=None, organization=None, timeout=DEFAULT_TIMEOUT, asynchronous=True):
+    api_base = api_base if api_base else DEFAULT_API_BASE
+    key = (api_base, api_key, organization, timeout, asynchronous)
+    with _clients_lock:
+        if key not in _clients:
+            client_class = openai.AsyncOpenAI if asynchronous else openai.OpenAI
+            _clients[key] = client_class(base_url=api_base,
+                                         api_key=api_key if api_key else 'placeholder',
+                                         organization=organization,
+                                         timeout=openai.Timeout(timeout, connect=CONNECT_TIMEOUT))
+        return _clients[key]
+
+
+# scoring without a model's endpoint goes to the endpoint configured in the environment, like openai's own client
+def scoring_client(api_base=None, api_key=None):
+    return openai_client(api_base if api_base else os.environ.get("OPENAI_BASE_URL", None),
+                         api_key if api_key else os.environ.get("OPENAI_API_KEY", None),
+                         asynchronous=False)
+
+
+# logprobs of the prompt's tokens ({'tokens', 'text_offset', 'token_logprobs', 'top_logprobs'}). Scoring a
+# prompt always gives the same result, so these are kept in the request cache
+def echo_logprobs(prompt, engine='ada', logprobs=0, bypass_cache=False, api_base=None, api_key=None):
+    client = scoring_client(api_base, api_key)
+    key = None if bypass_cache else request_key(engine, str(client.base_url), prompt,
+                                                {'max_tokens': 0, 'echo': True, 'logprobs': logprobs})
+    if key:
+        cached = request_cache().get(key)
+        if cached is not None:
+            return cached
+    response = client.completions.create(
+        model=engine,
         prompt=prompt,
         max_tokens=0,
         echo=True,
         n=1,
-        logprobs=0
-    )
-    tokens = response.choices[0]["logprobs"]["tokens"]
-    positions = response.choices[0]["logprobs"]["text_offset"]
+        logprobs=logprobs
+    ).to_dict()
+    result = response['choices'][0]['logprobs']
+    if key:
+        request_cache().put(key, result)
+    return result
+
+
+def tokenize_ada(prompt):
+    logprobs = echo_logprobs(prompt, engine='ada')
+    tokens = logprobs["tokens"]
+    positions = logprobs["text_offset"]
     return tokens, positions
 
 
-def prompt_probs(prompt, engine='ada'):
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=prompt,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=0
-    )
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    tokens = response.choices[0]["logprobs"]["tokens"]
-    logprobs = response.choices[0]["logprobs"]["token_logprobs"]
+def prompt_probs(prompt, engine='ada', api_base=None, api_key=None):
+    response_logprobs = echo_logprobs(prompt, engine=engine, api_base=api_base, api_key=api_key)
+    positions = response_logprobs["text_offset"]
+    tokens = response_logprobs["tokens"]
+    logprobs = response_logprobs["token_logprobs"]
     return logprobs, tokens, positions
 
 # evaluates logL(prompt+target | prompt)
-def conditional_logprob(prompt, target, engine='ada'):
+def conditional_logprob(prompt, target, engine='ada', api_base=None, api_key=None):
     combined = prompt + target
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=combined,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=0
-    )
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    logprobs = response.choices[0]["logprobs"]["token_logprobs"]
+    response_logprobs = echo_logprobs(combined, engine=engine, api_base=api_base, api_key=api_key)
+    positions = response_logprobs["text_offset"]
+    logprobs = response_logprobs["token_logprobs"]
     word_index = positions.index(len(prompt))
     total_conditional_logprob = sum(logprobs[word_index:])
     return total_conditional_logprob
@@ -136,16 +173,9 @@ def substring_probs(preprompt, content, target, engine='ada', quiet=0):
 # returns a list of substrings of content
 # logL(substring+target | substring) for each substring
 def token_conditional_logprob(content, target, engine='ada'):
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=content,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=100
-    )
-    tokens = response.choices[0]['logprobs']['tokens']
-    top_logprobs = response.choices[0]['logprobs']['top_logprobs']
+    response_logprobs = echo_logprobs(content, engine=engine, logprobs=100)
+    tokens = response_logprobs['tokens']
+    top_logprobs = response_logprobs['top_logprobs']
     logprobs = []
     substrings = []
     substring = ''
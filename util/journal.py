@@ -0,0 +1,116 @@
+import json
+import os
+
+from util.util_tree import preorder
+
+"""
+The journal is an append-only log of node operations written next to a tree file, so that autosaves only
+write what changed. Each line is a json record. The first record names the generation of the snapshot
+the journal applies to; a journal whose generation doesn't match the snapshot's is stale and ignored.
+
+Records:
+    {"op": "begin", "generation": ...}
+    {"op": "create", "parent_id": ..., "node": {...}}       node without children, appended to parent
+    {"op": "update", "node": {...}}                         replaces node attributes except children
+    {"op": "move", "id": ..., "parent_id": ...}             appended to new parent
+    {"op": "order", "id": ..., "children": [...]}           new order of a node's children
+    {"op": "delete", "id": ..., "reassign": bool}           reassign moves the children to the parent
+    {"op": "select", "id": ...}
+    {"op": "response", "id": ..., "response": {...}}        model response (older journals, see util/response_store.py)
+"""
+
+
+def journal_filename(tree_filename):
+    return tree_filename + '.journal'
+
+
+def read_journal(filename, generation):
+    if not generation or not os.path.isfile(filename):
+        return []
+    records = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a record cut off by a crash, everything before it is still good
+                break
+    if not records or records[0].get('op') != 'begin' or records[0].get('generation') != generation:
+        return []
+    return records[1:]
+
+
+def append_journal(filename, records, generation):
+    new_file = not os.path.isfile(filename)
+    with open(filename, 'a') as f:
+        if new_file:
+            f.write(json.dumps({'op': 'begin', 'generation': generation}) + '\n')
+        for record in records:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def remove_journal(filename):
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+
+# applies journal records to raw tree data (as loaded from the snapshot)
+def replay_journal(tree_data, records):
+    if not records:
+        return tree_data
+    node_dict = {d['id']: d for d in preorder(tree_data['root'])}
+    for record in records:
+        op = record['op']
+        if op == 'create':
+            parent = node_dict.get(record['parent_id'])
+            if parent is None or record['node']['id'] in node_dict:
+                continue
+            node = dict(record['node'])
+            node['children'] = []
+            node['parent_id'] = parent['id']
+            parent['children'].append(node)
+            node_dict[node['id']] = node
+        elif op == 'update':
+            node = node_dict.get(record['node']['id'])
+            if node is None:
+                continue
+            children = node['children']
+            node.clear()
+            node.update(record['node'])
+            node['children'] = children
+        elif op == 'move':
+            node = node_dict.get(record['id'])
+            new_parent = node_dict.get(record['parent_id'])
+            old_parent = node_dict.get(node.get('parent_id')) if node else None
+            if node is None or new_parent is None or old_parent is None:
+                continue
+            old_parent['children'].remove(node)
+            node['parent_id'] = new_parent['id']
+            new_parent['children'].append(node)
+        elif op == 'order':
+            node = node_dict.get(record['id'])
+            if node is None:
+                continue
+            position = {child_id: i for i, child_id in enumerate(record['children'])}
+            node['children'].sort(key=lambda child: position.get(child['id'], len(position)))
+        elif op == 'delete':
+            node = node_dict.get(record['id'])
+            parent = node_dict.get(node.get('parent_id')) if node else None
+            if node is None or parent is None:
+                continue
+            parent['children'].remove(node)
+            if record.get('reassign'):
+                for child in node['children']:
+                    child['parent_id'] = parent['id']
+                parent['children'].extend(node['children'])
+                del node_dict[node['id']]
+            else:
+                for descendant in preorder(node):
+                    node_dict.pop(descendant['id'], None)
+        elif op == 'select':
+            tree_data['selected_node_id'] = record['id']
+        elif op == 'response':
+            tree_data.setdefault('model_responses', {})[record['id']] = record['response']
+    return tree_data
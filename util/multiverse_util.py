@@ -1,31 +1,39 @@
 import openai
 import numpy as np
 from util.tokenizer import tokenize, token_to_word
-from util.gpt_util import logprobs_to_probs, get_correct_key
+from util.gpt_util import logprobs_to_probs, openai_client
+from util.request_cache import request_cache, request_key
 import os
 
 
-def generate(prompt, engine, api_base, api_key):
-    openai.base_url, openai.api_key = api_base + '/', api_key
-    #print('calling engine', engine, 'at endpoint', openai.api_base)
+# greedy next token logprobs, which are the same every time, so they're kept in the request cache
+def generate(prompt, engine, api_base, api_key, bypass_cache=False):
+    key = None if bypass_cache else request_key(engine, api_base, prompt,
+                                                {'max_tokens': 1, 'temperature': 0, 'logprobs': 100})
+    if key:
+        cached = request_cache().get(key)
+        if cached is not None:
+            return cached
+    client = openai_client(api_base, api_key, asynchronous=False)
     #print('prompt:', prompt)
-    response = openai.completions.create(prompt=prompt,
-                                        max_tokens=1,
-                                        n=1,
-                                        temperature=0,
-                                        logprobs=100,
-                                        model=engine).dict()
+    response = client.completions.create(prompt=prompt,
+                                         max_tokens=1,
+                                         n=1,
+                                         temperature=0,
+                                         logprobs=100,
+                                         model=engine).to_dict()
+    if key:
+        request_cache().put(key, response)
     return response
 
 # TODO multiple "ground truth" trajectories
 def greedy_word_multiverse(prompt, ground_truth='', max_depth=3,  unnormalized_amplitude=1, unnormalized_threshold=0.1,
-                           engine='davinci-002', model_type='openai', api_base=None):
+                           engine='davinci-002', api_base=None, api_key=None):
     if isinstance(ground_truth, str):
         ground_truth = tokenize(ground_truth)
         ground_truth = [token_to_word(token).replace('Ġ', ' ') for token in ground_truth]
     if max_depth == 0:
         return {}, ground_truth
-    api_key, _ = get_correct_key(model_type)
     response = generate(prompt, engine, api_base, api_key)
     logprobs = response['choices'][0]["logprobs"]["top_logprobs"][0]
     probs = {k: logprobs_to_probs(v) for k, v in sorted(logprobs.items(), key=lambda item: item[1], reverse=True)}
@@ -38,14 +46,16 @@ def greedy_word_multiverse(prompt, ground_truth='', max_depth=3,  unnormalized_a
                                                              unnormalized_threshold=unnormalized_threshold,
                                                              unnormalized_amplitude=token[1]['unnormalized_prob'],
                                                              engine=engine,
-                                                             api_base=api_base)
+                                                             api_base=api_base,
+                                                             api_key=api_key)
         elif token[0] == ground_truth_token:
             token[1]['children'], _ = greedy_word_multiverse(prompt + token[0], ground_truth=ground_truth[1:],
                                                              max_depth=max_depth-1,
                                                              unnormalized_threshold=unnormalized_threshold,
                                                              unnormalized_amplitude=token[1]['unnormalized_prob'],
                                                              engine=engine,
-                                                             api_base=api_base)
+                                                             api_base=api_base,
+                                                             api_key=api_key)
 
 
             done_ground_truth = True
@@ -23,6 +23,8 @@ def node_is_canonical(node, **kwargs):
 def descendent_of(ancestor_id, node, **kwargs):
     tree_node_dict = kwargs['tree_node_dict']
     ancestor = tree_node_dict[ancestor_id]
+    if 'is_ancestor' in kwargs:
+        return kwargs['is_ancestor'](ancestor, node)
     return in_ancestry(ancestor, node, tree_node_dict)
 
 
@@ -30,6 +32,8 @@ def descendent_of(ancestor_id, node, **kwargs):
 def ancestor_of(node, descendent_id, **kwargs):
     tree_node_dict = kwargs['tree_node_dict']
     descendent = tree_node_dict[descendent_id]
+    if 'is_ancestor' in kwargs:
+        return kwargs['is_ancestor'](node, descendent)
     return in_ancestry(node, descendent, tree_node_dict)
 
 
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+"""
+Responses to deterministic requests (temperature 0, or scoring a prompt without generating) are kept on disk,
+so repeating a request doesn't call the model again. Entries are keyed by a hash of the model, the api base,
+a hash of the prompt and the request parameters which change the response, see request_key. When the file
+grows past its size cap, the least recently used entries are removed.
+
+Set LOOM_BYPASS_CACHE in the environment, or bypass on the cache, to send every request.
+"""
+
+DEFAULT_CACHE_FILE = os.path.join('data', 'request_cache.db')
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+# entries removed at a time when the cache is too big
+EVICTION_BATCH = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER, used REAL);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+"""
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+# params are the request parameters which change the response. Parameters set to None are left out
+def request_key(model, api_base, prompt, params):
+    params = {name: value for name, value in params.items() if value is not None}
+    content = json.dumps([model, api_base, prompt_hash(prompt), params], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class RequestCache:
+    def __init__(self, filename=DEFAULT_CACHE_FILE, max_bytes=MAX_CACHE_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.bypass = bool(os.environ.get('LOOM_BYPASS_CACHE'))
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # used from the generation service's loop and the Tk thread
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    # the cached value, or None
+    def get(self, key):
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if self.bypass:
+            return
+        data = json.dumps(value, separators=(',', ':'))
+        size = len(data.encode('utf-8'))
+        with self.lock:
+            old = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+                                        (key, data, size, time.time()))
+            self.size += size - (old[0] if old else 0)
+            self.evict()
+
+    # removes the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_bytes:
+                rows = self.connection.execute("SELECT key, size FROM entries ORDER BY used LIMIT ?",
+                                               (EVICTION_BATCH,)).fetchall()
+                if not rows:
+                    break
+                removed = []
+                for key, size in rows:
+                    if self.size <= self.max_bytes:
+                        break
+                    removed.append((key,))
+                    self.size -= size
+                with self.connection:
+                    self.connection.executemany("DELETE FROM entries WHERE key = ?", removed)
+
+    def clear(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM entries")
+            self.connection.execute("VACUUM")
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self.size}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def request_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RequestCache()
+        return _cache
@@ -0,0 +1,241 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+"""
+Model responses (prompts, completions, logprobs and counterfactuals) are kept out of the tree in an append-only
+sidecar file next to it, so saving and loading the tree doesn't read or write them. Each line is
+json(response id) + tab + json(response). Responses are read from the file when they're needed, with the most
+recently used ones cached.
+
+The offsets of the lines are kept in an index file next to the responses, with a line of
+json(response id) + tab + offset + tab + length for each. Opening the store reads the index, and only scans the
+part of the responses file after the last indexed line, which is empty unless a write was cut off. If the index
+doesn't match the file it's built again from the whole file.
+
+New responses are kept in memory until flush writes them, which the model does on its save thread before
+each save, so generations don't write to disk on the Tk thread.
+"""
+
+# max number of responses kept in memory
+RESPONSE_CACHE_SIZE = 64
+
+
+def response_filename(tree_filename):
+    return tree_filename + '.responses'
+
+
+def index_filename(filename):
+    return filename + '.index'
+
+
+class ResponseStore:
+    def __init__(self, filename=None):
+        self.filename = None
+        # responses are added and read on the Tk thread, where the generation service delivers them, and
+        # flushed on the model's save thread
+        self.lock = threading.RLock()
+        # {response_id: (offset, length)} of lines in the file
+        self._index = {}
+        # {response_id: response} added while there's no file
+        self._pending = {}
+        # {response_id: response} added since the last flush
+        self._unwritten = {}
+        self._cache = OrderedDict()
+        self._ends_with_newline = True
+        self.attach(filename)
+
+    def read_index(self):
+        self._index = {}
+        self._cache.clear()
+        self._ends_with_newline = True
+        if not self.filename:
+            return
+        if not os.path.isfile(self.filename):
+            # an index left by a removed file
+            if os.path.isfile(index_filename(self.filename)):
+                os.remove(index_filename(self.filename))
+            return
+        offset = self.read_offsets(os.path.getsize(self.filename))
+        indexed = offset
+        lines = []
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                tab = line.find(b'\t')
+                # a line cut off by a crash is skipped
+                if tab > 0 and line.endswith(b'\n'):
+                    response_id = json.loads(line[:tab])
+                    self._index[response_id] = (offset, len(line))
+                    lines.append(self.index_line(response_id, offset, len(line)))
+                offset += len(line)
+                self._ends_with_newline = line.endswith(b'\n')
+        if lines or not indexed:
+            with open(index_filename(self.filename), 'ab' if indexed else 'wb') as f:
+                f.writelines(lines)
+
+    # Reads the index file into _index. Returns the end of the last indexed line, or 0 if the index doesn't
+    # match a responses file of this size
+    def read_offsets(self, size):
+        if not os.path.isfile(index_filename(self.filename)):
+            return 0
+        index = {}
+        end = 0
+        last = None
+        with open(index_filename(self.filename), 'rb') as f:
+            for line in f:
+                fields = line.split(b'\t')
+                # a line cut off by a crash is skipped, the scan finds its response
+                if len(fields) != 3 or not line.endswith(b'\n'):
+                    continue
+                response_id, offset, length = json.loads(fields[0]), int(fields[1]), int(fields[2])
+                index[response_id] = (offset, length)
+                if offset + length > end:
+                    end = offset + length
+                    last = response_id
+        if end > size:
+            return 0
+        # the file could have been replaced by one at least as long
+        if last is not None:
+            offset, length = index[last]
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                line = f.read(length)
+            if not line.startswith(json.dumps(last).encode('utf-8') + b'\t') or not line.endswith(b'\n'):
+                return 0
+        self._index = index
+        return end
+
+    def index_line(self, response_id, offset, length):
+        return f'{json.dumps(response_id)}\t{offset}\t{length}\n'.encode('utf-8')
+
+    # stores responses in filename from now on. Responses stored in the old file are copied if filename is new
+    def attach(self, filename):
+        with self.lock:
+            if filename == self.filename:
+                return
+            if filename and self.filename and os.path.isfile(self.filename) and not os.path.exists(filename):
+                shutil.copyfile(self.filename, filename)
+                if os.path.isfile(index_filename(self.filename)):
+                    shutil.copyfile(index_filename(self.filename), index_filename(filename))
+            self.filename = filename
+            self.read_index()
+            if self.filename:
+                self._unwritten.update(self._pending)
+                self._pending = {}
+
+    def write(self, response_id, response):
+        line = (json.dumps(response_id) + '\t' + json.dumps(response, separators=(',', ':')) + '\n').encode('utf-8')
+        with open(self.filename, 'ab') as f:
+            if not self._ends_with_newline:
+                f.write(b'\n')
+                self._ends_with_newline = True
+            offset = f.tell()
+            f.write(line)
+        # the index is written after its line, so it never points past the end of the file
+        with open(index_filename(self.filename), 'ab') as f:
+            f.write(self.index_line(response_id, offset, len(line)))
+        self._index[response_id] = (offset, len(line))
+
+    # writes the responses added since the last flush. Called from the model's save thread
+    def flush(self):
+        with self.lock:
+            if not self.filename:
+                return
+            unwritten, self._unwritten = self._unwritten, {}
+            for response_id, response in unwritten.items():
+                self.write(response_id, response)
+
+    def unwritten(self):
+        return bool(self._unwritten)
+
+    def __setitem__(self, response_id, response):
+        with self.lock:
+            if self.filename:
+                self._unwritten[response_id] = response
+            else:
+                self._pending[response_id] = response
+            self.cache(response_id, response)
+
+    def __contains__(self, response_id):
+        return response_id in self._pending or response_id in self._unwritten or response_id in self._index
+
+    def __len__(self):
+        return len(self._pending) + len(self._index) + sum(1 for response_id in self._unwritten
+                                                           if response_id not in self._index)
+
+    def get(self, response_id, default=None):
+        with self.lock:
+            if response_id in self._pending:
+                return self._pending[response_id]
+            if response_id in self._unwritten:
+                return self._unwritten[response_id]
+            if response_id in self._cache:
+                self._cache.move_to_end(response_id)
+                return self._cache[response_id]
+            if response_id not in self._index:
+                return default
+            offset, length = self._index[response_id]
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                line = f.read(length)
+            response = json.loads(line[line.find(b'\t') + 1:])
+            self.cache(response_id, response)
+            return response
+
+    def cache(self, response_id, response):
+        self._cache[response_id] = response
+        self._cache.move_to_end(response_id)
+        if len(self._cache) > RESPONSE_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    # moves the stored responses to filename and starts an empty store
+    def archive(self, filename):
+        with self.lock:
+            self.flush()
+            if self.filename and os.path.isfile(self.filename):
+                os.replace(self.filename, filename)
+                if os.path.isfile(index_filename(self.filename)):
+                    os.replace(index_filename(self.filename), index_filename(filename))
+            elif self._pending:
+                with open(filename, 'w') as f:
+                    for response_id, response in self._pending.items():
+                        f.write(json.dumps(response_id) + '\t' + json.dumps(response) + '\n')
+            self._pending = {}
+            self.read_index()
+
+    # Removes responses not in keep, and lines of responses which were written again, by rewriting the file.
+    # Returns the number of responses removed and the bytes they took. With dry_run nothing is removed
+    def compact(self, keep, dry_run=False):
+        with self.lock:
+            self.flush()
+            removed = [response_id for response_id in self._pending if response_id not in keep]
+            size = sum(len(json.dumps(self._pending[response_id])) for response_id in removed)
+            if not dry_run:
+                for response_id in removed:
+                    self._pending.pop(response_id)
+            if not self.filename or not os.path.isfile(self.filename):
+                return len(removed), size
+            kept = {response_id: line for response_id, line in self._index.items() if response_id in keep}
+            removed += [response_id for response_id in self._index if response_id not in keep]
+            size += os.path.getsize(self.filename) - sum(length for _, length in kept.values())
+            if not dry_run:
+                with open(self.filename, 'rb') as f, open(self.filename + '.tmp', 'wb') as out:
+                    for offset, length in kept.values():
+                        f.seek(offset)
+                        out.write(f.read(length))
+                os.replace(self.filename + '.tmp', self.filename)
+                if os.path.isfile(index_filename(self.filename)):
+                    os.remove(index_filename(self.filename))
+                self.read_index()
+            return len(removed), size
+
+    def clear(self):
+        with self.lock:
+            if self.filename and os.path.isfile(self.filename):
+                os.remove(self.filename)
+            self._pending = {}
+            self._unwritten = {}
+            self.read_index()
@@ -0,0 +1,56 @@
+from diff_match_patch import diff_match_patch
+
+"""
+Revision history of a node's text, oldest first, stored in node['history']. Every KEYFRAME_INTERVAL-th revision
+keeps its full text, the others a diff_match_patch delta from the revision before:
+
+    {'timestamp': ..., 'text': full text}
+    {'timestamp': ..., 'delta': diff_toDelta(diff(previous revision, this revision))}
+
+Revisions saved before deltas (all with full text) are keyframes. A revision is rebuilt from the nearest
+keyframe before it, so at most KEYFRAME_INTERVAL - 1 deltas are applied.
+"""
+
+KEYFRAME_INTERVAL = 20
+# seconds spent looking for a minimal diff before settling for a longer one
+DIFF_TIMEOUT = 0.1
+
+dmp = diff_match_patch()
+dmp.Diff_Timeout = DIFF_TIMEOUT
+
+
+def make_delta(old_text, new_text):
+    diffs = dmp.diff_main(old_text, new_text)
+    dmp.diff_cleanupEfficiency(diffs)
+    return dmp.diff_toDelta(diffs)
+
+
+def apply_delta(text, delta):
+    return dmp.diff_text2(dmp.diff_fromDelta(text, delta))
+
+
+def revision_text(history, index):
+    index = index % len(history)
+    keyframe = index
+    while 'text' not in history[keyframe]:
+        keyframe -= 1
+    text = history[keyframe]['text']
+    for revision in history[keyframe + 1:index + 1]:
+        text = apply_delta(text, revision['delta'])
+    return text
+
+
+# all revisions as {'timestamp': ..., 'text': ...}
+def revisions(history):
+    texts = []
+    for revision in history:
+        text = revision['text'] if 'text' in revision else apply_delta(texts[-1]['text'], revision['delta'])
+        texts.append({'timestamp': revision['timestamp'], 'text': text})
+    return texts
+
+
+def add_revision(history, text, revision_timestamp):
+    if len(history) % KEYFRAME_INTERVAL == 0:
+        history.append({'timestamp': revision_timestamp, 'text': text})
+    else:
+        history.append({'timestamp': revision_timestamp, 'delta': make_delta(revision_text(history, -1), text)})
@@ -0,0 +1,134 @@
+import base64
+import numpy as np
+
+"""
+Token data of stored completions is kept in columns instead of a dict per token:
+
+    strings       every distinct token string in the completion (generated and counterfactual), concatenated
+    string_start  int32 offset of each distinct string in strings, and the total length
+    token         int32 index of each generated token's string
+    logprob       float32 logprob of each generated token (nan if there is none)
+    start, end    int32 character offsets of each token in the completion text
+    top_token     int32 (tokens x k) counterfactual token indices, sorted by logprob, padded with -1
+    top_logprob   float32 (tokens x k) counterfactual logprobs, padded with nan
+
+Indexing a TokenArray gives the token data dict gpt.py produces, so code reading completion['tokens'] works
+with either. Stored in json as {"strings": ..., "k": ..., column: base64 of the little endian array bytes, ...}.
+"""
+
+COLUMNS = {
+    'string_start': np.dtype('<i4'),
+    'token': np.dtype('<i4'),
+    'logprob': np.dtype('<f4'),
+    'start': np.dtype('<i4'),
+    'end': np.dtype('<i4'),
+    'top_token': np.dtype('<i4'),
+    'top_logprob': np.dtype('<f4'),
+}
+
+
+class TokenArray:
+    def __init__(self, strings, string_start, token, logprob, start, end, top_token, top_logprob):
+        self.strings = strings
+        self.string_start = string_start
+        self.token = token
+        self.logprob = logprob
+        self.start = start
+        self.end = end
+        self.top_token = top_token
+        self.top_logprob = top_logprob
+
+    # from a list of token data dicts
+    @classmethod
+    def from_tokens(cls, tokens):
+        strings = []
+        string_index = {}
+
+        def intern(string):
+            if string not in string_index:
+                string_index[string] = len(strings)
+                strings.append(string)
+            return string_index[string]
+
+        n = len(tokens)
+        k = max((len(token_data.get('counterfactuals') or {}) for token_data in tokens), default=0)
+        token = np.empty(n, dtype=COLUMNS['token'])
+        logprob = np.empty(n, dtype=COLUMNS['logprob'])
+        start = np.empty(n, dtype=COLUMNS['start'])
+        end = np.empty(n, dtype=COLUMNS['end'])
+        top_token = np.full((n, k), -1, dtype=COLUMNS['top_token'])
+        top_logprob = np.full((n, k), np.nan, dtype=COLUMNS['top_logprob'])
+        offset = 0
+        for i, token_data in enumerate(tokens):
+            generated = token_data['generatedToken']
+            token[i] = intern(generated['token'])
+            logprob[i] = np.nan if generated['logprob'] is None else generated['logprob']
+            position = token_data.get('position')
+            # OpenAI token data only has an end offset or the token's index, so offsets are counted from the text
+            if isinstance(position, dict):
+                start[i], end[i] = position['start'], position['end']
+            else:
+                start[i], end[i] = offset, offset + len(generated['token'])
+            offset = end[i]
+            counterfactuals = token_data.get('counterfactuals') or {}
+            for j, (string, counterfactual_logprob) in enumerate(counterfactuals.items()):
+                top_token[i, j] = intern(string)
+                top_logprob[i, j] = counterfactual_logprob
+        # sort counterfactuals by logprob, padding last
+        order = np.argsort(np.where(np.isnan(top_logprob), np.inf, -top_logprob), axis=1, kind='stable')
+        top_token = np.take_along_axis(top_token, order, axis=1)
+        top_logprob = np.take_along_axis(top_logprob, order, axis=1)
+        string_start = np.zeros(len(strings) + 1, dtype=COLUMNS['string_start'])
+        np.cumsum([len(string) for string in strings], out=string_start[1:])
+        return cls(''.join(strings), string_start, token, logprob, start, end, top_token, top_logprob)
+
+    @classmethod
+    def decode(cls, data):
+        columns = {}
+        for name, dtype in COLUMNS.items():
+            columns[name] = np.frombuffer(base64.b64decode(data[name]), dtype=dtype)
+        n = len(columns['token'])
+        k = data['k']
+        columns['top_token'] = columns['top_token'].reshape(n, k)
+        columns['top_logprob'] = columns['top_logprob'].reshape(n, k)
+        return cls(data['strings'], **columns)
+
+    def encode(self):
+        data = {'strings': self.strings, 'k': self.top_token.shape[1]}
+        for name, dtype in COLUMNS.items():
+            data[name] = base64.b64encode(np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes()).decode('ascii')
+        return data
+
+    def __len__(self):
+        return len(self.token)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, i):
+        logprob = float(self.logprob[i])
+        return {'generatedToken': {'token': self.string(self.token[i]),
+                                   'logprob': None if np.isnan(logprob) else logprob},
+                'position': {'start': int(self.start[i]), 'end': int(self.end[i])},
+                'counterfactuals': self.counterfactuals(i)}
+
+    # {token: logprob} sorted by logprob, or None if the token has no counterfactuals
+    def counterfactuals(self, i):
+        counterfactuals = {self.string(t): float(logprob)
+                           for t, logprob in zip(self.top_token[i], self.top_logprob[i]) if t >= 0}
+        return counterfactuals if counterfactuals else None
+
+    def string(self, index):
+        return self.strings[self.string_start[index]:self.string_start[index + 1]]
+
+    def probs(self):
+        return np.exp(self.logprob)
+
+
+# TokenArray of stored token data, which may be an encoded TokenArray or a list of token data dicts
+def token_array(tokens):
+    if tokens is None or isinstance(tokens, TokenArray):
+        return tokens
+    if isinstance(tokens, dict):
+        return TokenArray.decode(tokens)
+    return TokenArray.from_tokens(tokens)
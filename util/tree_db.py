@@ -0,0 +1,254 @@
+import json
+import sqlite3
+import threading
+
+"""
+Trees saved with a .db extension are stored in SQLite. Nodes are rows linked by parent_id, with their position
+among their siblings, so a save only writes the nodes which changed (see apply_records, which takes the same
+records as util/journal.py) and each save is one transaction. Tags are indexed in a separate table, and
+chapters, summaries and model responses have their own tables. The rest of the tree data is kept as json
+values in the tree table.
+"""
+
+DATABASE_EXTENSIONS = ('.db', '.sqlite')
+# top level tree data which has its own table
+TABLES = ('chapters', 'summaries', 'model_responses')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (id TEXT PRIMARY KEY, parent_id TEXT, position INTEGER, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent_id, position);
+CREATE TABLE IF NOT EXISTS tags (node_id TEXT, tag TEXT, PRIMARY KEY (node_id, tag)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+CREATE TABLE IF NOT EXISTS chapters (id TEXT PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS summaries (id TEXT PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS model_responses (id TEXT PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS tree (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def is_database(filename):
+    return filename is not None and filename.endswith(DATABASE_EXTENSIONS)
+
+
+def node_data(node):
+    return json.dumps({key: value for key, value in node.items() if key != 'children'}, separators=(',', ':'))
+
+
+class TreeDatabase:
+    def __init__(self, filename):
+        self.filename = filename
+        # saves write from the save thread
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.RLock()
+
+    def close(self):
+        self.connection.close()
+
+    #################################
+    #   Reading
+    #################################
+
+    # Returns the tree data, {node_id: node} and {node_id: number of children} of nodes whose children weren't
+    # loaded. If lazy, only the children of the root and of open nodes are loaded
+    def read_tree(self, lazy=False):
+        with self.lock:
+            data = {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM tree")}
+            for table in TABLES:
+                data[table] = {row_id: json.loads(value)
+                               for row_id, value in self.connection.execute(f"SELECT id, data FROM {table}")}
+            if lazy:
+                rows = self.connection.execute(
+                    "SELECT id, parent_id, position, data FROM nodes WHERE parent_id IS NULL").fetchall()
+                rows.extend(self.subtree_rows(rows[0][0], lazy=True) if rows else [])
+            else:
+                rows = self.connection.execute("SELECT id, parent_id, position, data FROM nodes").fetchall()
+            node_dict, unloaded = self.build_nodes(rows, lazy)
+        data['root'] = next((node_dict[row[0]] for row in rows if row[1] is None), None)
+        return data, node_dict, unloaded
+
+    # Returns the children of node_id with their descendents linked, {node_id: node} and the unloaded children
+    # like read_tree
+    def read_children(self, node_id, lazy=False):
+        with self.lock:
+            rows = self.subtree_rows(node_id, lazy)
+            node_dict, unloaded = self.build_nodes(rows, lazy)
+        children = [node_dict[row[0]] for row in sorted(rows, key=lambda row: row[2]) if row[1] == node_id]
+        return children, node_dict, unloaded
+
+    # rows (id, parent_id, position, data) of the descendents of node_id. If lazy, the descendents of nodes
+    # which aren't open are left out
+    def subtree_rows(self, node_id, lazy=False):
+        condition = "WHERE json_extract(subtree.data, '$.open')" if lazy else ""
+        return self.connection.execute(
+            "WITH RECURSIVE subtree(id, parent_id, position, data) AS ("
+            "SELECT id, parent_id, position, data FROM nodes WHERE parent_id = ? UNION ALL "
+            "SELECT nodes.id, nodes.parent_id, nodes.position, nodes.data FROM nodes "
+            f"JOIN subtree ON nodes.parent_id = subtree.id {condition}) SELECT * FROM subtree", (node_id,)).fetchall()
+
+    def build_nodes(self, rows, lazy=False):
+        node_dict = {}
+        for node_id, _, _, value in rows:
+            node = json.loads(value)
+            node['children'] = []
+            node_dict[node_id] = node
+        for node_id, parent_id, _, _ in sorted(rows, key=lambda row: row[2]):
+            if parent_id in node_dict:
+                node_dict[parent_id]['children'].append(node_dict[node_id])
+        unloaded = {}
+        if lazy:
+            leaves = [node_id for node_id, node in node_dict.items() if not node['children']]
+            for i in range(0, len(leaves), 500):
+                batch = leaves[i:i + 500]
+                unloaded.update(self.connection.execute(
+                    f"SELECT parent_id, COUNT(*) FROM nodes WHERE parent_id IN ({','.join('?' * len(batch))}) "
+                    "GROUP BY parent_id", batch).fetchall())
+        return node_dict, unloaded
+
+    def node_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def descendent_count(self, node_id):
+        with self.lock:
+            return len(self.subtree_ids(node_id)) - 1
+
+    # ids from the root to node_id
+    def ancestor_ids(self, node_id):
+        with self.lock:
+            ids = [row[0] for row in self.connection.execute(
+                "WITH RECURSIVE ancestry(id, parent_id) AS (SELECT id, parent_id FROM nodes WHERE id = ? UNION ALL "
+                "SELECT nodes.id, nodes.parent_id FROM nodes JOIN ancestry ON nodes.id = ancestry.parent_id) "
+                "SELECT id FROM ancestry", (node_id,))]
+        return ids[::-1]
+
+    def child_ids(self, node_id):
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT id FROM nodes WHERE parent_id = ? ORDER BY position", (node_id,))]
+
+    def tagged_ids(self, tag):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT node_id FROM tags WHERE tag = ?", (tag,))]
+
+    def subtree_ids(self, node_id):
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "WITH RECURSIVE subtree(id) AS (SELECT ? UNION ALL "
+                "SELECT nodes.id FROM nodes JOIN subtree ON nodes.parent_id = subtree.id) SELECT id FROM subtree",
+                (node_id,))]
+
+    #################################
+    #   Writing
+    #################################
+
+    # replaces everything in the database with the tree data in one transaction. The descendents of the nodes in
+    # unloaded weren't loaded from the database and are kept
+    def write_tree(self, data, unloaded=()):
+        with self.lock, self.connection:
+            for table in ('tree',) + TABLES:
+                self.connection.execute(f"DELETE FROM {table}")
+            if unloaded:
+                self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS kept (id TEXT PRIMARY KEY)")
+                self.connection.execute("DELETE FROM kept")
+                for node_id in unloaded:
+                    self.connection.executemany("INSERT OR IGNORE INTO kept (id) VALUES (?)",
+                                                [(i,) for i in self.subtree_ids(node_id)[1:]])
+                self.connection.execute("DELETE FROM nodes WHERE id NOT IN (SELECT id FROM kept)")
+                self.connection.execute("DELETE FROM tags WHERE node_id NOT IN (SELECT id FROM kept)")
+            else:
+                self.connection.execute("DELETE FROM nodes")
+                self.connection.execute("DELETE FROM tags")
+            self.connection.executemany("INSERT INTO tree (key, value) VALUES (?, ?)",
+                                        [(key, json.dumps(value)) for key, value in data.items()
+                                         if key != 'root' and key not in TABLES])
+            for table in TABLES:
+                self.connection.executemany(f"INSERT INTO {table} (id, data) VALUES (?, ?)",
+                                            [(key, json.dumps(value)) for key, value in (data.get(table) or {}).items()])
+            rows = []
+            tags = []
+            stack = [(data['root'], None, 0)]
+            while stack:
+                node, parent_id, position = stack.pop()
+                rows.append((node['id'], parent_id, position, node_data(node)))
+                tags.extend((node['id'], tag) for tag in set(node.get('tags', [])))
+                stack.extend((child, node['id'], i) for i, child in enumerate(node.get('children', [])))
+            self.connection.executemany("INSERT INTO nodes (id, parent_id, position, data) VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany("INSERT INTO tags (node_id, tag) VALUES (?, ?)", tags)
+
+    # applies journal records (see util/journal.py) in one transaction
+    def apply_records(self, records):
+        with self.lock, self.connection:
+            for record in records:
+                op = record['op']
+                if op == 'create':
+                    self.insert_node(record['node'], record['parent_id'])
+                elif op == 'update':
+                    node = record['node']
+                    self.connection.execute("UPDATE nodes SET data = ? WHERE id = ?", (node_data(node), node['id']))
+                    self.set_tags(node)
+                elif op == 'move':
+                    self.connection.execute("UPDATE nodes SET parent_id = ?, position = ? WHERE id = ?",
+                                            (record['parent_id'], self.next_position(record['parent_id']), record['id']))
+                elif op == 'order':
+                    self.connection.executemany("UPDATE nodes SET position = ? WHERE id = ?",
+                                                [(i, child_id) for i, child_id in enumerate(record['children'])])
+                elif op == 'delete':
+                    self.delete_node(record['id'], record.get('reassign', False))
+                elif op == 'select':
+                    self.connection.execute("INSERT OR REPLACE INTO tree (key, value) VALUES (?, ?)",
+                                            ('selected_node_id', json.dumps(record['id'])))
+                elif op == 'response':
+                    self.connection.execute("INSERT OR REPLACE INTO model_responses (id, data) VALUES (?, ?)",
+                                            (record['id'], json.dumps(record['response'])))
+
+    def next_position(self, parent_id):
+        row = self.connection.execute("SELECT MAX(position) FROM nodes WHERE parent_id = ?", (parent_id,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def insert_node(self, node, parent_id):
+        self.connection.execute("INSERT OR REPLACE INTO nodes (id, parent_id, position, data) VALUES (?, ?, ?, ?)",
+                                (node['id'], parent_id, self.next_position(parent_id), node_data(node)))
+        self.set_tags(node)
+
+    def set_tags(self, node):
+        self.connection.execute("DELETE FROM tags WHERE node_id = ?", (node['id'],))
+        self.connection.executemany("INSERT INTO tags (node_id, tag) VALUES (?, ?)",
+                                    [(node['id'], tag) for tag in set(node.get('tags', []))])
+
+    def delete_node(self, node_id, reassign=False):
+        row = self.connection.execute("SELECT parent_id FROM nodes WHERE id = ?", (node_id,)).fetchone()
+        if row is None:
+            return
+        if reassign:
+            position = self.next_position(row[0])
+            self.connection.executemany("UPDATE nodes SET parent_id = ?, position = ? WHERE id = ?",
+                                        [(row[0], position + i, child_id)
+                                         for i, child_id in enumerate(self.child_ids(node_id))])
+            ids = [node_id]
+        else:
+            ids = self.subtree_ids(node_id)
+        self.connection.executemany("DELETE FROM nodes WHERE id = ?", [(i,) for i in ids])
+        self.connection.executemany("DELETE FROM tags WHERE node_id = ?", [(i,) for i in ids])
+
+    # returns the space of deleted rows to the file system
+    def vacuum(self):
+        with self.lock:
+            self.connection.execute("VACUUM")
+
+
+def read_database(filename):
+    database = TreeDatabase(filename)
+    try:
+        data, node_dict, _ = database.read_tree()
+        return data, node_dict
+    finally:
+        database.close()
+
+
+def write_database(filename, data):
+    database = TreeDatabase(filename)
+    try:
+        database.write_tree(data)
+    finally:
+        database.close()
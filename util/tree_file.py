@@ -0,0 +1,164 @@
+import json
+import os
+import struct
+import sys
+import zlib
+
+from util.util import json_open, json_create
+from util.tree_db import is_database, read_database, write_database
+
+"""
+Binary tree files (.loom) are a zlib stream of length prefixed json records, much smaller than pretty printed
+json and faster to load because nodes are read in batches without parsing the nesting.
+
+    b'LOOM1\n' + zlib(record, record, ...)
+    record = 4 byte little endian length + compact json
+
+The first record is the tree data without the root. The others are batches of nodes in preorder, each node
+written as [index of its parent in preorder (-1 for the root), node attributes without children].
+"""
+
+TREE_EXTENSION = '.loom'
+MAGIC = b'LOOM1\n'
+# nodes per record
+BATCH_SIZE = 1000
+# bytes read from the file at a time
+READ_SIZE = 1 << 20
+
+
+def is_binary_tree(filename):
+    return os.path.splitext(filename)[1] == TREE_EXTENSION
+
+
+def write_tree_file(filename, data):
+    compressor = zlib.compressobj()
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+
+        def write_record(obj):
+            encoded = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+            f.write(compressor.compress(struct.pack('<I', len(encoded)) + encoded))
+
+        write_record({key: value for key, value in data.items() if key != 'root'})
+        batch = []
+        # preorder, with the position of each node's parent
+        stack = [(data['root'], -1)]
+        position = 0
+        while stack:
+            node, parent = stack.pop()
+            batch.append([parent, {key: value for key, value in node.items() if key != 'children'}])
+            stack.extend((child, position) for child in reversed(node.get('children', [])))
+            position += 1
+            if len(batch) >= BATCH_SIZE:
+                write_record(batch)
+                batch = []
+        if batch:
+            write_record(batch)
+        f.write(compressor.flush())
+
+
+def read_records(f):
+    decompressor = zlib.decompressobj()
+    buffer = b''
+    while True:
+        chunk = f.read(READ_SIZE)
+        buffer += decompressor.decompress(chunk) if chunk else decompressor.flush()
+        pos = 0
+        while len(buffer) - pos >= 4:
+            (length,) = struct.unpack_from('<I', buffer, pos)
+            if len(buffer) - pos - 4 < length:
+                break
+            yield json.loads(buffer[pos + 4:pos + 4 + length])
+            pos += 4 + length
+        buffer = buffer[pos:]
+        if not chunk:
+            break
+
+
+# Returns the tree data and {node_id: node}, built while the nodes are read
+def read_tree_file(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a tree file')
+        records = read_records(f)
+        data = next(records)
+        nodes = []
+        node_dict = {}
+        for batch in records:
+            for parent, node in batch:
+                node['children'] = []
+                if parent >= 0:
+                    nodes[parent]['children'].append(node)
+                nodes.append(node)
+                if 'id' in node:
+                    node_dict[node['id']] = node
+    data['root'] = nodes[0]
+    return data, node_dict
+
+
+# Opens a json, binary or database tree file. Returns the tree data and {node_id: node} if it was built while loading
+def tree_open(filename):
+    if is_binary_tree(filename):
+        return read_tree_file(filename)
+    if is_database(filename):
+        return read_database(filename)
+    return json_open(filename), None
+
+
+def is_jsonl(filename):
+    return os.path.splitext(filename)[1] == '.jsonl'
+
+
+# Reads a stream of trees, one json object per line: either tree data with a root, or a node. Nodes without
+# children whose parent_id names a node read before (like the lines of TreeModel.save_jsonl) are added to
+# its children, other nodes are roots of new trees. Yields tree data
+def read_jsonl_trees(f):
+    tree = None
+    nodes = {}
+    for line in f:
+        if not line.strip():
+            continue
+        obj = json.loads(line)
+        if 'root' in obj:
+            if tree:
+                yield tree
+            tree = None
+            nodes = {}
+            yield obj
+            continue
+        obj.setdefault('children', [])
+        parent = nodes.get(obj.get('parent_id'))
+        if parent is not None:
+            parent['children'].append(obj)
+        else:
+            # a new tree starts, the previous nodes can't be parents any more
+            if tree:
+                yield tree
+            tree = {'root': obj}
+            nodes = {}
+        if 'id' in obj:
+            nodes[obj['id']] = obj
+    if tree:
+        yield tree
+
+
+def tree_create(filename, data):
+    if is_binary_tree(filename):
+        write_tree_file(filename, data)
+    elif is_database(filename):
+        write_database(filename, data)
+    else:
+        json_create(filename, data)
+
+
+# converts between json, binary and database tree files, depending on the extensions
+def convert_tree(filename, new_filename):
+    data, _ = tree_open(filename)
+    tree_create(new_filename, data)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'usage: python -m util.tree_file <tree.json|tree{TREE_EXTENSION}|tree.db> <tree.json|tree{TREE_EXTENSION}|tree.db>')
+        sys.exit(1)
+    convert_tree(sys.argv[1], sys.argv[2])
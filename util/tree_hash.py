@@ -0,0 +1,78 @@
+import hashlib
+import json
+import sys
+
+from util.tree_file import tree_open
+
+"""
+Subtree hashes combine a node's text, its tags and the hashes of its children in order, so two subtrees with
+the same hash have the same content and shape. Diffing two trees compares hashes from the roots down and
+only descends into subtrees whose hashes differ, matching children by id.
+"""
+
+
+def node_hash(node, child_hashes):
+    content = json.dumps([node.get('text', ''), sorted(set(node.get('tags', []))), child_hashes],
+                         separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Returns {node_id: hash} for root and its descendents. Hashes already in cache are reused (a node in cache must
+# have all its descendents in it too) and new ones are added to it
+def subtree_hashes(root, cache=None, children=lambda node: node.get('children', [])):
+    hashes = cache if cache is not None else {}
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node['id'] in hashes:
+            continue
+        if expanded:
+            hashes[node['id']] = node_hash(node, [hashes[child['id']] for child in children(node)])
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children(node))
+    return hashes
+
+
+# Compares two trees, given their {node_id: hash}. Returns the ids of nodes whose text or tags changed, whose
+# children were reordered, and of the roots of added and removed subtrees. A moved subtree is removed from its
+# old parent and added to the new one
+def diff_trees(root_a, root_b, hashes_a, hashes_b):
+    diff = {'changed': [], 'reordered': [], 'added': [], 'removed': []}
+    if root_a['id'] != root_b['id']:
+        diff['removed'].append(root_a['id'])
+        diff['added'].append(root_b['id'])
+        return diff
+    stack = [(root_a, root_b)]
+    while stack:
+        a, b = stack.pop()
+        if hashes_a[a['id']] == hashes_b[b['id']]:
+            continue
+        if a.get('text', '') != b.get('text', '') or set(a.get('tags', [])) != set(b.get('tags', [])):
+            diff['changed'].append(a['id'])
+        children_a = {child['id']: child for child in a.get('children', [])}
+        children_b = {child['id']: child for child in b.get('children', [])}
+        diff['removed'].extend(child_id for child_id in children_a if child_id not in children_b)
+        diff['added'].extend(child_id for child_id in children_b if child_id not in children_a)
+        if [i for i in children_a if i in children_b] != [i for i in children_b if i in children_a]:
+            diff['reordered'].append(a['id'])
+        stack.extend((child, children_b[child_id]) for child_id, child in children_a.items() if child_id in children_b)
+    return diff
+
+
+def diff_text(diff):
+    return '\n'.join(f'{kind}: {len(ids)}' + ''.join(f'\n    {node_id}' for node_id in ids)
+                     for kind, ids in diff.items())
+
+
+def diff_tree_files(filename_a, filename_b):
+    root_a = tree_open(filename_a)[0]['root']
+    root_b = tree_open(filename_b)[0]['root']
+    return diff_trees(root_a, root_b, subtree_hashes(root_a), subtree_hashes(root_b))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python -m util.tree_hash <tree A> <tree B>')
+        sys.exit(1)
+    print(diff_text(diff_tree_files(sys.argv[1], sys.argv[2])))
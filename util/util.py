@@ -1,3 +1,4 @@
+import asyncio
 import collections
 import csv
 import datetime
@@ -57,8 +58,8 @@ def datestamp():
     return datetime.date.today()
 
 
-def timestamp():
-    ts = time.time()
+def timestamp(ts=None):
+    ts = ts if ts else time.time()
     return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d-%H.%M.%S')
 
 
@@ -407,6 +408,33 @@ def retry(func=None, exception=Exception, n_tries=5, delay=0.1,
             on_failure=on_failure,
         )
 
+    # coroutine functions are retried without blocking their event loop
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            ntries, ndelay = n_tries, delay
+            exe = None
+            while ntries > 0:
+                try:
+                    return await func(*args, **kwargs)
+                except exception as e:
+                    exe = e
+                    msg = f"Failed with exception: {str(e)}, Retrying in {ndelay} seconds..."
+                    if logger:
+                        logging.warning(msg)
+                    else:
+                        print(msg)
+                    await asyncio.sleep(ndelay)
+                    ntries -= 1
+                    ndelay *= backoff
+
+            if on_failure is not None:
+                on_failure(*args, **kwargs)
+            else:
+                raise exe
+
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         ntries, ndelay = n_tries, delay
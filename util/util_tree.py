@@ -55,6 +55,62 @@ def subtree_list(root, filter=None, depth_limit=None):
     return sub_list
 
 
+# Iterative preorder traversal of a subtree. Unlike subtree_list, this doesn't recurse,
+# so it is safe on very deep chains
+def preorder(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.get('children', [])))
+
+
+# preorder, including the chains inside zipped nodes
+def all_nodes(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if 'masked_head' in node:
+            stack.append(node['masked_head'])
+        stack.extend(reversed(node.get('children', [])))
+
+
+# Gives new ids to nodes, chapters and summaries of tree data whose ids are in taken (or missing), and updates
+# the references to them. The ids of the tree are added to taken. Returns {old id: new id}
+def remap_tree_ids(tree, taken):
+    id_map = {}
+    for node in all_nodes(tree['root']):
+        if 'id' not in node or node['id'] in taken:
+            new_id = str(uuid.uuid1())
+            if 'id' in node:
+                id_map[node['id']] = new_id
+            node['id'] = new_id
+        taken.add(node['id'])
+    for table in ('chapters', 'summaries'):
+        items = tree.get(table) or {}
+        for item_id in list(items):
+            item = items.pop(item_id)
+            if item_id in taken:
+                id_map[item_id] = str(uuid.uuid1())
+            item['id'] = id_map.get(item_id, item_id)
+            taken.add(item['id'])
+            for key in ('root_id', 'end_id'):
+                if key in item:
+                    item[key] = id_map.get(item[key], item[key])
+            items[item['id']] = item
+    if id_map:
+        for node in all_nodes(tree['root']):
+            for key in ('parent_id', 'tail_id', 'chapter_id'):
+                if key in node:
+                    node[key] = id_map.get(node[key], node[key])
+            if 'summaries' in node:
+                node['summaries'] = [id_map.get(summary_id, summary_id) for summary_id in node['summaries']]
+        if 'canonical' in tree:
+            tree['canonical'] = [id_map.get(node_id, node_id) for node_id in tree['canonical']]
+    return id_map
+
+
 def depth_limited_tree(root, depth_limit):
     new_root = {'id': root['id'], 'children': []}
     if depth_limit == 0:
@@ -89,8 +145,11 @@ def collapsed_wavefunction(ancestry, root, current_node, depth_limit):
             new_root['children'].append(collapsed_wavefunction(ancestry[1:], child, current_node, depth_limit))
     return new_root
 
-def limited_distance_tree(root, reference_node, distance_limit, node_dict):
-    condition = lambda node: path_distance(reference_node, node, node_dict) <= distance_limit
+# distance is an optional function (node_a, node_b) -> path distance, e.g. TreeModel.path_distance
+def limited_distance_tree(root, reference_node, distance_limit, node_dict, distance=None):
+    if not distance:
+        distance = lambda node_a, node_b: path_distance(node_a, node_b, node_dict)
+    condition = lambda node: distance(reference_node, node) <= distance_limit
     if not condition(root):
         # root is node in reference node's ancestry distance_limit removed
         ancestry = node_ancestry(reference_node, node_dict)
@@ -160,9 +219,10 @@ def node_ancestry(node, node_dict):
     while "parent_id" in node:
         if node['parent_id'] in node_dict:
             node = node_dict[node["parent_id"]]
-            ancestry.insert(0, node)
+            ancestry.append(node)
         else:
             break
+    ancestry.reverse()
     return ancestry
 
 # returns node ancestry starting from root
@@ -223,7 +283,7 @@ def path_distance(node_a, node_b, node_dict):
 # Returns True if a is ancestor of b
 def in_ancestry(a, b, node_dict):
     ancestry = node_ancestry(b, node_dict)
-    return a in ancestry
+    return any(ancestor['id'] == a['id'] for ancestor in ancestry)
 
 def node_index(node, node_dict):
     return len(node_ancestry(node, node_dict)) - 1
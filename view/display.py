@@ -459,6 +459,9 @@ class Display:
             "<Button-1>", lambda event: f(node_id=self.chapter_nav_tree.identify('item', event.x, event.y))
         )
 
+        # load the children of nodes opened in the nav tree
+        self.nav_tree.bind("<<TreeviewOpen>>", lambda event: self.callbacks["Nav open"]["callback"]())
+
         # bind right click to context menu
         self.nav_tree.bind("<Button-3>", self.nav_tree_context_menu)
         self.nav_tree.bind("<Button-2>", self.nav_tree_context_menu)
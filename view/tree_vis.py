@@ -6,7 +6,7 @@ import copy
 from pprint import pprint
 from tkinter import ttk
 
-from util.util_tree import node_ancestry, limited_branching_tree, tree_subset
+from util.util_tree import node_ancestry, limited_branching_tree, tree_subset, preorder
 from util.custom_tks import TextAware
 from PIL import ImageTk, Image
 from view.colors import vis_bg_color, visited_node_bg_color, unvisited_node_bg_color,inactive_text_color,\
@@ -815,7 +815,7 @@ class TreeVis:
     def expand_node(self, node, change_selection=True, center_selection=True):
         ancestry = node_ancestry(node, self.state.tree_node_dict)
         for ancestor in ancestry:
-            ancestor['open'] = True
+            self.state.set_node_flag(ancestor, 'open', True)
         if change_selection or not self.selected_node['open']:
             #self.controller.nav_select(node)
             self.select_node(node)
@@ -825,6 +825,7 @@ class TreeVis:
     def expand_children(self, node):
         for child in node["children"]:
             child['open'] = True
+        self.state.nodes_changed(node["children"])
         self.draw(self.root, self.selected_node, center_on_selection=False)
 
 
@@ -833,19 +834,21 @@ class TreeVis:
             if node == self.root:
                 self.select_node(self.root)
             else:
-                node["open"] = False
+                self.state.set_node_flag(node, "open", False)
                 self.select_node(self.state.tree_node_dict[node["parent_id"]])
         else:
-            node["open"] = False
+            self.state.set_node_flag(node, "open", False)
         self.draw(self.root, self.selected_node, center_on_selection=False)
 
 
     def expand_all(self):
         self.expand_subtree(self.root)
+        self.state.nodes_changed(self.state.nodes)
 
 
     def collapse_all(self, immune=None):
         self.collapse_subtree(self.root, immune=immune)
+        self.state.nodes_changed(self.state.nodes)
 
 
     def collapse_subtree(self, root, immune=None):
@@ -865,11 +868,13 @@ class TreeVis:
 
     def collapse_node_subtree(self, root):
         self.collapse_subtree(root)
+        self.state.nodes_changed(list(preorder(root)))
         self.collapse_node(root, select_parent=True)
 
 
     def expand_node_subtree(self, root):
         self.expand_subtree(root)
+        self.state.nodes_changed(list(preorder(root)))
         self.expand_node(root, change_selection=False)
 
 
@@ -880,6 +885,7 @@ class TreeVis:
 
     def collapse_children(self, node):
         self.collapse_subtree(node)
+        self.state.nodes_changed(list(preorder(node)))
         self.expand_node(node, change_selection=False)
 
 